@@ -0,0 +1,272 @@
+#!/usr/bin/env python
+
+### Setup
+
+# Libraries.
+import argparse
+import json
+import multiprocessing
+import numpy as np
+import os
+import pandas as pd
+import platform
+import resource
+import subprocess
+import sys
+import time
+
+# Model code and data-processing stages.
+src_dir_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, os.path.join(src_dir_path, 'model'))
+sys.path.insert(0, os.path.join(src_dir_path, 'data-processing'))
+
+# Benchmarks in run order, with the unit of their throughput.
+benchmark_units = [
+    ('sample',   'draws/s'),
+    ('predict',  'games/s'),
+    ('score',    'games/s'),
+    ('simulate', 'simulations/s'),
+    ('exact',    'draws/s'),
+    ('build',    'games/s'),
+    ('import',   'imports/s')
+]
+
+# Model modules that must import with NumPy alone. The heavy dependencies are loaded on first use: pandas by the functions
+# that take or return data frames, the rest by sampling with PyMC, cross validation, plotting and the recursive engine.
+core_modules = ['bayes_lr', 'game_predictions', 'samplers', 'approximations', 'diagnostics', 'online', 'trace_store',
+                'win_prob_cache', 'games_dataset', 'feature_search', 'prediction_server']
+heavy_modules = ['pandas', 'pymc', 'sklearn', 'matplotlib', 'scipy']
+
+# Longest the core may take to import (seconds, beyond starting an empty interpreter).
+max_import_seconds = .4
+
+### Synthetic Data
+
+def synthetic_team_stats (n_teams, k_features, rng):
+    """
+    KenPom-like team statistics: 'TeamName' and k_features statistic columns S0, S1, ...
+    """
+    stats = pd.DataFrame(rng.standard_normal((n_teams,k_features))*10+100, columns=['S%d' % k for k in range(k_features)])
+    stats.insert(0, 'TeamName', ['Team %04d' % t for t in range(n_teams)])
+    return stats
+
+def synthetic_coefs (draws, k_features, rng):
+    """
+    Posterior-like coefficient trace (draws x (k_features+1)), intercept first.
+    """
+    center = np.concatenate(([.1], rng.standard_normal(k_features)*.05))
+    return center + rng.standard_normal((draws,k_features+1))*.01
+
+def synthetic_games (n_games, team_stats, rng):
+    """
+    Games between random pairs of teams, with diff_ features for every statistic, location_Home and a win drawn from the model.
+    """
+    stat_cols = [c for c in team_stats.columns if c != 'TeamName']
+    team = rng.randint(len(team_stats), size=n_games)
+    opponent = (team + 1 + rng.randint(len(team_stats)-1, size=n_games)) % len(team_stats)
+    values = np.asarray(team_stats[stat_cols], dtype=np.float64)
+    games = pd.DataFrame(values[team]-values[opponent], columns=['diff_'+c for c in stat_cols])
+    games['location_Home'] = rng.randint(2, size=n_games)
+    coefs = synthetic_coefs(1, len(stat_cols), rng)[0]
+    s = coefs[0] + games[['diff_'+c for c in stat_cols]].values.dot(coefs[1:]) + .5*games.location_Home.values
+    games['win'] = (rng.random_sample(n_games) < 1/(1+np.exp(-s))).astype(np.int64)
+    return games
+
+def synthetic_bracket (team_stats, n_teams, rng):
+    """
+    Bracket (array of first-round pairs) of n_teams random teams.
+    """
+    return rng.permutation(np.array(team_stats.TeamName))[:n_teams].reshape((-1,2))
+
+def synthetic_snapshots (n_games, team_stats, year, rng):
+    """
+    Team snapshot records (as written by process_snapshots.py) for n_games games, each listed by both teams, plus the season's
+    KenPom summary.
+    """
+    names = list(team_stats.TeamName)
+    team = rng.randint(len(names), size=n_games//2)
+    opponent = (team + 1 + rng.randint(len(names)-1, size=n_games//2)) % len(names)
+    day = rng.randint(120, size=n_games//2)
+    snapshots = dict((t, {'team':t, 'year':year, 'games':[]}) for t in names)
+    for g in range(n_games//2):
+        date = (pd.Timestamp('%d-11-10' % (year-1)) + pd.Timedelta(days=int(day[g]))).strftime('%Y-%m-%d')
+        win = rng.randint(2)
+        for a, b, w, loc in ((team[g], opponent[g], win, 'Home'), (opponent[g], team[g], 1-win, 'Away')):
+            snapshots[names[a]]['games'].append({
+                'date': date, 'opponent': names[b], 'location': loc, 'conference': False, 'conference_tournament': False,
+                'ncaa_tournament': False, 'other_tournament': False, 'win': bool(w), 'points_for': 70+5*w, 'points_against': 75-5*w
+            })
+    kenpom = team_stats.copy()
+    kenpom['year'] = year
+    return list(snapshots.values()), kenpom
+
+### Benchmarks
+
+def run_benchmark (task):
+    """
+    Runs one benchmark, best of 'repeat' timings. Meant to run in a fresh worker process so peak memory is its own.
+    Inputs:
+        task: Tuple of (benchmark name, parameter dictionary, repeat).
+    Returns:
+        Dictionary of seconds (best run), throughput, unit, work items and peak resident memory (MB).
+        The import benchmark also reports the start time of an empty interpreter and the heavy modules that were loaded.
+    """
+    name, params, repeat = task
+    extra = {}
+    rng = np.random.RandomState(params['seed'])
+    team_stats = synthetic_team_stats(params['teams'], params['features'], rng)
+    features = ['diff_S%d' % k for k in range(params['features'])]
+
+    # Set up inputs outside the timed region; 'run' does the work and 'items' is the amount of it.
+    if name == 'sample':
+        import bayes_lr
+        games = synthetic_games(params['games'], team_stats, rng)
+        def run ():
+            model = bayes_lr.model_games(games, features, backend=params['backend'], step_method=params['step_method'], seed=params['seed'])
+            model.sample(params['draws'], params['draws']//5)
+        items = params['draws']
+    elif name in ('predict', 'score'):
+        import game_predictions
+        games = synthetic_games(params['games'], team_stats, rng)
+        coefs = synthetic_coefs(params['draws'], params['features'], rng)
+        if name == 'predict':
+            run = lambda: game_predictions.predict_games(games, features, coefs=coefs, method='pp')
+        else:
+            run = lambda: game_predictions.score_games(games, features, coefs=coefs)
+        items = params['games']
+    elif name in ('simulate', 'exact'):
+        import game_predictions
+        bracket = synthetic_bracket(team_stats, params['bracket'], rng)
+        coefs = synthetic_coefs(params['draws'], params['features'], rng)
+        deterministic = 'exact' if name == 'exact' else False
+        run = lambda: game_predictions.simulate_tournament(bracket, team_stats, features, deterministic=deterministic, coef_trace=coefs)
+        items = params['draws']
+    elif name == 'build':
+        import generate_game_data
+        snapshots, kenpom = synthetic_snapshots(params['games'], team_stats, 2015, rng)
+        run = lambda: generate_game_data.build_games(snapshots, kenpom)
+        items = params['games']
+    elif name == 'import':
+        # A fresh interpreter importing every core model module, reporting which heavy modules came with them.
+        code = 'import sys; sys.path.insert(0, %r); import %s; print(",".join(m for m in %r if m in sys.modules))' % (
+            os.path.join(src_dir_path, 'model'), ', '.join(core_modules), heavy_modules)
+        def run ():
+            loaded = subprocess.check_output([sys.executable, '-c', code]).decode().strip()
+            extra['heavy_modules'] = [m for m in loaded.split(',') if m != '']
+        items = 1
+        extra['interpreter_seconds'] = min(timed(lambda: subprocess.check_output([sys.executable, '-c', 'pass'])) for _r in range(repeat))
+    else:
+        raise ValueError('Unknown benchmark: %s' % name)
+
+    times = [timed(run) for _r in range(repeat)]
+
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS.
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+    return dict(extra,
+        seconds    = min(times),
+        throughput = items / max(min(times), 1e-12),
+        unit       = dict(benchmark_units)[name],
+        items      = items,
+        peak_mb    = peak / 2.**20
+    )
+
+def timed (run):
+    start = time.time()
+    run()
+    return time.time() - start
+
+def run_benchmarks (names, params, repeat=3):
+    """
+    Runs benchmarks, each in its own process.
+    Returns:
+        Results dictionary: environment, parameters and per-benchmark results.
+    """
+    results = {}
+    for name in names:
+        pool = multiprocessing.Pool(1, maxtasksperchild=1)
+        try:
+            results[name] = pool.apply(run_benchmark, ((name, params, repeat),))
+        finally:
+            pool.close()
+            pool.join()
+    return {
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'commit':    git_commit(),
+        'python':    platform.python_version(),
+        'numpy':     np.__version__,
+        'pandas':    pd.__version__,
+        'params':    params,
+        'results':   results
+    }
+
+def git_commit ():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=src_dir_path).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare_results (base, new, threshold=.1):
+    """
+    Compares two results dictionaries benchmark by benchmark.
+    Returns:
+        List of (benchmark, base throughput, new throughput, ratio, regressed) tuples; a benchmark regressed if its throughput
+        fell by more than 'threshold' (a fraction).
+    """
+    rows = []
+    for name, _unit in benchmark_units:
+        if name in base['results'] and name in new['results']:
+            b, n = base['results'][name]['throughput'], new['results'][name]['throughput']
+            rows.append((name, b, n, n/b, n/b < 1-threshold))
+    return rows
+
+### Main Execution
+
+def main (argv=None):
+    if argv is None:
+        argv = sys.argv
+
+    parser = argparse.ArgumentParser(description='Benchmark sampling, scoring, simulation and dataset build on synthetic data.')
+    parser.add_argument('--only', default=','.join(n for n, _u in benchmark_units), help='Comma-separated benchmarks to run.')
+    parser.add_argument('--teams', type=int, default=350, help='Teams in the synthetic league.')
+    parser.add_argument('--games', type=int, default=20000, help='Games to score, sample on and build.')
+    parser.add_argument('--features', type=int, default=5, help='Game features (diff_ statistics).')
+    parser.add_argument('--draws', type=int, default=2000, help='Posterior draws to sample, score and simulate with.')
+    parser.add_argument('--bracket', type=int, default=64, help='Teams in the simulated bracket.')
+    parser.add_argument('--backend', default='numpy', help='model_games backend for the sample benchmark.')
+    parser.add_argument('--step-method', default='nuts', help='Step method for the sample benchmark.')
+    parser.add_argument('--repeat', type=int, default=3, help='Timed runs per benchmark; the best is reported.')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='Write results as JSON to this file.')
+    parser.add_argument('--compare', nargs=2, metavar=('BASE','NEW'), help='Compare two results files instead of running.')
+    parser.add_argument('--threshold', type=float, default=.1, help='Throughput drop that counts as a regression.')
+    args = parser.parse_args(argv[1:])
+
+    if args.compare is not None:
+        base, new = [json.load(open(p)) for p in args.compare]
+        rows = compare_results(base, new, args.threshold)
+        print('%-10s %14s %14s %8s' % ('benchmark', 'base', 'new', 'ratio'))
+        for name, b, n, ratio, regressed in rows:
+            print('%-10s %14.1f %14.1f %8.2f%s' % (name, b, n, ratio, '  REGRESSION' if regressed else ''))
+        return 1 if any(r[4] for r in rows) else 0
+
+    params = dict((k, getattr(args, k)) for k in ('teams', 'games', 'features', 'draws', 'bracket', 'backend', 'step_method', 'seed'))
+    results = run_benchmarks(args.only.split(','), params, args.repeat)
+    for name, r in sorted(results['results'].items()):
+        print('%-10s %10.3fs %14.1f %-14s peak %7.1f MB' % (name, r['seconds'], r['throughput'], r['unit'], r['peak_mb']))
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    # The core must import quickly and without the heavy dependencies.
+    if 'import' in results['results']:
+        r = results['results']['import']
+        if len(r['heavy_modules']) > 0:
+            print('Core model modules imported %s.' % ', '.join(r['heavy_modules']))
+            return 1
+        if r['seconds']-r['interpreter_seconds'] > max_import_seconds:
+            print('Core model modules took %.3fs to import (limit %.3fs).' % (r['seconds']-r['interpreter_seconds'], max_import_seconds))
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
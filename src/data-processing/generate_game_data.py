@@ -2,6 +2,7 @@
 
 ##### Libraries
 
+import hashlib
 import json
 import numpy as np
 import os
@@ -9,6 +10,12 @@ import pandas as pd
 import re
 import sys
 
+# Games dataset helpers and instrumentation from the model code. Instrumentation is enabled by setting BAYESKET_METRICS to an
+# output file (.prom for Prometheus text).
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'model'))
+import games_dataset
+import instrumentation
+
 ##### Setup
 
 # Paths.
@@ -16,164 +23,249 @@ config_dir_path = '../../../config/'
 data_dir_path = '../../../data/'
 summary_dir_path = data_dir_path+'kenpom_summaries/'
 snapshots_path = data_dir_path+'team_snapshots.json'
-
-# Evaluate arguments; determine paths. Run with "2015_tournament" as the first argument to restrict to 2014-2015 data pre-tournament.
-if len(sys.argv) == 2 and sys.argv[-1] == '2015_tournament':
-	games_output_path = data_dir_path+'games_2015_tournament.csv'
+snapshots_lines_path = data_dir_path+'team_snapshots.jsonl'
+
+# Evaluate arguments; determine paths. Run with "2015_tournament" as an argument to restrict to 2014-2015 data pre-tournament.
+# Run with "canonical" as an argument for the canonical matchup dataset: one row per game, from one team's side chosen at random
+# (see games_dataset.canonical_games), for the symmetric model (model_games(symmetric=True)).
+# Games are written per season to the partition directory (one games_YYYY.npz per season, plus a manifest of input hashes);
+# the combined CSV is rewritten whenever a season changes.
+canonical = 'canonical' in sys.argv[1:]
+if '2015_tournament' in sys.argv[1:]:
+	games_name = 'games_2015_tournament'
 	kp_pattern = r'summary15_pt.csv'
 else:
-	games_output_path = data_dir_path+'games.csv'
+	games_name = 'games'
 	kp_pattern = r'summary\d{2}.csv'
+if canonical:
+	games_name += '_canonical'
+games_output_path = data_dir_path+games_name+'.csv'
+games_partition_path = data_dir_path+games_name+'/'
+manifest_path = games_partition_path+'manifest.json'
+
+# Version of the games table layout, part of each season's manifest inputs: bump it when build_games output changes so
+# existing partitions are rebuilt.
+games_format = 2
+
+# Game locations as they appear in schedules. Every season gets a dummy column for each, so partitions line up.
+game_locations = ['Away','Home','Neutral','Semi-Away','Semi-Home']
+
+##### Build
+
+def build_games(snapshots, kenpom, canonical=False):
+	"""
+	Builds the games table for a set of snapshots.
+	Inputs:
+		snapshots: List of team snapshot records (see process_snapshots.py).
+		kenpom:    KenPom summaries with a year column.
+		canonical: Keep one row per game (the game_group 1 side).
+	Returns:
+		Data frame with one row per team per game, or per game if canonical.
+	"""
+
+	# Flatten all snapshots into one games table.
+	game_features = pd.DataFrame([g for snap in snapshots for g in snap['games']])
+	game_features['team'] = np.repeat([snap['team'] for snap in snapshots], [len(snap['games']) for snap in snapshots])
+	game_features['year'] = np.repeat([snap['year'] for snap in snapshots], [len(snap['games']) for snap in snapshots])
+
+	# KenPom table indexed by team and year. Join once per side; prefix KenPom columns.
+	kenpom_indexed = kenpom.set_index(['TeamName','year'])
+	game_features = game_features.join(kenpom_indexed.rename(columns=lambda c: 'team_'+c), on=['team','year'], how='inner')
+	game_features = game_features.join(kenpom_indexed.rename(columns=lambda c: 'opponent_'+c), on=['opponent','year'], how='inner')
+
+	# Reset index for sequential index.
+	game_features.reset_index(drop=True, inplace=True)
+
+	### Aggregate Columns
+
+	# Get all team, opponent columns.
+	team_cols     = [c for c in game_features.columns if c.startswith('team_')]
+	opponent_cols = [c for c in game_features.columns if c.startswith('opponent_')]
+
+	# Calculate diff and ratio col names.
+	diff_col_names  = [c.replace('team_','diff_')  for c in team_cols]
+	ratio_col_names = [c.replace('team_','ratio_') for c in team_cols]
+
+	# Calculate differences and ratios.
+	team_vals     = game_features[team_cols].values
+	opponent_vals = game_features[opponent_cols].values
+	diff_vals  = team_vals - opponent_vals
+	ratio_vals = team_vals / opponent_vals
+
+	# Convert to DF.
+	diff_vals_df  = pd.DataFrame(diff_vals,  columns=diff_col_names)
+	ratio_vals_df = pd.DataFrame(ratio_vals, columns=ratio_col_names)
+
+	# Append to game features.
+	game_features = pd.concat((game_features,diff_vals_df),  axis=1)
+	game_features = pd.concat((game_features,ratio_vals_df), axis=1)
+
+	### Game IDs
+
+	# Date strings and team keys.
+	g_dates     = game_features.date.str.replace('-','')
+	g_teams     = game_features.team.str.lower().str.replace(r'[^a-z0-9]', '')
+	g_opponents = game_features.opponent.str.lower().str.replace(r'[^a-z0-9]', '')
+
+	# Order each pair of teams alphabetically and join all ID components together as game ID.
+	team_first = g_teams <= g_opponents
+	game_features['game_id'] = g_dates+'-'+g_teams.where(team_first, g_opponents)+'-'+g_opponents.where(team_first, g_teams)
+
+	# Sort on game ID. Ensures all games are paired and entire dataset sorted by year.
+	game_features.sort('game_id', inplace=True)
+	game_features.reset_index(drop=True, inplace=True)
+
+	# Now generate random 0s and 1s to identify delineations. Every two observations will sum to 1 and be 1 or 0.
+	game_group_1_first = np.random.randint(2, size=game_features.shape[0]/2)
+	game_group_1_indices = np.column_stack((game_group_1_first, 1-game_group_1_first)).ravel()
+	# Set in DF.
+	game_features['game_group'] = game_group_1_indices
+
+	### Cleanup
+
+	# Integerize dummy variables.
+	for c, dt in zip(game_features.columns,game_features.dtypes):
+		if dt == 'bool':
+			game_features[c] = game_features[c].astype(np.int)
+
+	# Get location dummies.
+	location_dummies = pd.get_dummies(pd.Categorical(game_features.location, categories=game_locations), prefix='location').astype(np.int)
+	# Clean up.
+	location_dummies.columns = [re.sub('[^a-zA-Z\\_]','',c) for c in location_dummies.columns]
+	# Antisymmetric location columns: they change sign when a game is seen from the other side.
+	location_dummies['location_HomeAway'] = location_dummies.location_Home - location_dummies.location_Away
+	location_dummies['location_SemiHomeAway'] = location_dummies.location_SemiHome - location_dummies.location_SemiAway
+
+	# Append location dummies to right.
+	game_features = pd.concat((game_features, location_dummies), axis=1)
+
+	# Reorder columns.
+	# Store main column list.
+	main_game_columns = [
+			'game_id','game_group','year','date','team','opponent',
+			'conference','conference_tournament','ncaa_tournament','other_tournament'
+		]
+	outcome_columns = ['points_for','points_against','win']
+
+	# Add Kenpom columns.
+	kp_columns = [c for c in game_features.columns if c.startswith('team_') or c.startswith('opponent_') or c.startswith('diff_') or c.startswith('ratio_')]
+
+	# Reorder columns.
+	game_features = game_features[main_game_columns+list(location_dummies.columns)+kp_columns+outcome_columns]
+
+	# One row per game if asked.
+	if canonical:
+		game_features = games_dataset.canonical_games(game_features)
+
+	return game_features
+
+##### Partitions
+
+def save_season(path, game_features):
+	"""
+	Writes one season's games as an uncompressed .npz with one typed array per column (text columns as fixed-width unicode),
+	so readers can load single columns without parsing the rest. Column order is kept in the '__columns__' entry.
+	"""
+	arrays = {}
+	for c in game_features.columns:
+		values = np.asarray(game_features[c])
+		arrays[c] = values.astype('U') if values.dtype == object else values
+	arrays['__columns__'] = np.array(list(game_features.columns), dtype='U')
+	with open(path+'.tmp', 'wb') as f:
+		np.savez(f, **arrays)
+	os.rename(path+'.tmp', path)
+
+def text_hash(lines):
+	sha = hashlib.sha1()
+	for line in lines:
+		sha.update(line.encode('utf-8') if not isinstance(line, bytes) else line)
+	return sha.hexdigest()
 
 ##### Main Execution
 
-### KenPom
-
-print 'Getting KenPom data.'
-
-# Assemble KenPom data.
-kenpom = None
-kenpom_files = os.listdir(summary_dir_path)
-# Traverse all files.
-for kp_filename in kenpom_files:
-	# Ignore non-final scores. Maybe we'll do something with these later.
-	if not re.match(kp_pattern,kp_filename):
-		continue
-	# Get year.
-	kp_year = int('20'+kp_filename[7:9])
-	# Get data.
-	kp_data = pd.read_csv(summary_dir_path+kp_filename)
-	# Add year
-	kp_data['year'] = kp_year
-	# Save.
-	if kenpom is None:
-		kenpom = kp_data
+def main(argv=None):
+	if argv is None:
+		argv = sys.argv
+
+	### KenPom
+
+	print 'Getting KenPom data.'
+
+	# KenPom summaries and their hashes by year.
+	kenpom = {}
+	kenpom_hashes = {}
+	# Traverse all files.
+	for kp_filename in os.listdir(summary_dir_path):
+		# Ignore non-final scores. Maybe we'll do something with these later.
+		if not re.match(kp_pattern,kp_filename):
+			continue
+		# Get year.
+		kp_year = int('20'+kp_filename[7:9])
+		# Get data.
+		with open(summary_dir_path+kp_filename, 'rb') as f:
+			kenpom_hashes[kp_year] = hashlib.sha1(f.read()).hexdigest()
+		kp_data = pd.read_csv(summary_dir_path+kp_filename)
+		# Add year
+		kp_data['year'] = kp_year
+		# Save.
+		kenpom[kp_year] = kp_data
+
+	### Snapshots
+
+	print 'Getting snapshots.'
+
+	# Raw snapshot records by year: one record per line from process_snapshots.py if available; else the older single JSON file.
+	if os.path.exists(snapshots_lines_path):
+		snapshot_lines = [line for line in open(snapshots_lines_path) if line.strip() != '']
 	else:
-		kenpom = kenpom.append(kp_data)
-
-### Snapshots, Join
-
-print 'Getting snapshots.'
-
-# Load snapshot data.
-snapshots_dict = json.load(open(snapshots_path))
-
-# Container for features.
-game_features = None
-
-print 'Merging snapshots with KenPom data.'
-
-# Traverse snapshots.
-for snap in snapshots_dict:
-	# Get snapshot games.
-	snap_games = pd.DataFrame(snap['games'])
-	# Append team, year.
-	snap_games['team'] = snap['team']
-	snap_games['year'] = snap['year']
-	# Join team information; prefix KenPom columns.
-	snap_games = snap_games.merge(kenpom, left_on=['team','year'], right_on=['TeamName','year'])
-	snap_games.drop('TeamName', axis=1, inplace=True)
-	snap_games.columns = ['team_'+c if (c in kenpom.columns and c != 'year') else c for c in snap_games.columns]
-	# Join opponent information; prefix KenPom columns.
-	snap_games = snap_games.merge(kenpom, left_on=['opponent','year'], right_on=['TeamName','year'])
-	snap_games.drop('TeamName', axis=1, inplace=True)
-	snap_games.columns = ['opponent_'+c if (c in kenpom.columns and c != 'year') else c for c in snap_games.columns]
-	if game_features is None:
-		game_features = snap_games
-	else:
-		game_features = game_features.append(snap_games)
-
-# Reset index for sequential index.
-game_features.reset_index(drop=True, inplace=True)
-
-### Aggregate Columns
-
-print 'Calculating aggregate columns.'
-
-# Get all team, opponent columns.
-team_cols     = [c for c in game_features.columns if c.startswith('team_')]
-opponent_cols = [c for c in game_features.columns if c.startswith('opponent_')]
-
-# Calculate diff and ratio col names.
-diff_col_names  = [c.replace('team_','diff_')  for c in team_cols]
-ratio_col_names = [c.replace('team_','ratio_') for c in team_cols]
-
-# Calculate differences and ratios.
-diff_vals  = np.array(game_features.ix[:,team_cols]) - np.array(game_features.ix[:,opponent_cols])
-ratio_vals = np.array(game_features.ix[:,team_cols]) / np.array(game_features.ix[:,opponent_cols])
-
-# Convert to DF.
-diff_vals_df  = pd.DataFrame(diff_vals,  columns=diff_col_names)
-ratio_vals_df = pd.DataFrame(ratio_vals, columns=ratio_col_names)
-
-# Append to game features.
-game_features = pd.concat((game_features,diff_vals_df),  axis=1)
-game_features = pd.concat((game_features,ratio_vals_df), axis=1)
-
-### Game IDs
-
-print 'Generating game IDs.'
-
-# Get all date strings.
-g_dates = np.array(game_features.date, dtype=np.str)
-g_dates = np.core.defchararray.replace(g_dates,'-','')
-
-# Get team combinations and sort along second axis (default).
-g_team_combos = np.array([
-		list(game_features.team.str.lower().str.replace(r'[^a-z0-9]', '')),
-		list(game_features.opponent.str.lower().str.replace(r'[^a-z0-9]', ''))
-	]).T
-g_team_combos.sort()
-
-# Join all ID components together and save as game ID.
-game_features['game_id'] = np.core.defchararray.add(g_dates,
-			np.core.defchararray.add('-',
-				np.core.defchararray.add(g_team_combos[:,0],
-					np.core.defchararray.add('-',g_team_combos[:,1])
-				)
-			)
-		)
-
-# Sort on game ID. Ensures all games are paired and entire dataset sorted by year.
-game_features.sort('game_id', inplace=True)
-game_features.reset_index(drop=True, inplace=True)
-
-# Now generate random 0s and 1s to identify delineations. Every two observations will sum to 1 and be 1 or 0.
-game_group_1_indices = np.array([np.random.choice(2,replace=False,size=2) for _ in xrange(game_features.shape[0]/2)]).ravel()
-# Set in DF.
-game_features['game_group'] = game_group_1_indices
-
-### Cleanup
-
-print 'Cleaning up: dummy-izing locations and reordering columns.'
-
-# Integerize dummy variables.
-for c, dt in zip(game_features.columns,game_features.dtypes):
-	if dt == 'bool':
-		game_features[c] = game_features[c].astype(np.int)
-
-# Get location dummies.
-location_dummies = pd.get_dummies(game_features.location, prefix='location').astype(np.int)
-# Clean up.
-location_dummies.columns = [re.sub('[^a-zA-Z\\_]','',c) for c in location_dummies.columns]
-
-# Append location dummies to right.
-game_features = pd.concat((game_features, location_dummies), axis=1)
-
-# Reorder columns.
-# Store main column list.
-main_game_columns = [
-		'game_id','game_group','year','date','team','opponent',
-		'conference','conference_tournament','ncaa_tournament','other_tournament'
-	]
-outcome_columns = ['points_for','points_against','win']
-
-# Add Kenpom columns.
-kp_columns = [c for c in game_features.columns if c.startswith('team_') or c.startswith('opponent_') or c.startswith('diff_') or c.startswith('ratio_')]
-
-# Reorder columns.
-game_features = game_features[main_game_columns+list(location_dummies.columns)+kp_columns+outcome_columns]
-
-# Save.
-print 'Saving.'
-game_features.to_csv(games_output_path, index=False)
+		snapshot_lines = [json.dumps(snap, sort_keys=True) for snap in json.load(open(snapshots_path))]
+	snapshots = {}
+	for line in snapshot_lines:
+		snap = json.loads(line)
+		snapshots.setdefault(snap['year'], []).append((line, snap))
+
+	### Seasons
+
+	# Input hashes per season; rebuild seasons whose inputs changed.
+	manifest = json.load(open(manifest_path)) if os.path.exists(manifest_path) else {}
+	new_manifest = {}
+	seasons = sorted(set(kenpom) & set(snapshots))
+	rebuilt = 0
+	if not os.path.isdir(games_partition_path):
+		os.makedirs(games_partition_path)
+	for y in seasons:
+		season_file = 'games_%d.npz' % y
+		inputs = {'format': games_format, 'kenpom': kenpom_hashes[y], 'snapshots': text_hash(sorted(line for line, _snap in snapshots[y]))}
+		previous = manifest.get(str(y))
+		if previous is not None and previous['inputs'] == inputs and os.path.exists(games_partition_path+season_file):
+			new_manifest[str(y)] = previous
+			continue
+
+		print 'Building %d season.' % y
+		with instrumentation.timer('build_season', season=str(y)):
+			game_features = build_games([snap for _line, snap in snapshots[y]], kenpom[y], canonical)
+			save_season(games_partition_path+season_file, game_features)
+		instrumentation.count('games_built', len(game_features))
+		new_manifest[str(y)] = {'file': season_file, 'inputs': inputs, 'rows': len(game_features), 'columns': list(game_features.columns)}
+		rebuilt += 1
+
+	# Drop partitions of seasons that are no longer present.
+	for y in set(manifest) - set(new_manifest):
+		if os.path.exists(games_partition_path+manifest[y]['file']):
+			os.remove(games_partition_path+manifest[y]['file'])
+	with open(manifest_path+'.tmp', 'w') as f:
+		json.dump(new_manifest, f, indent=1, sort_keys=True)
+	os.rename(manifest_path+'.tmp', manifest_path)
+
+	# Combined CSV for the notebooks and R scripts.
+	if rebuilt > 0 or not os.path.exists(games_output_path):
+		print 'Saving.'
+		with instrumentation.timer('write_csv'):
+			games_dataset.load_games(seasons, path=games_partition_path).to_csv(games_output_path, index=False)
+
+	print 'Done: rebuilt %d of %d seasons.' % (rebuilt, len(seasons))
+
+	return 0
+
+if __name__ == '__main__':
+	sys.exit(main())
@@ -4,9 +4,16 @@
 
 from bs4 import BeautifulSoup as bs
 import datetime as dt
+import hashlib
 import json
+import multiprocessing
 import os
 import re
+import sys
+
+# Instrumentation from the model code; enabled by setting BAYESKET_METRICS to an output file (.prom for Prometheus text).
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'model'))
+import instrumentation
 
 ### Setup
 
@@ -14,124 +21,218 @@ import re
 snapshot_dir_path      = '../../../data/team_snapshots_raw/'
 snapshot_proc_dir_path = '../../../data/team_snapshots_processed/'
 
-# Processed file paths.
-output_path = '../../../data/team_snapshots.json'
-
-### Main Execution
-
-# Get years for which we have data.
-snapshot_years = [int(p) for p in os.listdir(snapshot_dir_path) if re.match(r'\d{4}',p)]
-
-# Container to store all snapshots.
-snapshots = []
-
-# Traverse all year directories.
-for y in snapshot_years:
-
-	# Get all team files.
-	raw_y_dir = snapshot_dir_path+str(y)+'/'
-	team_snaps = [p for p in os.listdir(raw_y_dir) if p[-5:] == '.html']
+# Processed file paths. One team-season record per line; the manifest holds content hashes of the parsed pages.
+output_path   = '../../../data/team_snapshots.jsonl'
+manifest_path = '../../../data/team_snapshots_manifest.json'
+
+# Use lxml for parsing if it is installed; it is several times faster than the standard library parser.
+try:
+	import lxml
+	html_parser = 'lxml'
+except ImportError:
+	html_parser = 'html.parser'
+
+### Parsing
+
+def parse_team_page(task):
+	"""
+	Parses one team's season page into a snapshot record.
+	Inputs:
+		task: Tuple of (path to team HTML file, year).
+	Returns:
+		Dictionary with team, year, conference, record and games.
+	"""
+	path, y = task
+
+	# Get data.
+	with open(path) as page:
+		t_data = bs(page.read(), html_parser)
+	# Get schedule table.
+	sched_table = t_data.findAll('table')[1]
+
+	# Clean team name.
+	team_name = os.path.basename(path)[:-5]
 
 	# Table format changed slightly in 2010. Store a constant to adjust.
 	rk_const = 0 if y <= 2010 else 1
 
-	# Traverse them.
-	for t in team_snaps:
-		# Get data.
-		t_data = bs(open(raw_y_dir+t))
-		# Get schedule table.
-		sched_table = t_data.findAll('table')[1]
-
-		# Clean team name.
-		team_name = t[:-5]
-
-		# Get record information.
-		rank_info = t_data.findAll('span', {'class':'rank'})[1].text
-		wins = int(rank_info[1:rank_info.index('-')])
-		losses = int(rank_info[rank_info.index('-')+1:-1])
-
-		# Get conference information.
-		conf = t_data.find('div', {'id':'title-container'}).find('span', {'class':'otherinfo'}).find('a').text
-
-		# Containers to store information.
-		t_info = {
-			'team': team_name,
-			'year': y,
-			'conference': conf,
-			'games': [],
-			'wins': wins,
-			'losses': losses,
-			'conference_wins': 0,
-			'conference_losses': 0,
-			'ncaa_tournament_wins': 0
-		}
-
-		# Set up some booleans to help us determine kinds of games.
-		conference = False
-		conference_tournament = False
-		ncaa_tournament = False
-		other_tournament = False
-		last_conf_record = ''
-
-		# These tables are all well-formed. Traverse the appropriate row range of each and store data.
-		sched_rows = sched_table.findAll('tr')[1:-1]
-		for sr in sched_rows:
-			# Look for class in row. If exists, this is a valid game.
-			if sr.has_attr('class'):
-				# Get information that requires pre-processing.
-				# Get score.
-				score_info = sr.findAll('td')[rk_const+3].text
-				score = score_info[score_info.find(', ')+2:]
-				# Win info.
-				win = score_info[0] == 'W'
-				# Find score accordingly.
-				points_greater = int(score[:score.find('-')])
-				points_lesser  = int(score[score.find('-')+1:])
-				points_for     = points_greater if win else points_lesser
-				points_against = points_lesser if win else points_greater
-				# Get date.
-				date_text = sr.find('td').text
-				date_text = date_text[date_text.index(' ')+1:]
-				if date_text.startswith('Nov') or date_text.startswith('Dec'):
-					date_text += ' '+str(y-1)
-				else:
-					date_text += ' '+str(y)
-				date_clean = dt.datetime.strptime(date_text,'%b %d %Y').date().strftime('%Y-%m-%d')
-				# Conference info.
-				conf_record = sr.findAll('td')[-1].text
-				conference = conf_record != last_conf_record and re.match(r'\d+-\d+',conf_record) is not None
-				last_conf_record = conf_record
-				# Append game info to games.
-				t_info['games'].append({
-					'date': date_clean,
-					'opponent': sr.findAll('td')[rk_const+2].text,
-					'location': sr.findAll('td')[rk_const+6].text,
-					'conference': conference or conference_tournament,
-					'conference_tournament': conference_tournament,
-					'ncaa_tournament': ncaa_tournament,
-					'other_tournament': other_tournament,
-					'win': win,
-					'points_for': points_for,
-					'points_against': points_against
-				})
-				# Update win counts.
-				t_info['conference_wins'] += (conference or conference_tournament) and win
-				t_info['conference_losses'] += (conference or conference_tournament) and not win
-				t_info['ncaa_tournament_wins'] += ncaa_tournament and win
+	# Get record information.
+	rank_info = t_data.findAll('span', {'class':'rank'})[1].text
+	wins = int(rank_info[1:rank_info.index('-')])
+	losses = int(rank_info[rank_info.index('-')+1:-1])
+
+	# Get conference information.
+	conf = t_data.find('div', {'id':'title-container'}).find('span', {'class':'otherinfo'}).find('a').text
+
+	# Containers to store information.
+	t_info = {
+		'team': team_name,
+		'year': y,
+		'conference': conf,
+		'games': [],
+		'wins': wins,
+		'losses': losses,
+		'conference_wins': 0,
+		'conference_losses': 0,
+		'ncaa_tournament_wins': 0
+	}
+
+	# Set up some booleans to help us determine kinds of games.
+	conference = False
+	conference_tournament = False
+	ncaa_tournament = False
+	other_tournament = False
+	last_conf_record = ''
+
+	# These tables are all well-formed. Traverse the appropriate row range of each and store data.
+	sched_rows = sched_table.findAll('tr')[1:-1]
+	for sr in sched_rows:
+		# Look for class in row. If exists, this is a valid game.
+		if sr.has_attr('class'):
+			# Get the row's cells once.
+			cells = sr.findAll('td')
+			# Get information that requires pre-processing.
+			# Get score.
+			score_info = cells[rk_const+3].text
+			score = score_info[score_info.find(', ')+2:]
+			# Win info.
+			win = score_info[0] == 'W'
+			# Find score accordingly.
+			points_greater = int(score[:score.find('-')])
+			points_lesser  = int(score[score.find('-')+1:])
+			points_for     = points_greater if win else points_lesser
+			points_against = points_lesser if win else points_greater
+			# Get date.
+			date_text = cells[0].text
+			date_text = date_text[date_text.index(' ')+1:]
+			if date_text.startswith('Nov') or date_text.startswith('Dec'):
+				date_text += ' '+str(y-1)
 			else:
-				# If not a game row we can at least get information about the row we've encountered.
-				# We can reason about what order certain things should come in.
-				if sr.text == 'NCAA Tournament':
-					conference_tournament = False
-					ncaa_tournament = True
-				elif sr.text == 'Postseason':
-					conference_tournament = False
-					other_tournament = True
-				elif sr.text.endswith('Conference Tournament'):
-					conference_tournament = True
-
-		# Whew, now we have season info. Append to year snaps.
-		snapshots.append(t_info)
-
-# Write out all snapshot data.
-json.dump(snapshots, open(output_path,'w'))
+				date_text += ' '+str(y)
+			date_clean = dt.datetime.strptime(date_text,'%b %d %Y').date().strftime('%Y-%m-%d')
+			# Conference info.
+			conf_record = cells[-1].text
+			conference = conf_record != last_conf_record and re.match(r'\d+-\d+',conf_record) is not None
+			last_conf_record = conf_record
+			# Append game info to games.
+			t_info['games'].append({
+				'date': date_clean,
+				'opponent': cells[rk_const+2].text,
+				'location': cells[rk_const+6].text,
+				'conference': conference or conference_tournament,
+				'conference_tournament': conference_tournament,
+				'ncaa_tournament': ncaa_tournament,
+				'other_tournament': other_tournament,
+				'win': win,
+				'points_for': points_for,
+				'points_against': points_against
+			})
+			# Update win counts.
+			t_info['conference_wins'] += (conference or conference_tournament) and win
+			t_info['conference_losses'] += (conference or conference_tournament) and not win
+			t_info['ncaa_tournament_wins'] += ncaa_tournament and win
+		else:
+			# If not a game row we can at least get information about the row we've encountered.
+			# We can reason about what order certain things should come in.
+			if sr.text == 'NCAA Tournament':
+				conference_tournament = False
+				ncaa_tournament = True
+			elif sr.text == 'Postseason':
+				conference_tournament = False
+				other_tournament = True
+			elif sr.text.endswith('Conference Tournament'):
+				conference_tournament = True
+
+	# Whew, now we have season info.
+	return t_info
+
+### Manifest
+
+def file_hash(path):
+	"""
+	SHA-1 hex digest of a file's contents.
+	"""
+	sha = hashlib.sha1()
+	with open(path, 'rb') as f:
+		for block in iter(lambda: f.read(2**20), b''):
+			sha.update(block)
+	return sha.hexdigest()
+
+def file_entry(path, previous=None):
+	"""
+	Manifest entry for a file: size, modification time and content hash. The hash is reused from the previous entry if size
+	and modification time are unchanged, so unchanged pages are not read at all.
+	"""
+	st = os.stat(path)
+	if previous is not None and previous['size'] == st.st_size and previous['mtime'] == st.st_mtime:
+		return previous
+	return {'size': st.st_size, 'mtime': st.st_mtime, 'sha1': file_hash(path)}
+
+### Main Execution
+
+def main(argv=None):
+	if argv is None:
+		argv = sys.argv
+
+	# Number of parsing processes. Run with "--full" to re-parse every page.
+	n_jobs = multiprocessing.cpu_count()
+	full = '--full' in argv
+
+	# Previous manifest and records, keyed by page (year/team.html).
+	manifest = {}
+	records = {}
+	if not full and os.path.exists(manifest_path) and os.path.exists(output_path):
+		manifest = json.load(open(manifest_path))
+		with open(output_path) as f:
+			for line in f:
+				r = json.loads(line)
+				records['%d/%s.html' % (r['year'],r['team'])] = r
+
+	# Get years for which we have data.
+	snapshot_years = [int(p) for p in os.listdir(snapshot_dir_path) if re.match(r'\d{4}',p)]
+
+	# Hash every team page; queue the new and changed ones.
+	new_manifest = {}
+	tasks = []
+	for y in sorted(snapshot_years):
+		raw_y_dir = snapshot_dir_path+str(y)+'/'
+		for t in sorted(os.listdir(raw_y_dir)):
+			if t[-5:] != '.html':
+				continue
+			key = str(y)+'/'+t
+			new_manifest[key] = file_entry(raw_y_dir+t, manifest.get(key))
+			if key not in records or manifest.get(key, {}).get('sha1') != new_manifest[key]['sha1']:
+				tasks.append((key, raw_y_dir+t, y))
+
+	print 'Parsing %d of %d team pages.' % (len(tasks), len(new_manifest))
+
+	# Parse in a process pool.
+	instrumentation.count('pages_total', len(new_manifest))
+	instrumentation.count('pages_parsed', len(tasks))
+	if len(tasks) > 0:
+		pool = multiprocessing.Pool(n_jobs)
+		try:
+			with instrumentation.timer('parse_pages'):
+				parsed = pool.map(parse_team_page, [(path, y) for _key, path, y in tasks], chunksize=8)
+		finally:
+			pool.close()
+			pool.join()
+		for (key, _path, _y), t_info in zip(tasks, parsed):
+			records[key] = t_info
+
+	# Write out snapshot data, dropping pages that no longer exist. Write to temporary files first so an interrupted run
+	# leaves the previous output and manifest in place.
+	with open(output_path+'.tmp', 'w') as f:
+		for key in sorted(new_manifest):
+			f.write(json.dumps(records[key])+'\n')
+	with open(manifest_path+'.tmp', 'w') as f:
+		json.dump(new_manifest, f, indent=1, sort_keys=True)
+	os.rename(output_path+'.tmp', output_path)
+	os.rename(manifest_path+'.tmp', manifest_path)
+
+	print 'Done.'
+
+	return 0
+
+if __name__ == '__main__':
+	sys.exit(main())
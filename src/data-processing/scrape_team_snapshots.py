@@ -2,14 +2,22 @@
 
 ### Libraries
 
+import argparse
 import csv
 import json
+import multiprocessing.pool
 import os
+import random
 import requests
 import sys
+import threading
 import time
 import urllib
 
+# Instrumentation from the model code; enabled by setting BAYESKET_METRICS to an output file (.prom for Prometheus text).
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'model'))
+import instrumentation
+
 ### Setup
 
 # Paths.
@@ -18,67 +26,256 @@ data_dir_path = '../../../data/'
 summary_dir_path = data_dir_path+'kenpom_summaries/'
 export_dir_path = data_dir_path+'team_snapshots_raw/'
 
-# Sleep time between fetches.
-request_sleep_time = 5
+# Fetch journal, in the export directory: status, validators and attempts for every team page, used to resume runs and make
+# conditional requests.
+journal_file = 'fetch_journal.json'
+
+# Request rate (requests per second, averaged) and burst size across all workers.
+request_rate = .2
+request_burst = 1
+
+# Retries for connection errors, 429 and 5xx responses, with exponential backoff starting at 'retry_backoff' seconds.
+max_retries = 5
+retry_backoff = 2.
 
 # KenPom.com URL settings.
 kp_domain = 'http://www.kenpom.com/'
-kp_url_login = kp_domain+'handlers/login_handler.php'
-kp_url_team  = kp_domain+'team.php?%s'
+kp_url_team = 'team.php?%s'
 
-# KenPom login settings.
-kp_credentials = json.load(open(config_dir_path+'kenpom.json'))
-kp_headers     = json.load(open(config_dir_path+'kenpom_headers.json'))
-
-### Main Execution
+### Configuration
 
-def main(argv=None):
-	if argv is None:
-		argv = sys.argv
+def load_headers():
+	"""
+	KenPom request headers from the config directory; none if the file is missing (e.g. against a local test server).
+	"""
+	headers_path = config_dir_path+'kenpom_headers.json'
+	if not os.path.exists(headers_path):
+		return {}
+	return json.load(open(headers_path))
 
-	# Get year and teams. Don't worry about advanced error handling here.
-	# If something doesn't work, we should be able to figure out why.
-	year = sys.argv[1]
+def year_teams(year, summary_dir=summary_dir_path):
+	"""
+	Team names in a season's KenPom summary, read from 'summary_dir'.
+	"""
 	teams = []
-	with open(summary_dir_path+'summary'+year[2:]+'.csv', 'rb') as summary_csv:
+	with open(os.path.join(summary_dir, 'summary'+year[2:]+'.csv'), 'rb') as summary_csv:
 		summary_reader = csv.reader(summary_csv, delimiter=',')
 		for row in summary_reader:
 			if row[0] != 'TeamName':
 				teams.append(row[0])
+	return teams
+
+### Rate Limiting
+
+class TokenBucket(object):
+	"""
+	Thread-safe token bucket: acquire() blocks until a token is available. Tokens accrue at 'rate' per second up to 'capacity',
+	so workers share one average request rate while allowing short bursts.
+	"""
+
+	def __init__(self, rate, capacity=1):
+		self.rate = float(rate)
+		self.capacity = float(capacity)
+		self.tokens = float(capacity)
+		self.updated = time.time()
+		self.lock = threading.Lock()
+
+	def acquire(self):
+		while True:
+			with self.lock:
+				now = time.time()
+				self.tokens = min(self.capacity, self.tokens + (now-self.updated)*self.rate)
+				self.updated = now
+				if self.tokens >= 1:
+					self.tokens -= 1
+					return
+				wait = (1-self.tokens) / self.rate
+			time.sleep(wait)
+
+### Journal
+
+class FetchJournal(object):
+	"""
+	Persistent record of fetches keyed by 'year/team'. Saved atomically every 'save_every' updates and on flush(), so an
+	interrupted run loses at most a few entries and can resume.
+	"""
+
+	def __init__(self, path, save_every=20):
+		self.path = path
+		self.entries = json.load(open(path)) if os.path.exists(path) else {}
+		self.lock = threading.Lock()
+		self.save_every = save_every
+		self.unsaved = 0
+
+	def get(self, key):
+		with self.lock:
+			return self.entries.get(key)
+
+	def update(self, key, entry):
+		with self.lock:
+			self.entries[key] = entry
+			self.unsaved += 1
+			if self.unsaved >= self.save_every:
+				self.save()
+
+	def flush(self):
+		with self.lock:
+			if self.unsaved > 0:
+				self.save()
+
+	def save(self):
+		# Callers hold the lock.
+		with open(self.path+'.tmp', 'w') as f:
+			json.dump(self.entries, f, indent=1, sort_keys=True)
+		os.rename(self.path+'.tmp', self.path)
+		self.unsaved = 0
+
+### Fetching
+
+class Scraper(object):
+	"""
+	Fetches team pages over one pooled HTTP session from a thread pool, sharing a token bucket. Failed requests are retried
+	with exponential backoff; pages already fetched are skipped or, when refreshing, re-requested conditionally with their
+	ETag/Last-Modified so unchanged pages cost a 304. Team lists are read from 'summary_dir'; pages and the fetch journal are
+	written under 'export_dir', so a test run against a local server can use scratch directories.
+	"""
+
+	def __init__(self, base_url=kp_domain, workers=4, rate=request_rate, burst=request_burst, headers=None, refresh=False,
+			summary_dir=summary_dir_path, export_dir=export_dir_path):
+		self.base_url = base_url if base_url.endswith('/') else base_url+'/'
+		self.workers = workers
+		self.refresh = refresh
+		self.summary_dir = summary_dir
+		self.export_dir = export_dir
+		self.bucket = TokenBucket(rate, burst)
+		self.session = requests.Session()
+		adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=workers)
+		self.session.mount('http://', adapter)
+		self.session.mount('https://', adapter)
+		if headers is not None:
+			self.session.headers.update(headers)
+		if not os.path.isdir(export_dir):
+			os.makedirs(export_dir)
+		self.journal = FetchJournal(os.path.join(export_dir, journal_file))
+
+	def request(self, url, headers):
+		"""
+		GET with retries. Returns the response, or None if every attempt failed to connect.
+		"""
+		response = None
+		for attempt in range(max_retries+1):
+			self.bucket.acquire()
+			try:
+				with instrumentation.timer('http_request'):
+					response = self.session.get(url, headers=headers, timeout=60)
+				instrumentation.count('http_responses', status=str(response.status_code))
+				if response.status_code != 429 and response.status_code < 500:
+					return response
+				retry_after = response.headers.get('Retry-After')
+			except requests.exceptions.RequestException:
+				instrumentation.count('http_errors')
+				retry_after = None
+			if attempt < max_retries:
+				delay = float(retry_after) if retry_after is not None and retry_after.isdigit() else retry_backoff*2**attempt
+				time.sleep(delay*(1+random.random()*.25))
+		return response
+
+	def fetch(self, task):
+		"""
+		Fetches one team page. Returns (key, status); status is None if no response was received.
+		"""
+		year, team, exists = task
+		key = year+'/'+team
+		previous = self.journal.get(key) or {}
+
+		# Conditional request if we have the page and its validators.
+		headers = {}
+		if exists:
+			if 'etag' in previous:
+				headers['If-None-Match'] = previous['etag']
+			if 'last_modified' in previous:
+				headers['If-Modified-Since'] = previous['last_modified']
+
+		team_url = self.base_url + kp_url_team % urllib.urlencode({'team':team,'y':year})
+		response = self.request(team_url, headers)
+		entry = dict(previous, attempted=time.time(), status=None if response is None else response.status_code)
+
+		if response is not None and response.status_code == 200:
+			# Write out.
+			team_path = os.path.join(self.export_dir, year, team+'.html')
+			with open(team_path+'.tmp', 'wb') as team_file:
+				team_file.write(response.content)
+			os.rename(team_path+'.tmp', team_path)
+			entry['fetched'] = entry['attempted']
+			for header, field in (('ETag','etag'), ('Last-Modified','last_modified')):
+				if header in response.headers:
+					entry[field] = response.headers[header]
+		self.journal.update(key, entry)
+		return key, entry['status']
+
+	def run(self, years):
+		"""
+		Scrapes every team of every year in 'years'. Returns the number of pages fetched, unchanged and failed.
+		"""
+		tasks = []
+		for year in years:
+			year_dir = os.path.join(self.export_dir, year)
+			if not os.path.isdir(year_dir):
+				os.makedirs(year_dir)
+			# List the export directory once per year.
+			existing = set(os.listdir(year_dir))
+			for team in year_teams(year, self.summary_dir):
+				exists = team+'.html' in existing
+				if exists and not self.refresh:
+					continue
+				tasks.append((year, team, exists))
+
+		print 'Fetching %d team pages with %d workers.' % (len(tasks), self.workers)
+
+		counts = {'fetched':0, 'unchanged':0, 'failed':0}
+		pool = multiprocessing.pool.ThreadPool(self.workers)
+		try:
+			for t_i, (key, status) in enumerate(pool.imap_unordered(self.fetch, tasks)):
+				if status == 200:
+					counts['fetched'] += 1
+				elif status == 304:
+					counts['unchanged'] += 1
+				else:
+					counts['failed'] += 1
+					print 'Failed to fetch %s (status %s).' % (key, status)
+				# Status update.
+				if t_i % 20 == 0:
+					print 'Processed %d of %d pages.' % (t_i+1, len(tasks))
+		finally:
+			pool.close()
+			pool.join()
+			self.journal.flush()
+		return counts
+
+### Main Execution
+
+def main(argv=None):
+	if argv is None:
+		argv = sys.argv
+
+	parser = argparse.ArgumentParser(description='Fetch KenPom team pages for one or more seasons.')
+	parser.add_argument('years', nargs='+', help='Seasons to fetch, e.g. 2014 2015.')
+	parser.add_argument('--workers', type=int, default=4, help='Concurrent requests.')
+	parser.add_argument('--rate', type=float, default=request_rate, help='Average requests per second across workers.')
+	parser.add_argument('--burst', type=int, default=request_burst, help='Requests allowed back to back.')
+	parser.add_argument('--base-url', default=kp_domain, help='Site to fetch from, e.g. a local test server.')
+	parser.add_argument('--refresh', action='store_true', help='Re-request pages already fetched (conditionally).')
+	parser.add_argument('--summary-dir', default=summary_dir_path, help='Directory of KenPom summaries listing each season\'s teams.')
+	parser.add_argument('--export-dir', default=export_dir_path, help='Directory for fetched pages and the fetch journal.')
+	args = parser.parse_args(argv[1:])
+
+	scraper = Scraper(args.base_url, args.workers, args.rate, args.burst, load_headers(), args.refresh, args.summary_dir, args.export_dir)
+	counts = scraper.run(args.years)
+
+	print 'Done: %(fetched)d fetched, %(unchanged)d unchanged, %(failed)d failed.' % counts
 
-	# Great, now we have teams. Traverse the whole list and download individual pages. Make sure to put several seconds in between.
-	for t_i, team in enumerate(teams):
-		# Filename.
-		team_file = team+'.html'
-		# Ensure the team data has not been fetched.
-		if team_file in os.listdir(export_dir_path+year+'/'):
-			continue
-		
-		# Fetch from KenPom.
-		team_url = kp_url_team % urllib.urlencode({'team':team,'y':year})
-		team_request = requests.get(team_url, headers=kp_headers)
-
-		# Check status.
-		if team_request.status_code != 200:
-			print 'Last request returned status code %d.' % team_request.status_code
-			print 'Response:'
-			print team_request.text
-			return 1
-
-		# Write out.
-		with open(export_dir_path+year+'/'+team_file,'w') as team_file:
-			team_file.write(team_request.text)
-
-		# Status update.
-		if t_i % 20 == 0:
-			print 'Just fetched %s (team %d).' % (team, t_i)
-		# Sleep before next one.
-		time.sleep(request_sleep_time)
-
-	print 'Done.'
-
-	# All done. Exit normally.
-	return 0
+	# Nonzero exit if anything failed; rerunning resumes from the journal.
+	return 1 if counts['failed'] > 0 else 0
 
 if __name__ == '__main__':
-	sys.exit(main())
\ No newline at end of file
+	sys.exit(main())
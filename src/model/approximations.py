@@ -0,0 +1,121 @@
+### Setup
+
+# Libraries.
+import numpy as np
+
+# Custom library
+import samplers
+
+### Main Functionality
+
+class GaussianApproximation (object):
+    """
+    Multivariate normal approximation to the posterior over the intercept and coefficients.
+    sample() gives a coefficient array in the layout of bayes_lr.feature_coefficients, so it can be passed as 'coefs'/'coef_trace'
+    to game_predictions.predict_games and game_predictions.simulate_tournament.
+    """
+
+    def __init__ (self, mean, cov, symmetric=False):
+        """
+        Inputs:
+            mean:      Numpy array of means, intercept first.
+            cov:       Numpy array covariance matrix.
+            symmetric: Whether this approximates the symmetric matchup model (see bayes_lr.model_games). Its intercept and the
+                       coefficients of features that share their mirror image's coefficient are fixed at zero, with zero
+                       variance.
+        """
+        self.mean = np.asarray(mean, dtype=np.float64)
+        self.cov  = np.asarray(cov, dtype=np.float64)
+        self.symmetric = symmetric
+
+    def free_columns (self):
+        """
+        Positions of the coefficients that are not fixed: all of them, or in the symmetric model those with nonzero variance.
+        """
+        if not self.symmetric:
+            return np.arange(len(self.mean))
+        return np.nonzero(np.diag(self.cov) > 0)[0]
+
+    def sample (self, draws, seed=None):
+        """
+        Numpy array of 'draws' coefficient samples; rows are draws, columns are coefficients starting with the intercept.
+        """
+        rng = np.random.RandomState(seed)
+        free = self.free_columns()
+        samples = np.tile(self.mean, (draws,1))
+        samples[:,free] += rng.standard_normal((draws,len(free))).dot(np.linalg.cholesky(self.cov[np.ix_(free,free)]).T)
+        return samples
+
+    def sd (self):
+        return np.sqrt(np.diag(self.cov))
+
+def full_layout (free, dims, mean, cov):
+    """
+    Mean and covariance over the free coefficients padded back to all 'dims' coefficients (e.g. the symmetric model's full layout), with zeros for the fixed ones.
+    """
+    full_mean = np.zeros(dims)
+    full_cov = np.zeros((dims,dims))
+    full_mean[free] = mean
+    full_cov[np.ix_(free,free)] = cov
+    return full_mean, full_cov
+
+def laplace (posterior):
+    """
+    Laplace approximation: a normal centered at the posterior mode with the inverse negative Hessian as covariance.
+    Inputs:
+        posterior: samplers.LogisticPosterior.
+    Returns:
+        GaussianApproximation object.
+    """
+    mode, cov = samplers.posterior_mode(posterior)
+    return GaussianApproximation(mode, cov)
+
+def advi (posterior, full_rank=False, iterations=300, samples=5, learning_rate=.05, seed=None):
+    """
+    Automatic differentiation variational inference: fits a normal approximation by stochastic gradient ascent on the ELBO,
+    using reparameterized draws and Adam steps. The problem is first whitened with the Laplace approximation, which fixes
+    the scale of each coefficient; the last quarter of the iterates is averaged.
+    Inputs:
+        posterior:     samplers.LogisticPosterior.
+        full_rank:     Fit a full covariance matrix; else a diagonal one (mean-field).
+        iterations:    Number of gradient steps.
+        samples:       Monte Carlo draws per gradient estimate.
+        learning_rate: Adam step size (in whitened units).
+        seed:          Seed for the Monte Carlo draws.
+    Returns:
+        GaussianApproximation object.
+    """
+    rng = np.random.RandomState(seed)
+    mode, cov = samplers.posterior_mode(posterior)
+    dims = len(mode)
+    # Whitening transform: full Cholesky factor for full rank, scales only for mean-field (which must stay diagonal).
+    C = np.linalg.cholesky(cov) if full_rank else np.diag(np.sqrt(np.diag(cov)))
+
+    # Variational parameters in whitened space: mean, log scales and (full rank) lower triangle.
+    params = [np.zeros(dims), np.zeros(dims), np.zeros((dims,dims))]
+    moments = [[np.zeros_like(p), np.zeros_like(p)] for p in params]
+    averages = [np.zeros_like(p) for p in params]
+    averaged = 0
+
+    for t in range(1, iterations+1):
+        mu, omega, lower = params
+        L = np.diag(np.exp(omega)) + (np.tril(lower, -1) if full_rank else 0)
+        eps = rng.standard_normal((samples,dims))
+        # Gradients of the log posterior at the draws, in whitened coordinates.
+        G = posterior.grad_batch(mode + (mu + eps.dot(L.T)).dot(C.T)).dot(C)
+        GE = G.T.dot(eps)/samples
+        grads = [G.mean(axis=0), np.diag(GE)*np.exp(omega) + 1, np.tril(GE, -1) if full_rank else np.zeros((dims,dims))]
+        # Adam ascent.
+        for p, g, m in zip(params, grads, moments):
+            m[0] = .9*m[0] + .1*g
+            m[1] = .999*m[1] + .001*g**2
+            p += learning_rate * (m[0]/(1-.9**t)) / (np.sqrt(m[1]/(1-.999**t)) + 1e-8)
+        # Average the tail of the iterates.
+        if t > .75*iterations:
+            averaged += 1
+            for a, p in zip(averages, params):
+                a += (p-a)/averaged
+
+    mu, omega, lower = averages
+    L = C.dot(np.diag(np.exp(omega)) + (np.tril(lower, -1) if full_rank else 0))
+    return GaussianApproximation(mode + C.dot(mu), L.dot(L.T))
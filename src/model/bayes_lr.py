@@ -1,13 +1,26 @@
 ### Setup
 
 # Libraries.
+import multiprocessing
 import numpy as np
-import pymc
-from sklearn.cross_validation import KFold
-import matplotlib, matplotlib.pyplot as plt
+import time
 
 # Custom library
+import approximations
+import diagnostics
 import game_predictions
+import games_dataset
+import instrumentation
+import online
+import samplers
+import trace_store
+
+# PyMC, scikit-learn and matplotlib are imported on first use (see load_pymc, mcmc_xval and plot_Geweke), so the numpy
+# backend, scoring and simulation load without them.
+pymc = None
+
+# PyMC classes that may be given by name.
+pymc_names = {'Normal':'normal', 'Metropolis':'metropolis', 'Slicer':'slice'}
 
 ### Main Functionality
 
@@ -18,48 +31,98 @@ def model_games (
     coef_dist_params=None,
     b0_params={'mu':0, 'tau':0.0003, 'value':0},
     err_params=[.5],
-    default_coef_dist = pymc.Normal,
+    default_coef_dist = 'normal',
     default_coef_params = {'mu':0, 'tau':0.0003, 'value':0},
-    step_method = pymc.Metropolis,
+    step_method = 'metropolis',
     step_method_params = None,
-    default_step_method_params = {'proposal_sd':1., 'proposal_distribution':'Normal'}
+    default_step_method_params = {'proposal_sd':1., 'proposal_distribution':'Normal'},
+    backend = 'pymc',
+    seed = None,
+    init = None,
+    symmetric = False
 ):
     """
     Inputs:
         data: Pandas dataframe of game information.
         features: String list of features from game data.
-        coef_dists: Distribution for coefficients. Default: see default_coef_dist; usually Normal.
+        coef_dists: Distribution for coefficients. Default: see default_coef_dist; usually Normal. PyMC distribution classes;
+                    'normal' stands for pymc.Normal.
         coef_dist_params: List of dictionaries that parameterize coeficient distributions.
         b0_params: Parameters for intercept ("b0"). Default: mean=0, precision=0.0003; initial value=0.
         err_params: Parameters list for Bernoulli-distribued error distribution. Default: p=0.5.
-        default_coef_dist: Coefficient distributions.
+        default_coef_dist: Coefficient distributions. Default: 'normal' (pymc.Normal).
         default_coef_params: Default coefficient distribution parameters.
-        step_method: MCMC stepping method.
+        step_method: MCMC stepping method: a PyMC step method class, or 'metropolis' (default; pymc.Metropolis) or 'slice' (pymc.Slicer).
         step_method_params: Parameters for stepping method for each coefficient. Default: see default_step_method_params.
         default_step_method_params: Default step method parameters for coefficient draws.
+        backend: 'pymc' for a PyMC model; 'numpy' for the vectorized samplers in samplers.py, which update all coefficients at once.
+                 The numpy backend takes step_method pymc.Metropolis/'metropolis' (adaptive blocked Metropolis), pymc.Slicer/'slice',
+                 'hmc' or 'nuts' (gradient-based; step size and mass matrix adapt during burn-in, towards the 'target_accept' entry of
+                 default_step_method_params, default 0.8), or 'sgld'/'sghmc' (stochastic gradient Langevin dynamics or Hamiltonian
+                 Monte Carlo on minibatches of games, with control variates around the posterior mode; default_step_method_params
+                 entries 'batch_size' (default 1000), 'step_size' (default 0.1) and, for sghmc, 'friction' (default 0.1)), and
+                 supports normal coefficient distributions only. Stochastic gradient steps cost the same however many games
+                 there are, past the full-data passes that find the mode, but have no accept/reject step: smaller step sizes trade
+                 mixing for less bias.
+        seed: Seed for the numpy backend's random stream.
+        init: Initial values for the intercept and coefficients, in that order. Overrides the 'value' parameters.
+        symmetric: Fit the symmetric matchup model. Games listed from both sides are reduced to one row per game (see
+                   games_dataset.canonical_games), each feature enters through its antisymmetric part and there is no
+                   intercept (see game_predictions.design_matrix), so a game's likelihood is the same from either side and is
+                   counted once. Shared game properties (e.g. location_Neutral) are rejected, and a feature and its mirror image
+                   (e.g. location_Home and location_Away) share one coefficient, sampled for the first listed; the other's trace
+                   and the intercept trace are zero (see feature_coefficients). Per-feature arguments and 'init' still cover
+                   every feature. Score with predict_games/score_games(symmetric=True).
     Returns:
         PyMC MCMC object. Call with .sample() and desired parameters to perform actual sampling.
+        The numpy backend returns a samplers.NumpyMCMC object with the same sample() and trace() interface.
     """
+
+    # Symmetric matchup model: one row per game, and one coefficient per antisymmetric column.
+    if symmetric:
+        if 'game_id' in data:
+            data = games_dataset.canonical_games(data)
+        keep, features, coef_dists, coef_dist_params, step_method_params = symmetric_features(features, coef_dists, coef_dist_params, step_method_params)
+        if init is not None:
+            init = [init[0]]+[init[i+1] for i in keep]
+
+    # Initial values are carried by the distribution parameters.
+    if init is not None:
+        b0_params = dict(b0_params, value=init[0])
+        coef_dist_params = [
+            dict(default_coef_params if coef_dist_params is None or coef_dist_params[i] is None else coef_dist_params[i], value=init[i+1])
+            for i in range(len(features))
+        ]
+
+    if backend == 'numpy':
+        return numpy_model_games(data, features, coef_dists, coef_dist_params, b0_params, default_coef_dist, default_coef_params,
+                                 step_method, step_method_params, default_step_method_params, seed, symmetric)
+    elif backend != 'pymc':
+        raise ValueError('Unknown backend: %s' % backend)
+    load_pymc()
+    default_coef_dist = pymc_class(default_coef_dist)
+    step_method = pymc_class(step_method)
     
-    # Define priors on intercept and error. PyMC uses precision (inverse variance).
-    b0 = pymc.Normal('b_0', **b0_params)
+    # Define priors on intercept and error. PyMC uses precision (inverse variance). The symmetric model has no intercept.
+    b0 = 0. if symmetric else pymc.Normal('b_0', **b0_params)
     err = pymc.Bernoulli('err', *err_params)
     
     # Containers for coefficients and data.
     b = np.empty(len(features), dtype=object)
     x = np.empty(len(features), dtype=object)
+    x_values = game_predictions.design_matrix(data, features, symmetric=symmetric)[:,1:]
     
     # Traverse features.
     for i, f in enumerate(features):
         # Coefficient.
         # First start with the distribution. Use one if we've been given one; else use default.
-        coef_dist_type = default_coef_dist if coef_dists is None or coef_dists[i] is None else coef_dists[i]
+        coef_dist_type = default_coef_dist if coef_dists is None or coef_dists[i] is None else pymc_class(coef_dists[i])
         # Now handle parameters.
         this_coef_dist_params = default_coef_params if coef_dist_params is None or coef_dist_params[i] is None else coef_dist_params[i]
         # Now actually create the coefficient distribution
         b[i] = coef_dist_type('b_'+f, **this_coef_dist_params)
         # Data distribution.
-        x[i] = pymc.Normal('x_'+f, 0, 1, value=np.array(data[f]), observed=True)
+        x[i] = pymc.Normal('x_'+f, 0, 1, value=x_values[:,i], observed=True)
     
     # Logistic function.
     @pymc.deterministic
@@ -74,9 +137,10 @@ def model_games (
     # Define model, MCMC object.
     model = pymc.Model([logistic, pymc.Container(b), err, pymc.Container(x), y])
     mcmc  = pymc.MCMC(model)
+    mcmc.symmetric = symmetric
     
     # Configure step methods.
-    for var in list(b)+[b0,err]:
+    for var in list(b)+([] if symmetric else [b0])+[err]:
         coef_step_method_params = default_step_method_params if step_method_params is None or step_method_params[i] is None else step_method_params[i]
         if step_method == pymc.Slicer:
             mcmc.use_step_method(step_method, stochastic=var)
@@ -86,25 +150,428 @@ def model_games (
     # Return MCMC object.
     return mcmc
 
+def numpy_model_games (data, features, coef_dists, coef_dist_params, b0_params, default_coef_dist, default_coef_params,
+                       step_method, step_method_params, default_step_method_params, seed, symmetric=False):
+    """
+    Builds the model_games model on the numpy backend. Arguments are as in model_games.
+    Returns:
+        samplers.NumpyMCMC object.
+    """
+
+    # Posterior.
+    posterior, init = logistic_posterior(data, features, coef_dists, coef_dist_params, b0_params, default_coef_dist, default_coef_params, symmetric)
+
+    # Proposal scales: intercept first (unless symmetric), then coefficients.
+    proposal_sd = [] if symmetric else [default_step_method_params.get('proposal_sd', 1.)]
+    for i, f in enumerate(features):
+        coef_step_method_params = default_step_method_params if step_method_params is None or step_method_params[i] is None else step_method_params[i]
+        proposal_sd.append(coef_step_method_params.get('proposal_sd', 1.))
+
+    # Step method.
+    rng = np.random.RandomState(seed)
+    step_method = component_name(step_method)
+    if step_method == 'metropolis':
+        step = samplers.MetropolisStep(posterior, proposal_sd, rng)
+    elif step_method == 'slice':
+        step = samplers.SliceStep(posterior, proposal_sd, rng)
+    elif step_method == 'hmc':
+        step = samplers.HMCStep(posterior, rng, target_accept=default_step_method_params.get('target_accept', .8))
+    elif step_method == 'nuts':
+        step = samplers.NUTSStep(posterior, rng, target_accept=default_step_method_params.get('target_accept', .8))
+    elif step_method in ('sgld', 'sghmc'):
+        sg_keys = ['batch_size','step_size'] + (['friction'] if step_method == 'sghmc' else [])
+        sg_params = dict((k, default_step_method_params[k]) for k in sg_keys if k in default_step_method_params)
+        step = (samplers.SGLDStep if step_method == 'sgld' else samplers.SGHMCStep)(posterior, rng, **sg_params)
+    else:
+        raise ValueError('Unsupported step method for the numpy backend: %s' % step_method)
+
+    model = samplers.NumpyMCMC(posterior, ([] if symmetric else ['b_0'])+['b_'+f for f in features], step, init)
+    model.symmetric = symmetric
+    return model
+
+def logistic_posterior (
+    data,
+    features,
+    coef_dists=None,
+    coef_dist_params=None,
+    b0_params={'mu':0, 'tau':0.0003, 'value':0},
+    default_coef_dist = 'normal',
+    default_coef_params = {'mu':0, 'tau':0.0003, 'value':0},
+    symmetric = False
+):
+    """
+    The model_games posterior as a samplers.LogisticPosterior. Prior arguments are as in model_games; only normal priors are supported.
+    With symmetric=True, the symmetric matchup model's posterior, over the feature coefficients only.
+    Returns:
+        samplers.LogisticPosterior object.
+        Initial values from the 'value' parameters, intercept first (unless symmetric).
+    """
+    prior_params = [b0_params]
+    for i, f in enumerate(features):
+        coef_dist_type = default_coef_dist if coef_dists is None or coef_dists[i] is None else coef_dists[i]
+        if component_name(coef_dist_type) != 'normal':
+            raise ValueError('Only normal coefficient distributions are supported.')
+        prior_params.append(default_coef_params if coef_dist_params is None or coef_dist_params[i] is None else coef_dist_params[i])
+    X = game_predictions.design_matrix(data, features, symmetric=symmetric)
+    if symmetric:
+        # The intercept column is zero; leave it out.
+        X, prior_params = X[:,1:], prior_params[1:]
+    posterior = samplers.LogisticPosterior(
+        X,
+        np.array(data.win),
+        [p.get('mu', 0) for p in prior_params],
+        [p.get('tau', 1) for p in prior_params]
+    )
+    return posterior, [p.get('value', 0) for p in prior_params]
+
+def symmetric_features (features, *feature_args):
+    """
+    Features with a coefficient in the symmetric matchup model (see games_dataset.antisymmetric_features), and per-feature
+    argument lists (e.g. coef_dist_params) cut down to them. None arguments stay None.
+    Returns:
+        List of positions of the kept features in 'features'.
+        List of kept features, followed by each cut-down argument.
+    """
+    keep = games_dataset.antisymmetric_features(features)
+    return [keep, [features[i] for i in keep]] + [None if a is None else [a[i] for i in keep] for a in feature_args]
+
+def posterior_mode (data, features, symmetric=False, **prior_args):
+    """
+    Posterior mode (MAP) of the model_games model and the covariance of the Laplace approximation around it.
+    Inputs:
+        data, features, symmetric: As in model_games.
+        prior_args:     Prior arguments of model_games (coef_dists, coef_dist_params, b0_params, default_coef_dist, default_coef_params).
+    Returns:
+        Numpy array of mode coefficients, intercept first. In the symmetric model the intercept and the coefficients of
+        features that share their mirror image's coefficient (see model_games) are zero, with zero variance.
+        Numpy array covariance matrix.
+    """
+    if not symmetric:
+        posterior, _init = logistic_posterior(data, features, **prior_args)
+        return samplers.posterior_mode(posterior)
+    columns, posterior = symmetric_posterior(data, features, **prior_args)
+    fit_mode, fit_cov = samplers.posterior_mode(posterior)
+    return approximations.full_layout(columns, len(features)+1, fit_mode, fit_cov)
+
+def symmetric_posterior (data, features, **prior_args):
+    """
+    The symmetric matchup model's posterior (see logistic_posterior), on one row per game if the data has game ids.
+    Returns:
+        List of the columns of the full coefficient layout (intercept first) that the posterior covers.
+        samplers.LogisticPosterior object.
+    """
+    if 'game_id' in data:
+        data = games_dataset.canonical_games(data)
+    keep, fit_features, coef_dists, coef_dist_params = symmetric_features(features, prior_args.get('coef_dists'), prior_args.get('coef_dist_params'))
+    prior_args = dict(prior_args, coef_dists=coef_dists, coef_dist_params=coef_dist_params)
+    posterior, _init = logistic_posterior(data, fit_features, symmetric=True, **prior_args)
+    return [i+1 for i in keep], posterior
+
+def approximate_posterior (data, features, method='laplace', seed=None, symmetric=False, **prior_args):
+    """
+    Fast alternative to MCMC: a normal approximation to the model_games posterior.
+    Inputs:
+        data, features, symmetric: As in model_games.
+        method:         'laplace' (normal at the Newton-IRLS posterior mode), 'advi' (mean-field ADVI) or 'fullrank_advi'.
+        seed:           Seed for ADVI's Monte Carlo gradients.
+        prior_args:     Prior arguments of model_games (coef_dists, coef_dist_params, b0_params, default_coef_dist, default_coef_params).
+    Returns:
+        approximations.GaussianApproximation object. Its sample(draws) is a coefficient array that predict_games and
+        simulate_tournament take as 'coefs'/'coef_trace'. In the symmetric model the intercept and the coefficients of
+        features that share their mirror image's coefficient are zero, with zero variance, as in posterior_mode.
+    """
+    if symmetric:
+        columns, posterior = symmetric_posterior(data, features, **prior_args)
+    else:
+        posterior, _init = logistic_posterior(data, features, **prior_args)
+    if method == 'laplace':
+        approximation = approximations.laplace(posterior)
+    elif method in ('advi', 'fullrank_advi'):
+        approximation = approximations.advi(posterior, full_rank=method=='fullrank_advi', seed=seed)
+    else:
+        raise ValueError('Unknown approximation method: %s' % method)
+    if not symmetric:
+        return approximation
+    mean, cov = approximations.full_layout(columns, len(features)+1, approximation.mean, approximation.cov)
+    return approximations.GaussianApproximation(mean, cov, symmetric=True)
+
+def update_posterior (previous, data, features, method='adf', seed=None, symmetric=False, **update_args):
+    """
+    Incremental update: folds newly played games into a previous posterior without refitting on all games.
+    Inputs:
+        previous:    Previous posterior: an approximations.GaussianApproximation, an online.ParticlePosterior, a
+                     diagnostics.ChainTraces, or a coefficient array (see feature_coefficients).
+        data:        Pandas dataframe of the new games only.
+        features:    String list of features; must match the previous posterior.
+        symmetric:   Whether the previous posterior is of the symmetric matchup model (see model_games); must match its
+                     'symmetric' attribute where it has one. New games are then reduced to one row per game, and the
+                     coefficients fixed at zero stay fixed.
+        method:      'adf' (assumed-density filtering; returns a GaussianApproximation) or 'smc' (sequential Monte Carlo
+                     reweighting with resampling and rejuvenation; returns a ParticlePosterior).
+        seed:        Seed for the 'smc' moves.
+        update_args: Further arguments to online.smc_update (ess_threshold, rejuvenate_steps).
+    Returns:
+        Updated posterior, which can be passed back in as 'previous' when more games arrive. Its sample(draws) is a
+        coefficient array that predict_games and simulate_tournament take as 'coefs'/'coef_trace'.
+    """
+    if getattr(previous, 'symmetric', symmetric) != symmetric:
+        raise ValueError('Previous posterior has symmetric=%s; update with the same setting.' % previous.symmetric)
+    if isinstance(previous, diagnostics.ChainTraces):
+        previous = previous.samples.reshape((-1,previous.samples.shape[2]))
+    if isinstance(previous, np.ndarray):
+        previous = online.ParticlePosterior(previous, symmetric=symmetric)
+    if symmetric and 'game_id' in data:
+        data = games_dataset.canonical_games(data)
+    X = game_predictions.design_matrix(data, features, symmetric=symmetric)
+    y = np.array(data.win)
+    if method == 'adf':
+        return online.assumed_density_update(previous, X, y)
+    elif method == 'smc':
+        if isinstance(previous, approximations.GaussianApproximation):
+            previous = online.ParticlePosterior(previous.sample(update_args.pop('draws', 4000), seed), symmetric=symmetric)
+        return online.smc_update(previous, X, y, seed=seed, **update_args)
+    raise ValueError('Unknown update method: %s' % method)
+
+def sample_chains (data, features, n_chains=4, iter=10000, burn=2000, thin=1, seed=None, n_jobs=None, **model_args):
+    """
+    Runs independently seeded chains of model_games in a process pool and stacks their traces.
+    Inputs:
+        data:       Pandas dataframe of game information.
+        features:   String list of features from game data.
+        n_chains:   Number of chains.
+        iter, burn, thin: Arguments to each chain's sample().
+        seed:       Seed from which the chains' seeds are derived. Results are reproducible for a given seed.
+        n_jobs:     Number of worker processes. Default: one per chain. 1 runs chains in this process.
+        model_args: Further arguments to model_games (e.g. backend='numpy', step_method='nuts'), and optionally
+                    'until_converged' (see sample_chain).
+    Returns:
+        diagnostics.ChainTraces object. Its trace() pools chains, so it can stand in for the MCMC object in feature_coefficients,
+        predict_games and simulate_tournament; rhat(), ess_bulk(), ess_tail() and summary() give convergence diagnostics.
+        Like the MCMC object, it records whether the symmetric model was sampled.
+    """
+    tasks = [(data, features, iter, burn, thin, s, model_args) for s in chain_seeds(seed, n_chains)]
+    n_jobs = n_chains if n_jobs is None else n_jobs
+    if n_jobs > 1:
+        pool = multiprocessing.Pool(n_jobs)
+        try:
+            chains = pool.map(sample_chain, tasks)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        chains = [sample_chain(t) for t in tasks]
+    # Chains sampled until converged may differ in length; keep the last draws of each, as many as the shortest has.
+    length = min(len(c) for c in chains)
+    chains = [c[len(c)-length:] for c in chains]
+    return diagnostics.ChainTraces(np.array(chains), ['b_0']+['b_'+f for f in features], model_args.get('symmetric', False))
+
+def sample_chain (task):
+    """
+    Worker for sample_chains: builds and samples one chain, returning its coefficient array (see feature_coefficients).
+    If model_args has an 'until_converged' entry (True, or a dictionary of arguments to sample_until_converged), the chain
+    is sampled until converged, with 'iter' as its budget.
+    """
+    return run_chain(task)[0]
+
+def run_chain (task):
+    """
+    As sample_chain, also returning the convergence report of sample_until_converged (None for a fixed number of iterations).
+    """
+    data, features, iter, burn, thin, seed, model_args = task
+    model_args = dict(model_args)
+    until_converged = model_args.pop('until_converged', None)
+    if model_args.get('backend', 'pymc') == 'numpy':
+        model_mcmc = model_games(data, features, seed=seed, **model_args)
+    else:
+        # PyMC draws from the global random state.
+        np.random.seed(seed)
+        model_mcmc = model_games(data, features, **model_args)
+    with instrumentation.timer('sample_chain', backend=model_args.get('backend', 'pymc')):
+        if until_converged:
+            converge_args = dict(until_converged) if isinstance(until_converged, dict) else {}
+            coefs, report = sample_until_converged(model_mcmc, features, burn=burn, max_iter=iter, thin=thin, **converge_args)
+        else:
+            model_mcmc.sample(iter, burn, thin)
+            coefs, report = feature_coefficients(model_mcmc, features), None
+    record_acceptance(model_mcmc)
+    return coefs, report
+
+def sample_until_converged (model_mcmc, features, burn=2000, batch=1000, max_iter=50000, thin=1, min_ess=400, max_geweke=2.,
+                            min_acceptance=.1):
+    """
+    Samples a model in batches, checking convergence after each, until every coefficient's bulk effective sample size is at
+    least 'min_ess', its Geweke z-score is within +/-'max_geweke' and the acceptance rate is at least 'min_acceptance', or
+    until 'max_iter' iterations (burn-in included) have run. Easy models stop early; hard ones are flagged rather than
+    silently under-sampled.
+    Inputs:
+        model_mcmc: Unsampled model from model_games (either backend).
+        features:   List of features.
+        burn:       Burn-in iterations, run before the first batch.
+        batch:      Iterations between convergence checks.
+        max_iter:   Iteration budget.
+        thin:       Thinning of the kept draws.
+        min_ess, max_geweke, min_acceptance: Convergence targets. Acceptance is that of the latest batch, where the step
+                    methods report it (not PyMC's slice sampler). PyMC's Metropolis restarts its counts at every tuning
+                    interval, so there it covers the batch's draws since the last tuning. Neither Geweke nor acceptance
+                    checks apply to SG-MCMC ('sgld'/'sghmc' on the numpy backend), which has no accept/reject step and
+                    whose draws carry a step-size bias; those chains are checked on ESS only (Geweke z-scores are still
+                    reported).
+    ESS and Geweke scores are not incremental: each check recomputes them over every draw so far, at O(n log n) for n draws,
+    so a run of k batches does O(k^2) batches' worth of diagnostic work. Keep 'batch' a sizeable fraction of the expected
+    run length (e.g. max_iter/20) rather than checking every few iterations.
+    Returns:
+        Numpy array of coefficients from every batch (see feature_coefficients).
+        Dictionary: 'converged', 'iterations' (burn-in included), 'draws', per-coefficient 'ess' and 'geweke' (intercept
+        first, as in the coefficients), 'acceptance' (None if not reported) and 'problems', a list of unmet targets.
+    """
+    if max_iter <= burn:
+        raise ValueError('max_iter must exceed burn.')
+    names = ['b_0']+['b_'+f for f in features]
+    # The symmetric model's intercept and shared mirror-image coefficients are constant and not monitored.
+    fixed = np.zeros(len(features)+1, dtype=bool)
+    if getattr(model_mcmc, 'symmetric', False):
+        fixed[:] = True
+        fixed[[i+1 for i in games_dataset.antisymmetric_features(features)]] = False
+    # Stochastic gradient chains have no accept/reject step and keep a discretization bias, so only ESS is checked.
+    stochastic_gradient = isinstance(getattr(model_mcmc, 'step_method', None), samplers.StochasticGradientStep)
+    batches = []
+    iterations = 0
+    while True:
+        # The first batch runs the burn-in. Each call to sample() continues the chain and stores its draws as a new chain.
+        this_burn = burn if iterations == 0 else 0
+        this_iter = min(this_burn+batch, max_iter-iterations)
+        before = acceptance_counts(model_mcmc, reset=True)
+        model_mcmc.sample(this_iter, this_burn, thin)
+        after = acceptance_counts(model_mcmc)
+        iterations += this_iter
+        batches.append(feature_coefficients(model_mcmc, features))
+
+        # Check convergence on all draws so far.
+        coefs = np.concatenate(batches, axis=0)
+        ess = np.array([diagnostics.ess_bulk(coefs[None,:,k]) for k in range(coefs.shape[1])])
+        geweke = np.array([diagnostics.geweke_z(coefs[:,k]) if len(coefs) >= 20 else np.inf for k in range(coefs.shape[1])])
+        ess[fixed], geweke[fixed] = np.inf, 0.
+        acceptance = None
+        if before is not None and after[1] > before[1]:
+            acceptance = (after[0]-before[0]) / float(after[1]-before[1])
+        problems = []
+        if ess.min() < min_ess:
+            problems.append('ESS %.0f below %.0f (%s)' % (ess.min(), min_ess, names[ess.argmin()]))
+        worst = np.abs(geweke).argmax()
+        if abs(geweke[worst]) > max_geweke and not stochastic_gradient:
+            problems.append('Geweke z %.2f beyond %.2f (%s)' % (geweke[worst], max_geweke, names[worst]))
+        if acceptance is not None and acceptance < min_acceptance:
+            problems.append('acceptance %.3f below %.3f' % (acceptance, min_acceptance))
+        if len(problems) == 0 or iterations >= max_iter:
+            break
+
+    instrumentation.count('convergence_runs', converged=str(len(problems) == 0))
+    return coefs, {
+        'converged':  len(problems) == 0,
+        'iterations': iterations,
+        'draws':      len(coefs),
+        'ess':        ess,
+        'geweke':     geweke,
+        'acceptance': acceptance,
+        'problems':   problems
+    }
+
+def acceptance_counts (model_mcmc, reset=False):
+    """
+    Accepted and total proposals, summed over step methods; None if the step methods do not report them (PyMC's slice
+    sampler, the numpy backend's stochastic gradient steps).
+    The numpy backend counts over the whole chain. PyMC's step methods count since their last reset, and Metropolis resets
+    at every tuning interval, so counts taken before and after a sample() call cannot be differenced. With reset=True the
+    PyMC counters are zeroed first; counts taken after the next sample() then cover its draws since the last tuning.
+    """
+    if isinstance(model_mcmc, samplers.NumpyMCMC):
+        # Stochastic gradient steps have no accept/reject step.
+        if isinstance(model_mcmc.step_method, samplers.StochasticGradientStep):
+            return None
+        return model_mcmc.accepted, model_mcmc.proposals
+    methods = [m for ms in getattr(model_mcmc, 'step_method_dict', {}).values() for m in ms
+               if hasattr(m, 'accepted') and hasattr(m, 'rejected')]
+    if len(methods) == 0:
+        return None
+    if reset:
+        for m in methods:
+            m.accepted, m.rejected = 0, 0
+    counts = [(m.accepted, m.accepted+m.rejected) for m in methods]
+    return sum(c[0] for c in counts), sum(c[1] for c in counts)
+
+def record_acceptance (model_mcmc):
+    """
+    Records acceptance rates of a PyMC model's step methods, one gauge per stochastic, if instrumentation is enabled.
+    The numpy backend records its own, except for stochastic gradient steps, which have no acceptance rate.
+    """
+    if not instrumentation.enabled or not hasattr(model_mcmc, 'step_method_dict'):
+        return
+    for var, methods in model_mcmc.step_method_dict.items():
+        for m in methods:
+            if hasattr(m, 'accepted') and hasattr(m, 'rejected'):
+                instrumentation.gauge('acceptance_rate', m.accepted/float(max(m.accepted+m.rejected,1)), parameter=str(var), step_method=type(m).__name__)
+
+def chain_seeds (seed, n):
+    """
+    Independent integer seeds for n chains, derived from one seed.
+    """
+    if hasattr(np.random, 'SeedSequence'):
+        return [int(s) for s in np.random.SeedSequence(seed).generate_state(n)]
+    return list(np.random.RandomState(seed).randint(2**31-1, size=n))
+
+def load_pymc ():
+    """
+    Imports PyMC on first use and returns it.
+    """
+    global pymc
+    if pymc is None:
+        import pymc
+    return pymc
+
+def component_name (component):
+    """
+    Name of a distribution or step method given as a name or as a PyMC class (e.g. pymc.Slicer -> 'slice').
+    """
+    if isinstance(component, str):
+        return component
+    return pymc_names.get(component.__name__, component.__name__)
+
+def pymc_class (component):
+    """
+    PyMC class of a distribution or step method given as a name or as a PyMC class.
+    """
+    if not isinstance(component, str):
+        return component
+    classes = dict((name, c) for c, name in pymc_names.items())
+    if component not in classes:
+        raise ValueError('Unknown PyMC distribution or step method: %s' % component)
+    return getattr(load_pymc(), classes[component])
+
 ### Ancillary Functions
 
 def feature_coefficients(model_mcmc, features):
     """
     Get a Numpy array of the features from a model MCMC object.
     Inputs:
-        model_mcmc: sampled PyMC object with the given features.
+        model_mcmc: sampled PyMC object with the given features, or a trace_store.TraceStore.
         features: List of features.
     Returns:
         Numpy array of features. Rows are trace history; columns are features starting with the intercept.
+        For a trace store this is a view of the memory-mapped traces rather than a copy.
     """
-    # Trace and feature info.
-    trace_len = model_mcmc.trace('b_0')[:].shape[0]
+    if isinstance(model_mcmc, trace_store.TraceStore):
+        return model_mcmc.coefficients(features)
+    # Trace and feature info. The symmetric model has no intercept trace, nor traces for features that share their mirror
+    # image's coefficient; these are zero.
+    names = ['b_'+f for f in ['0']+features]
+    traced = [names[i+1] for i in games_dataset.antisymmetric_features(features)] if getattr(model_mcmc, 'symmetric', False) else names
+    trace_len = model_mcmc.trace(traced[0])[:].shape[0]
     feat_len  = len(features)+1
     # Container for coefficients.
-    coefs = np.empty((trace_len,feat_len))
+    coefs = np.zeros((trace_len,feat_len))
     # Extract trace for each coefficient and return.
-    for f_i, f in enumerate(['0']+features):
-        coefs[:,f_i] = model_mcmc.trace('b_'+f)[:]
+    for name in traced:
+        coefs[:,names.index(name)] = model_mcmc.trace(name)[:]
     return coefs
 
 ### Standalone Run
@@ -137,20 +604,82 @@ def mcmc_trace_means(model_mcmc, features, printMeans = False):
         features: String list of features from game data.
         K: K for K-fold cross-validation
         thin: thinning parameter for the sampling technique
+        step_method_params, coef_dist_params: As in model_games.
+        iter, burn: Arguments to each fold's sample().
+        n_jobs: Number of worker processes; folds run in parallel.
+        warm_start: Start each fold's chain at the full-data posterior mode (see posterior_mode). On the numpy backend the
+                    proposal scales of the intercept and coefficients also come from the Laplace approximation unless
+                    step_method_params is given.
+        seed: Seed for the fold split and each fold's chain. Results are reproducible for a given seed.
+        details: Return a data frame of per-fold accuracy, log loss, fitting time, iterations run and convergence instead of
+                 accuracies only.
+        until_converged: Sample each fold until converged (True, or a dictionary of arguments to sample_until_converged),
+                         with 'iter' as the budget, rather than for exactly 'iter' iterations.
+        model_args: Further arguments to model_games (e.g. backend='numpy', step_method='nuts'). With symmetric=True, games are
+                    reduced to one row per game before splitting, so a game's two rows never fall in different folds.
     Returns:
         np.array of K-fold cross validated scores
     """
-def mcmc_xval(X, features, K, thin, step_method_params=None, coef_dist_params=None):
-    scores = []
-    kf = KFold(len(X), 5,shuffle=True)
-    for train, test in kf:
-        X_train = X.ix[train]
-        X_test = X.ix[test]
-        model_mcmc = model_games(data=X_train,features=features,step_method_params=step_method_params, coef_dist_params=coef_dist_params)
-        model_mcmc.sample(10000,2000, thin)
-        y_hat_raw, y_hat, y_hat_accuracy = game_predictions.predict_games(X_test, model_mcmc, features, 'pp')
-        scores.append(y_hat_accuracy)
-    return np.array(scores)
+def mcmc_xval(X, features, K, thin, step_method_params=None, coef_dist_params=None, iter=10000, burn=2000, n_jobs=1,
+              warm_start=False, seed=None, details=False, until_converged=None, **model_args):
+    # Symmetric matchup model: split games, not rows.
+    symmetric = model_args.get('symmetric', False)
+    if symmetric and 'game_id' in X:
+        X = games_dataset.canonical_games(X)
+
+    # Warm start from the full-data mode.
+    if warm_start:
+        prior_args = dict((k, model_args[k]) for k in ['coef_dists','b0_params','default_coef_dist','default_coef_params'] if k in model_args)
+        mode, cov = posterior_mode(X, features, symmetric=symmetric, coef_dist_params=coef_dist_params, **prior_args)
+        model_args = dict(model_args, init=mode)
+        if step_method_params is None and model_args.get('backend', 'pymc') == 'numpy':
+            sds = np.sqrt(np.diag(cov))
+            step_method_params = [{'proposal_sd':sd} for sd in sds[1:]]
+            if not symmetric:
+                default_params = model_args.get('default_step_method_params', {'proposal_sd':1., 'proposal_distribution':'Normal'})
+                model_args['default_step_method_params'] = dict(default_params, proposal_sd=sds[0])
+
+    # One task per fold.
+    from sklearn.cross_validation import KFold
+    kf = KFold(len(X), K, shuffle=True, random_state=seed)
+    fold_args = dict(model_args, step_method_params=step_method_params, coef_dist_params=coef_dist_params, until_converged=until_converged)
+    tasks = [(X.ix[train], X.ix[test], features, iter, burn, thin, s, fold_args) for (train, test), s in zip(kf, chain_seeds(seed, K))]
+    if n_jobs > 1:
+        pool = multiprocessing.Pool(n_jobs)
+        try:
+            folds = pool.map(xval_fold, tasks)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        folds = [xval_fold(t) for t in tasks]
+
+    scores = np.array([f['accuracy'] for f in folds])
+    if details:
+        import pandas as pd
+        return pd.DataFrame(folds, columns=['accuracy','log_loss','seconds','iterations','converged'])
+    return scores
+
+def xval_fold(task):
+    """
+    Worker for mcmc_xval: fits one fold and scores it on the held-out games.
+    Returns:
+        Dictionary of posterior predictive accuracy, log loss of the mean predictions, seconds taken, iterations run and
+        whether sampling converged (None unless sampled until converged).
+    """
+    X_train, X_test, features, iter, burn, thin, seed, model_args = task
+    start = time.time()
+    coefs, report = run_chain((X_train, features, iter, burn, thin, seed, model_args))
+    _mean, _interval, accuracy, log_loss = game_predictions.score_games(X_test, features, coefs=coefs, interval=None,
+                                                                        symmetric=model_args.get('symmetric', False))
+    instrumentation.count('xval_folds')
+    return {
+        'accuracy':   accuracy,
+        'log_loss':   log_loss,
+        'seconds':    time.time()-start,
+        'iterations': iter if report is None else report['iterations'],
+        'converged':  None if report is None else report['converged']
+    }
 
 # Function to store geweke scores from pymc's geweke function
     """
@@ -165,7 +694,7 @@ def geweke_statistics(model_mcmc, features):
     # Geweke Test
     for feature in features:
         print feature
-        scores = pymc.geweke(model_mcmc.trace('b_'+feature)[:])
+        scores = load_pymc().geweke(model_mcmc.trace('b_'+feature)[:])
         geweke_scores.append(scores)
     return geweke_scores
 
@@ -190,6 +719,7 @@ def unravel_list(twoD_list):
         features: String list of features from game data.
     """
 def plot_Geweke(geweke_scores, features):
+    import matplotlib, matplotlib.pyplot as plt
     plt.figure(figsize=[8,5])
     for i in xrange(len(geweke_scores)):
 #         geweke_MC = Geweke(model_mcmc.trace("b_"+feature)[:], 10, 1000)
@@ -0,0 +1,170 @@
+### Setup
+
+# Libraries.
+import numpy as np
+
+### Main Functionality
+
+def rhat (chains):
+    """
+    Rank-normalized split R-hat (Vehtari et al., 2021). The maximum of the bulk and folded (tail) versions is returned.
+    Inputs:
+        chains: Numpy array of shape (chains, draws) for one parameter.
+    Returns:
+        R-hat; values near 1 (say below 1.01) indicate the chains agree.
+    """
+    chains = split_chains(chains)
+    bulk = basic_rhat(rank_normalize(chains))
+    tail = basic_rhat(rank_normalize(np.abs(chains-np.median(chains))))
+    return max(bulk, tail)
+
+def ess_bulk (chains):
+    """
+    Bulk effective sample size: ESS of the rank-normalized split chains.
+    Inputs:
+        chains: Numpy array of shape (chains, draws) for one parameter.
+    """
+    return ess(rank_normalize(split_chains(chains)))
+
+def ess_tail (chains, prob=.05):
+    """
+    Tail effective sample size: the smaller ESS of the indicators for the 'prob' and 1-'prob' quantiles.
+    Inputs:
+        chains: Numpy array of shape (chains, draws) for one parameter.
+    """
+    chains = split_chains(chains)
+    lower, upper = np.percentile(chains, [100*prob, 100*(1-prob)])
+    return min(ess((chains <= lower).astype(np.float64)), ess((chains <= upper).astype(np.float64)))
+
+def ess (chains):
+    """
+    Effective sample size across chains from their autocorrelations, truncated by Geyer's initial monotone sequence.
+    Inputs:
+        chains: Numpy array of shape (chains, draws) for one parameter.
+    """
+    chains = np.atleast_2d(np.asarray(chains, dtype=np.float64))
+    m, n = chains.shape
+    if n < 4 or np.all(chains == chains.flat[0]):
+        return float(m*n)
+
+    # Autocovariance of each chain via FFT.
+    centered = chains - chains.mean(axis=1)[:,None]
+    size = 2**int(np.ceil(np.log2(2*n)))
+    f = np.fft.rfft(centered, n=size, axis=1)
+    acov = np.fft.irfft(f*np.conjugate(f), n=size, axis=1)[:,:n] / n
+
+    # Combine chains (Stan's estimator).
+    chain_var = acov[:,0] * n/(n-1.)
+    within = chain_var.mean()
+    var_plus = within*(n-1.)/n + (chains.mean(axis=1).var(ddof=1) if m > 1 else 0.)
+    rho = 1 - (within - acov.mean(axis=0))/var_plus
+    rho[0] = 1
+
+    # Sum autocorrelation pairs while positive, forcing them to be monotone.
+    tau = -1.
+    last_pair = np.inf
+    for t in range(0, n-1, 2):
+        pair = rho[t] + rho[t+1]
+        if pair < 0:
+            break
+        pair = min(pair, last_pair)
+        last_pair = pair
+        tau += 2*pair
+    return m*n / max(tau, 1./np.log10(m*n))
+
+def geweke_z (draws, first=.1, last=.5):
+    """
+    Geweke's convergence z-score: the difference between the means of the first 'first' and last 'last' fractions of a
+    chain, over its standard error. Each segment's variance of the mean is its variance over its effective sample size.
+    Inputs:
+        draws: Numpy array of one parameter's draws from a single chain.
+    Returns:
+        z-score; values beyond about +/-2 suggest the chain had not reached its stationary distribution at the start.
+        0 for a constant chain.
+    """
+    draws = np.asarray(draws, dtype=np.float64).ravel()
+    a = draws[:int(first*len(draws))]
+    b = draws[len(draws)-int(last*len(draws)):]
+    if len(a) < 2 or len(b) < 2:
+        raise ValueError('Too few draws for Geweke segments: %d.' % len(draws))
+    se2 = a.var()/ess(a) + b.var()/ess(b)
+    if se2 == 0:
+        return 0.
+    return (a.mean()-b.mean()) / np.sqrt(se2)
+
+### Helpers
+
+def split_chains (chains):
+    """
+    Splits each chain in half, so that within-chain trends show up as between-chain differences.
+    """
+    chains = np.atleast_2d(np.asarray(chains, dtype=np.float64))
+    half = chains.shape[1]//2
+    return np.concatenate((chains[:,:half], chains[:,chains.shape[1]-half:]), axis=0)
+
+def rank_normalize (chains):
+    """
+    Replaces draws by normal scores of their pooled ranks.
+    """
+    # Imported here so that loading diagnostics (e.g. for ChainTraces) does not load SciPy.
+    import scipy as sp, scipy.special, scipy.stats
+    ranks = sp.stats.rankdata(chains, method='average').reshape(chains.shape)
+    return sp.special.ndtri((ranks-.375)/(chains.size+.25))
+
+def basic_rhat (chains):
+    m, n = chains.shape
+    within  = chains.var(axis=1, ddof=1).mean()
+    between = n*chains.mean(axis=1).var(ddof=1)
+    if within == 0:
+        return 1.
+    return np.sqrt(((n-1.)/n*within + between/n) / within)
+
+### Multiple Chains
+
+class ChainTraces (object):
+    """
+    Traces of several independent chains for the same model, stacked into one (chains x draws x coefficients) array.
+    Supports trace(name)[:] like pymc.MCMC; by default traces are pooled over chains.
+    """
+
+    def __init__ (self, samples, names, symmetric=False):
+        """
+        Inputs:
+            samples:   Numpy array of shape (chains, draws, coefficients).
+            names:     Trace names for each coefficient, e.g. ['b_0', 'b_diff_Pythag'].
+            symmetric: Whether the chains sampled the symmetric matchup model (see bayes_lr.model_games), like the
+                       'symmetric' attribute of a single chain's MCMC object.
+        """
+        self.samples = np.asarray(samples)
+        self.names = list(names)
+        self.symmetric = symmetric
+
+    def trace (self, name, chain=None):
+        """
+        Samples of one coefficient from one chain; chain=None pools all chains.
+        """
+        samples = self.samples[:,:,self.names.index(name)]
+        return samples.ravel() if chain is None else samples[chain]
+
+    def rhat (self):
+        return np.array([rhat(self.samples[:,:,k]) for k in range(len(self.names))])
+
+    def ess_bulk (self):
+        return np.array([ess_bulk(self.samples[:,:,k]) for k in range(len(self.names))])
+
+    def ess_tail (self):
+        return np.array([ess_tail(self.samples[:,:,k]) for k in range(len(self.names))])
+
+    def summary (self):
+        """
+        Dictionary of per-coefficient diagnostics: mean, sd, R-hat, bulk and tail ESS.
+        """
+        pooled = self.samples.reshape((-1,len(self.names)))
+        return {
+            'name':     self.names,
+            'mean':     pooled.mean(axis=0),
+            'sd':       pooled.std(axis=0),
+            'rhat':     self.rhat(),
+            'ess_bulk': self.ess_bulk(),
+            'ess_tail': self.ess_tail()
+        }
@@ -0,0 +1,197 @@
+### Setup
+
+# Libraries.
+import multiprocessing
+import numpy as np
+
+# Custom library
+import samplers
+
+### Data
+
+class GameMatrix (object):
+    """
+    Game data held once as a contiguous float matrix, indexed by column name. Each column is contiguous in memory
+    (Fortran order), so the design matrix for any feature subset is a cheap column gather rather than a DataFrame rebuild.
+    Game ids are kept, if the data has them, so both rows of a game listed from each side fall in the same fold.
+    """
+
+    def __init__ (self, data, columns=None):
+        """
+        Inputs:
+            data:    Dataframe with game data, including 'win' and optionally 'game_id'.
+            columns: Candidate feature columns to keep. Default: every numeric column except 'win' and the game identifiers.
+        """
+        if columns is None:
+            columns = [c for c, dt in zip(data.columns, data.dtypes) if c not in ('win','game_id','game_group') and np.issubdtype(dt, np.number)]
+        self.columns = list(columns)
+        self.index = dict((c, i) for i, c in enumerate(self.columns))
+        self.values = np.asfortranarray(data[self.columns], dtype=np.float64)
+        self.win = np.array(data.win, dtype=np.float64)
+        self.game_id = np.array(data.game_id) if 'game_id' in data else None
+
+    @classmethod
+    def from_csv (cls, path, columns=None):
+        """
+        Reads a games CSV (as written by generate_game_data.py) once.
+        """
+        import pandas as pd
+        keep = None if columns is None else set(columns) | set(['win','game_id'])
+        data = pd.read_csv(path, usecols=None if keep is None else (lambda c: c in keep))
+        return cls(data, columns)
+
+    def __len__ (self):
+        return len(self.win)
+
+    def folds (self, K, rng=np.random):
+        """
+        Random fold (0 to K-1) of each row. Rows are assigned by game where game ids are known, so a game and its mirrored row
+        are never split between training and test games.
+        """
+        if self.game_id is None:
+            return rng.permutation(len(self)) % K
+        _ids, game = np.unique(self.game_id, return_inverse=True)
+        return (rng.permutation(game.max()+1) % K)[game]
+
+    def design (self, features, rows=None):
+        """
+        Design matrix (intercept first) for a feature subset, optionally restricted to some rows.
+        """
+        cols = [self.index[f] for f in features]
+        X = np.empty((len(self) if rows is None else len(rows),len(cols)+1))
+        X[:,0] = 1
+        X[:,1:] = self.values[:,cols] if rows is None else self.values[np.ix_(rows, cols)]
+        return X
+
+    def posterior (self, features, rows=None, prior_tau=.0003):
+        """
+        samplers.LogisticPosterior for a feature subset with model_games' default priors (mean 0, precision 'prior_tau').
+        """
+        X = self.design(features, rows)
+        y = self.win if rows is None else self.win[rows]
+        return samplers.LogisticPosterior(X, y, np.zeros(X.shape[1]), np.repeat(prior_tau, X.shape[1]))
+
+### Scoring
+
+def score_features (games, features, score='cv_log_loss', K=5, seed=None, prior_tau=.0003, draws=500):
+    """
+    Scores a feature subset; lower is better.
+    Inputs:
+        games:     GameMatrix.
+        features:  List of feature columns.
+        score:     'cv_log_loss' for K-fold cross-validated log loss of the Laplace-approximate posterior predictive;
+                   'waic' for WAIC (deviance scale) from Laplace draws on all games.
+        K:         Number of folds for 'cv_log_loss'. Folds are drawn by game (see GameMatrix.folds).
+        seed:      Seed for the fold assignment and draws. Use the same seed to compare subsets on the same folds.
+        prior_tau: Prior precision of the intercept and coefficients.
+        draws:     Number of posterior draws for 'waic'.
+    Returns:
+        Score.
+    """
+    rng = np.random.RandomState(seed)
+    if score == 'cv_log_loss':
+        folds = games.folds(K, rng)
+        total = 0.
+        for k in range(K):
+            train = np.nonzero(folds != k)[0]
+            test  = np.nonzero(folds == k)[0]
+            mode, cov = samplers.posterior_mode(games.posterior(features, train, prior_tau))
+            X = games.design(features, test)
+            # Probit approximation to the predictive probability under the Laplace posterior.
+            s = X.dot(mode) / np.sqrt(1 + np.pi/8*(X.dot(cov)*X).sum(axis=1))
+            p = np.clip(.5*(1+np.tanh(.5*s)), 1e-15, 1-1e-15)
+            y = games.win[test]
+            total -= (y*np.log(p) + (1-y)*np.log(1-p)).sum()
+        return total / len(games)
+    elif score == 'waic':
+        posterior = games.posterior(features, prior_tau=prior_tau)
+        mode, cov = samplers.posterior_mode(posterior)
+        B = mode + rng.standard_normal((draws,len(mode))).dot(np.linalg.cholesky(cov).T)
+        # Pointwise log likelihoods, games by draws.
+        s = posterior.X.dot(B.T)
+        loglik = posterior.y[:,None]*s - np.logaddexp(0, s)
+        top = loglik.max(axis=1)
+        lppd = (top + np.log(np.exp(loglik-top[:,None]).mean(axis=1))).sum()
+        p_waic = loglik.var(axis=1, ddof=1).sum()
+        return -2*(lppd - p_waic)
+    raise ValueError('Unknown score: %s' % score)
+
+# Worker state: the game matrix is sent to each worker once, not with every task.
+worker_games = None
+
+def init_worker (games):
+    global worker_games
+    worker_games = games
+
+def score_task (task):
+    features, score, K, seed, prior_tau = task
+    return score_features(worker_games, features, score, K, seed, prior_tau)
+
+### Search
+
+def search_features (games, candidates, method='forward', base_features=[], score='cv_log_loss', K=5, max_features=None,
+                     n_jobs=1, seed=0, prior_tau=.0003):
+    """
+    Greedy feature subset search. Every candidate move of a step is scored in a worker pool.
+    Inputs:
+        games:         GameMatrix (or a games dataframe, which is converted once).
+        candidates:    List of candidate feature columns.
+        method:        'forward' (add the best feature while the score improves), 'backward' (start from all candidates and
+                       drop the least useful) or 'stepwise' (forward steps, each followed by any improving removals).
+        base_features: Features always included.
+        score, K, prior_tau: As in score_features. The same folds (from 'seed') are used for every subset.
+        max_features:  Stop adding once this many candidates are selected.
+        n_jobs:        Number of worker processes.
+        seed:          Seed for fold assignment.
+    Returns:
+        List of selected features (including base_features).
+        Data frame of the search path: step, move, features and score.
+    """
+    if not isinstance(games, GameMatrix):
+        games = GameMatrix(games, list(base_features)+[c for c in candidates if c not in base_features])
+    max_features = len(candidates) if max_features is None else max_features
+
+    pool = multiprocessing.Pool(n_jobs, initializer=init_worker, initargs=(games,)) if n_jobs > 1 else None
+    init_worker(games)
+    def score_all (subsets):
+        tasks = [(list(base_features)+s, score, K, seed, prior_tau) for s in subsets]
+        return pool.map(score_task, tasks) if pool is not None else [score_task(t) for t in tasks]
+
+    try:
+        selected = list(candidates) if method == 'backward' else []
+        best = score_all([selected])[0]
+        path = [{'step':0, 'move':'start', 'features':list(base_features)+selected, 'score':best}]
+        step = 0
+        while True:
+            step += 1
+            improved = False
+            # Additions.
+            if method in ('forward', 'stepwise') and len(selected) < max_features:
+                options = [c for c in candidates if c not in selected]
+                if len(options) > 0:
+                    scores = score_all([selected+[c] for c in options])
+                    i = int(np.argmin(scores))
+                    if scores[i] < best:
+                        selected, best, improved = selected+[options[i]], scores[i], True
+                        path.append({'step':step, 'move':'add '+options[i], 'features':list(base_features)+selected, 'score':best})
+            # Removals.
+            if method in ('backward', 'stepwise') and len(selected) > 0:
+                while len(selected) > 0:
+                    scores = score_all([[c for c in selected if c != r] for r in selected])
+                    i = int(np.argmin(scores))
+                    if scores[i] >= best:
+                        break
+                    removed = selected[i]
+                    selected, best, improved = [c for c in selected if c != removed], scores[i], True
+                    path.append({'step':step, 'move':'drop '+removed, 'features':list(base_features)+selected, 'score':best})
+                    if method == 'backward':
+                        break
+            if not improved:
+                break
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    import pandas as pd
+    return list(base_features)+selected, pd.DataFrame(path, columns=['step','move','features','score'])
@@ -1,64 +1,181 @@
 ### Setup
 
 # Libraries.
-import bayes_lr
+import games_dataset
+import instrumentation
+import multiprocessing
 import numpy as np
-import pandas as pd
-import scipy as sp, scipy.stats
+import trace_store
 
 ### Main Functionality
 
+def feature_coefficients (model_mcmc, features):
+    """
+    Coefficient array of a sampled model, as bayes_lr.feature_coefficients. bayes_lr (and with it PyMC) is only imported for
+    MCMC objects, so predictions from trace stores do not load the modelling stack.
+    """
+    if isinstance(model_mcmc, trace_store.TraceStore):
+        return model_mcmc.coefficients(features)
+    import bayes_lr
+    return bayes_lr.feature_coefficients(model_mcmc, features)
+
+def coefficient_trace (features, model_mcmc=None, coefs=None):
+    """
+    Coefficients for coefficient_chunks: 'coefs' as a 2-D array if given; else a trace store as is, so it is read block by block
+    rather than loaded; else the coefficients of the MCMC object.
+    """
+    if coefs is not None:
+        return np.atleast_2d(coefs)
+    if isinstance(model_mcmc, trace_store.TraceStore):
+        return model_mcmc
+    return np.atleast_2d(feature_coefficients(model_mcmc, features))
+
+def coefficient_chunks (trace, features, chunk_size, dtype=np.float64):
+    """
+    Generator of (start, coefficients) for consecutive blocks of at most 'chunk_size' draws of a coefficient array or trace store,
+    converted to 'dtype' one block at a time.
+    """
+    if isinstance(trace, trace_store.TraceStore):
+        blocks = trace.chunks(chunk_size, features)
+    else:
+        blocks = ((start, trace[start:start+chunk_size]) for start in range(0, len(trace), chunk_size))
+    for start, block in blocks:
+        yield start, block.astype(dtype, copy=False)
+
 def logistic (s):
     """
     Sigmoid function. Just takes in a scalar and applies formula to it.
     """
     return 1 / (1+np.exp(-s))
 
-def predict_games (data, features, model_mcmc=None, coefs=None, method='map'):
+def predict_games (data, features, model_mcmc=None, coefs=None, method='map', dtype=np.float64, symmetric=False, chunk_size=1024):
     """
     Inputs:
         data:       Dataframe with game data.
         features:   List of features in data dataframe.
-        model_mcmc: PyMC MCMC object. Required if 'coefs' not supplied.
+        model_mcmc: PyMC MCMC object or trace_store.TraceStore. Required if 'coefs' not supplied.
         coefs:      Numpy array of coefficients; each column corresponds to an element of 'features'. Required if 'model_mcmc' is not supplied.
         method:     'pp' for posterior predictive, 'map' for single estimate using MAP.
+        dtype:      Floating point type for the predictions. np.float32 halves memory for long traces.
+        symmetric:  True for coefficients from model_games(symmetric=True); see design_matrix.
+        chunk_size: Number of draws predicted together. Bounds the working memory beyond the returned predictions at about
+                    chunk_size*games values.
     Returns:
         Binary predictions for each game.
         Raw continuous predictions (in range [0,1]) for each game.
         Accuracy based on binary predictions (range [0,1]).
     """
 
-    # Trace length.
-    coef_samples = model_mcmc.trace('b_0')[:].shape[0] if coefs is None else len(coefs)
-    
     # Get coefficients.
-    if coefs is None:
-        coefs = bayes_lr.feature_coefficients(model_mcmc, features)
+    trace = coefficient_trace(features, model_mcmc, coefs)
     # Use MAP if we need to.
-    if method == 'map' and coefs.shape[0] > 1:
-        coefs = coefs.mean(axis=0).reshape((1,len(features)+1))
-        coef_samples = 1
-    
+    if method == 'map' and len(trace) > 1:
+        total = np.zeros(len(features)+1)
+        for _start, block in coefficient_chunks(trace, features, chunk_size):
+            total += block.sum(axis=0)
+        trace = (total/len(trace)).reshape((1,len(features)+1))
+
     # Get design matrix.
-    X = np.concatenate((np.ones((len(data),1)), data[features]), axis=1)
-    
-    # Estimate wins. Start with a wins container.
-    y_hat_raw = np.zeros((coef_samples,len(data)))
-    # Traverse set of coefficients and assemble win estimates.
-    for c_i, c in enumerate(coefs):
-        y_hat_raw[c_i] = logistic((c.T*X).sum(axis=1))
+    X = design_matrix(data, features, dtype, symmetric)
+
+    # Estimate wins: one matrix product per chunk of draws.
+    y_hat_raw = np.empty((len(trace),len(X)), dtype=dtype)
+    with instrumentation.timer('predict_games'):
+        for start, block in coefficient_chunks(trace, features, chunk_size, dtype):
+            y_hat_raw[start:start+len(block)] = logistic(block.dot(X.T))
+    instrumentation.count('games_predicted', X.shape[0]*len(trace))
     # Tag wins/losses with comparison.
     y_hat = (y_hat_raw >= .5).astype(np.int)
-    
+
     # Compute accuracy by wins if they are available.
     y_hat_accuracy = None
     if 'win' in data:
         y_hat_accuracy = (np.array(data.win) == y_hat).mean()
-    
+
     return y_hat_raw, y_hat, y_hat_accuracy
 
+def score_games (data, features, model_mcmc=None, coefs=None, interval=.95, chunk_size=1024, dtype=np.float32, symmetric=False, draw_chunk_size=4096):
+    """
+    Posterior predictive summaries for each game, without holding the full (samples x games) prediction array.
+    Games are scored in blocks of 'chunk_size'; each block is multiplied against the trace 'draw_chunk_size' draws at a time,
+    so a trace store is read block by block rather than copied whole.
+    Inputs:
+        data:       Dataframe with game data.
+        features:   List of features in data dataframe.
+        model_mcmc: PyMC MCMC object or trace_store.TraceStore. Required if 'coefs' not supplied.
+        coefs:      Numpy array of coefficients; each column corresponds to an element of 'features'. Required if 'model_mcmc' is not supplied.
+        interval:   Width of the central credible interval for each game's win probability. None to skip intervals.
+        chunk_size: Number of games per block. Memory use is about chunk_size*samples values.
+        dtype:      Floating point type for block computations.
+        symmetric:  True for coefficients from model_games(symmetric=True); see design_matrix.
+        draw_chunk_size: Number of draws converted to 'dtype' and multiplied together.
+    Returns:
+        Mean win probability for each game.
+        Credible interval (lower, upper) for each game's win probability; None if 'interval' is None.
+        Posterior predictive accuracy (as predict_games with method='pp'); None if 'win' not in data.
+        Log loss of the mean win probabilities; None if 'win' not in data.
+    """
+
+    # Get coefficients.
+    trace = coefficient_trace(features, model_mcmc, coefs)
+
+    # Get design matrix, outcomes.
+    X = design_matrix(data, features, dtype, symmetric)
+    y = np.array(data.win) if 'win' in data else None
+
+    # Containers.
+    y_hat_mean = np.empty(len(X))
+    y_hat_interval = np.empty((len(X),2)) if interval is not None else None
+    correct = 0
+
+    # Score blocks of games. Rows are games, columns are samples.
+    with instrumentation.timer('score_games'):
+        for start in range(0, len(X), chunk_size):
+            stop = min(start+chunk_size, len(X))
+            s = np.empty((stop-start,len(trace)), dtype=dtype)
+            for draw, block in coefficient_chunks(trace, features, draw_chunk_size, dtype):
+                s[:,draw:draw+len(block)] = X[start:stop].dot(block.T)
+            y_hat_mean[start:stop] = logistic(s).mean(axis=1)
+            # The logistic function is monotone, so quantiles can be taken on the linear predictor.
+            if interval is not None:
+                y_hat_interval[start:stop] = logistic(np.percentile(s, [50*(1-interval), 50*(1+interval)], axis=1).T)
+            if y is not None:
+                correct += ((s >= 0) == y[start:stop,None]).sum()
+    instrumentation.count('games_scored', X.shape[0]*len(trace))
+
+    # Accuracy and log loss if outcomes are available.
+    y_hat_accuracy = None
+    y_hat_log_loss = None
+    if y is not None:
+        y_hat_accuracy = correct / float(len(trace)*len(X))
+        p = np.clip(y_hat_mean, 1e-15, 1-1e-15)
+        y_hat_log_loss = -(y*np.log(p) + (1-y)*np.log(1-p)).mean()
+
+    return y_hat_mean, y_hat_interval, y_hat_accuracy, y_hat_log_loss
+
+def design_matrix (data, features, dtype=np.float64, symmetric=False):
+    """
+    Design matrix for a set of games: an intercept column followed by the feature columns.
+    With symmetric=True, the design of the symmetric matchup model: the intercept column is zero and each feature is replaced
+    by its antisymmetric part, half its difference from the mirrored feature (see games_dataset.mirror_features). Seeing a
+    game from the other side then negates every row, so the two teams' win probabilities sum to one. diff_ and location_HomeAway
+    features are already antisymmetric and are unchanged. Of a feature and its mirror image (e.g. location_Home and
+    location_Away) only the first listed gets a column; the other's is zero. Shared game properties raise a ValueError
+    (see games_dataset.antisymmetric_features).
+    """
+    X = np.empty((len(data),len(features)+1), dtype=dtype)
+    if symmetric:
+        keep = games_dataset.antisymmetric_features(features)
+        kept = [features[i] for i in keep]
+        X[:,:] = 0
+        X[:,[i+1 for i in keep]] = (np.asarray(data[kept], dtype=np.float64) - np.asarray(games_dataset.mirror_features(data, kept), dtype=np.float64)) / 2
+    else:
+        X[:,0] = 1
+        X[:,1:] = data[features]
+    return X
+
 # Main function for simulating a tournament.
-def simulate_tournament (bracket, team_stats, features, deterministic=False, model_mcmc=None, coef_trace=None):
+def simulate_tournament (bracket, team_stats, features, deterministic=False, model_mcmc=None, coef_trace=None, engine='vectorized', win_probs=None, n_jobs=1, seed=None, chunk_size=4096, symmetric=False):
     """
     Simulates a tournament, following all teams down the bracket to the championship.
     Inputs:
@@ -67,20 +184,49 @@ def simulate_tournament (bracket, team_stats, features, deterministic=False, mod
         team_stats:    Dataframe with team statistics.
         features:      List of features in data dataframe.
         deterministic: Declare the most likely winner as the winner if true; else use a Bernoulli trial to simulate each game.
-        model_mcmc:    PyMC MCMC object. Trace length = simulations. Required if 'coef_trace' not supplied.
+                       'exact' computes expected outcomes for every set of coefficients without sampling games (see bracket_advancement);
+                       counts are then real-valued expectations.
+        model_mcmc:    PyMC MCMC object or trace_store.TraceStore. Trace length = simulations. A store's trace is read chunk by chunk
+                       when 'features' are the stored features in order; another subset or order is copied into memory.
+                       Required if 'coef_trace' not supplied.
         coef_trace:    Numpy array of coefficients; each column corresponds to an element of 'features'. Trace length = simulations. Required if 'model_mcmc' is not supplied.
+        engine:        'vectorized' to simulate every draw of a round as one array operation (see simulate_bracket_draws);
+                       'recursive' to simulate one draw at a time with simulate_bracket_coefs.
+        win_probs:     Optional win_prob_cache.WinProbabilityCache covering the bracket teams. Its trace replaces 'model_mcmc'/'coef_trace'
+                       and game probabilities are looked up rather than recomputed. Vectorized engine only.
+        n_jobs:        Number of worker processes. The trace is split into n_jobs contiguous shards. Vectorized engine only.
+        seed:          Seed for the shards' independent random streams (see spawn_random_states). Results are reproducible for a given
+                       seed and n_jobs. If both are left at their defaults, the global np.random state is used.
+        chunk_size:    Number of draws simulated together by the vectorized engine. Bounds memory independently of trace length.
+                       With 'win_probs', the cache's block_size is used instead.
+        symmetric:     True for coefficients from model_games(symmetric=True): games are scored with the antisymmetric matchup design
+                       (see matchup_design). Vectorized engine only; a 'win_probs' cache must be built the same way.
     Returns:
         Tournament outcomes as a data frame.
     """
 
     ### Setup
 
+    # Outcomes are data frames. pandas is imported on first use, so the numeric core imports with NumPy alone.
+    import pandas as pd
+
     # Get coefficients if we were not given them.
-    if coef_trace is None:
-        coef_trace = bayes_lr.feature_coefficients(model_mcmc, features)
+    check_symmetric(symmetric, model_mcmc, win_probs)
+    if symmetric and engine != 'vectorized':
+        raise ValueError('The symmetric matchup model requires the vectorized engine.')
+    if win_probs is not None:
+        if engine != 'vectorized':
+            raise ValueError('Win probability caches require the vectorized engine.')
+        if list(win_probs.features) != list(features):
+            raise ValueError('Win probability cache was built for different features.')
+        coef_trace = win_probs.coef_trace
+    elif coef_trace is None:
+        coef_trace = feature_coefficients(model_mcmc, features)
 
     ### Simulations
 
+    instrumentation.count('tournament_simulations', len(coef_trace), engine=engine, mode=str(deterministic))
+
     # Turn bracket into an array for easy manipulation.
     if type(bracket) == list:
         bracket = np.array(bracket)
@@ -91,44 +237,82 @@ def simulate_tournament (bracket, team_stats, features, deterministic=False, mod
     # Use a numpy array to hold our outcomes.
     # Log base 2 works for determining how many rounds we have.
     round_outcomes = np.zeros((len(teams),int(np.log2(len(teams)))), dtype=np.int)
-
-    # Create "team" DF by merging teams with statistics.
-    teams_df = pd.DataFrame({'team':bracket.ravel()}).merge(team_stats, left_on='team', right_on='TeamName').drop(['TeamName'],axis=1)
-    teams_df.columns = ['team_'+c if c in team_stats.columns else c for c in teams_df.columns]
-    # teams_df = teams_df.reset_index().rename(columns={'index':'bracket_order'})
-    # Reuse for "opponent" DF.
-    opponents_df = teams_df.copy().rename(columns={'team':'opponent'})
-    opponents_df.columns = [c.replace('team_','opponent_') if c.startswith('team_') else c for c in opponents_df.columns]
-
-    # Generate location columns if in features. Append to the "team" DF.
-    if 'location_Neutral' in features:
-        teams_df['location_Neutral'] = 1 # Presume neutrality.
-    for c in ['location_Home','location_Away','location_SemiAway','location_SemiHome']:
-        if c in features:
-            teams_df[c] = 0
-
-    # Matchup information containers.
-    matchups = []
-
-    # Iterate over trace and start one branch per set of coefficients.
-    for coefs in coef_trace:
-        # Ensure correct shape for coefficients.
-        coefs = coefs.reshape((1,coefs.shape[0]))
-        # Simulate.
-        coef_matchups, coefs_round_outcomes = simulate_bracket_coefs(bracket, teams_df, opponents_df, features, coefs, deterministic)
-        # Add matchups to container.
-        matchups = matchups + coef_matchups
-        # Add simulation outcomes to main outcomes array.
-        for t_i, t in enumerate(teams):
-            round_outcomes[t_i,:] += coefs_round_outcomes[t]
+    # Matchup counts: [round, winner, loser], teams indexed by position in the sorted list.
+    matchup_counts = np.zeros((round_outcomes.shape[1],len(teams),len(teams)), dtype=np.int)
+
+    if deterministic == 'exact':
+        if engine != 'vectorized':
+            raise ValueError('Exact outcomes require the vectorized engine.')
+        # Sum expected outcomes over chunks of draws. Every pair that can meet gets its expected count.
+        round_outcomes = np.zeros(round_outcomes.shape)
+        matchup_counts = np.zeros(matchup_counts.shape)
+        for advance, meetings in exact_advancement_chunks(teams, np.searchsorted(teams, bracket), team_stats, features, coef_trace, win_probs, symmetric=symmetric):
+            round_outcomes += advance.sum(axis=0)
+            matchup_counts += meetings
+    elif engine == 'vectorized':
+        # Teams are referenced by their position in the sorted team list.
+        bracket_idx = np.searchsorted(teams, bracket)
+        if n_jobs == 1 and seed is None:
+            # Game probabilities come from the cache if we have one; else from team statistics looked up once.
+            if win_probs is not None:
+                win_prob = win_probs.draw_lookup(win_probs.index(teams))
+                # Simulate one cache block at a time, so every round of a chunk reuses the same block.
+                chunk_size = win_probs.block_size
+            else:
+                stats, spec = team_feature_matrix(teams, team_stats, features, symmetric)
+                win_prob = design_win_prob(stats, spec, np.atleast_2d(coef_trace), symmetric)
+            matchup_counts, round_outcomes = simulate_bracket_draws(bracket_idx, len(teams), len(coef_trace), win_prob, deterministic, chunk_size=chunk_size)
+        else:
+            if win_probs is not None:
+                raise ValueError('Win probability caches cannot be shared with worker processes.')
+            # One shard of the trace and one random stream per worker.
+            stats, spec = team_feature_matrix(teams, team_stats, features, symmetric)
+            shards = [s for s in np.array_split(np.atleast_2d(coef_trace), n_jobs) if len(s) > 0]
+            tasks  = [(bracket_idx, stats, spec, s, deterministic, rng, chunk_size, symmetric) for s, rng in zip(shards, spawn_random_states(seed, len(shards)))]
+            if n_jobs > 1:
+                pool = multiprocessing.Pool(n_jobs)
+                try:
+                    results = pool.map(simulate_shard, tasks)
+                finally:
+                    pool.close()
+                    pool.join()
+            else:
+                results = [simulate_shard(t) for t in tasks]
+            # Merge shards.
+            matchup_counts = np.sum([r[0] for r in results], axis=0)
+            round_outcomes = np.sum([r[1] for r in results], axis=0)
+    elif engine == 'recursive':
+        # Create "team" DF by merging teams with statistics.
+        teams_df = pd.DataFrame({'team':bracket.ravel()}).merge(team_stats, left_on='team', right_on='TeamName').drop(['TeamName'],axis=1)
+        teams_df.columns = ['team_'+c if c in team_stats.columns else c for c in teams_df.columns]
+        # teams_df = teams_df.reset_index().rename(columns={'index':'bracket_order'})
+        # Reuse for "opponent" DF.
+        opponents_df = teams_df.copy().rename(columns={'team':'opponent'})
+        opponents_df.columns = [c.replace('team_','opponent_') if c.startswith('team_') else c for c in opponents_df.columns]
+
+        # Generate location columns if in features. Append to the "team" DF.
+        for c, v in tournament_locations.items():
+            if c in features:
+                teams_df[c] = v
+
+        # Iterate over trace and start one branch per set of coefficients.
+        for coefs in coef_trace:
+            # Ensure correct shape for coefficients.
+            coefs = coefs.reshape((1,coefs.shape[0]))
+            # Simulate.
+            coef_matchups, coefs_round_outcomes = simulate_bracket_coefs(bracket, teams_df, opponents_df, features, coefs, deterministic)
+            # Add matchups to counts.
+            for m in coef_matchups:
+                r_i = int(np.log2(len(teams)/m['round_of']))
+                np.add.at(matchup_counts[r_i], (np.searchsorted(teams, m['winners']), np.searchsorted(teams, m['losers'])), 1)
+            # Add simulation outcomes to main outcomes array.
+            for t_i, t in enumerate(teams):
+                round_outcomes[t_i,:] += coefs_round_outcomes[t]
+    else:
+        raise ValueError('Unknown simulation engine: %s' % engine)
 
     # Transform matchup information to DF.
-    matchups_df = pd.DataFrame({
-            'winner':  np.concatenate([r['winners'] for r in matchups]),
-            'loser':   np.concatenate([r['losers']  for r in matchups]),
-            'round_of': np.concatenate([np.repeat(r['round_of'],r['round_of']/2) for r in matchups]),
-            'count': 1
-        }).groupby(['winner','loser','round_of']).agg(np.sum).reset_index()
+    matchups_df = matchups_frame(teams, matchup_counts)
 
     # Turn team list and outcomes into a data frame.
     team_round_outcomes = pd.DataFrame(round_outcomes, index=teams, columns=['wins_round_'+str(rnd) for rnd in xrange(1,round_outcomes.shape[1]+1)])
@@ -136,6 +320,322 @@ def simulate_tournament (bracket, team_stats, features, deterministic=False, mod
     # Return teams and outcomes.
     return matchups_df, team_round_outcomes
 
+def matchups_frame (teams, matchup_counts):
+    """
+    Turns a matchup count array into the matchup data frame returned by simulate_tournament.
+    Inputs:
+        teams:          Sorted array of team names.
+        matchup_counts: Numpy array of shape (rounds, teams, teams); [r,w,l] counts wins of team w over team l in round r+1.
+    Returns:
+        Data frame with winner, loser, round_of and count columns; one row per observed matchup, sorted by winner, loser and round_of.
+    """
+    import pandas as pd
+    # Order axes as winner, loser, round_of (ascending) so nonzero entries come out sorted.
+    by_pair = matchup_counts[::-1].transpose((1,2,0))
+    winners, losers, rounds = np.nonzero(by_pair)
+    return pd.DataFrame({
+            'winner':   teams[winners],
+            'loser':    teams[losers],
+            'round_of': 2**(rounds+1),
+            'count':    by_pair[winners,losers,rounds]
+        }, columns=['winner','loser','round_of','count'])
+
+### Vectorized Simulation
+
+# Location columns and the values they take for a tournament game (presumed neutral).
+tournament_locations = {
+    'location_Neutral':      1,
+    'location_Home':         0,
+    'location_Away':         0,
+    'location_SemiAway':     0,
+    'location_SemiHome':     0,
+    'location_HomeAway':     0,
+    'location_SemiHomeAway': 0
+}
+
+def team_feature_matrix (teams, team_stats, features, symmetric=False):
+    """
+    Collects the team statistics needed to compute 'features' for any pairing of 'teams'.
+    Inputs:
+        teams:      Array of team names.
+        team_stats: Dataframe with team statistics, keyed by 'TeamName'.
+        features:   List of game features: diff_, ratio_, team_ and opponent_ statistics and location_ dummies.
+        symmetric:  True for the symmetric matchup model: shared game properties raise a ValueError and a feature whose mirror
+                    image is listed before it is fixed at zero, as in design_matrix(symmetric=True).
+    Returns:
+        Numpy array of statistics with one row per element of 'teams'.
+        Feature specification: one (kind, column) pair per feature, for use with matchup_design.
+    """
+
+    # Map every feature onto a statistic column (or a constant for locations).
+    keep = games_dataset.antisymmetric_features(features) if symmetric else range(len(features))
+    spec = []
+    stat_cols = []
+    for k, f in enumerate(features):
+        if k not in keep:
+            spec.append(('constant', 0))
+            continue
+        if f in tournament_locations:
+            spec.append(('constant', tournament_locations[f]))
+            continue
+        kind = f[:f.index('_')] if '_' in f else None
+        stat = f[len(kind)+1:] if kind is not None else None
+        if kind not in ('diff','ratio','team','opponent') or stat not in team_stats.columns:
+            raise ValueError('Feature %s cannot be computed from team statistics.' % f)
+        if stat not in stat_cols:
+            stat_cols.append(stat)
+        spec.append((kind, stat_cols.index(stat)))
+
+    # Look up teams.
+    stats_df = team_stats.set_index('TeamName')
+    missing = [t for t in teams if t not in stats_df.index]
+    if len(missing) > 0:
+        raise ValueError('No statistics for teams: %s' % ', '.join(missing))
+    stats = np.array(stats_df.loc[list(teams), stat_cols], dtype=np.float64).reshape((len(teams),len(stat_cols)))
+
+    return stats, spec
+
+def matchup_design (stats, spec, team, opponent, symmetric=False):
+    """
+    Builds design matrices for games between rows of a team statistics matrix.
+    Inputs:
+        stats:     Numpy array of team statistics from team_feature_matrix.
+        spec:      Feature specification from team_feature_matrix.
+        team:      Integer array of team rows. Any shape.
+        opponent:  Integer array of opponent rows. Same shape as 'team'.
+        symmetric: True for the symmetric matchup model: half the difference between the design of the game and that of the
+                   game seen from the opponent's side, as design_matrix(symmetric=True). The intercept and location constants
+                   cancel and ratio_ features r become (r-1/r)/2. Build 'spec' with symmetric=True too.
+    Returns:
+        Numpy array of shape team.shape + (features+1,); the first column is the intercept.
+    """
+    if symmetric:
+        return (matchup_design(stats, spec, team, opponent) - matchup_design(stats, spec, opponent, team)) / 2
+    team     = np.asarray(team)
+    opponent = np.asarray(opponent)
+    X = np.empty(team.shape+(len(spec)+1,))
+    X[...,0] = 1
+    for k, (kind, col) in enumerate(spec, 1):
+        if kind == 'constant':
+            X[...,k] = col
+        elif kind == 'diff':
+            X[...,k] = stats[team,col] - stats[opponent,col]
+        elif kind == 'ratio':
+            X[...,k] = stats[team,col] / stats[opponent,col]
+        elif kind == 'team':
+            X[...,k] = stats[team,col]
+        else:
+            X[...,k] = stats[opponent,col]
+    return X
+
+def pairwise_design (stats, spec, symmetric=False):
+    """
+    Design matrix for every ordered pair of rows of a team statistics matrix.
+    Inputs:
+        stats:     Numpy array of team statistics from team_feature_matrix.
+        spec:      Feature specification from team_feature_matrix.
+        symmetric: As in matchup_design.
+    Returns:
+        Numpy array of shape (teams*teams, features+1); row i*teams+j is team i against opponent j.
+    """
+    team, opponent = np.meshgrid(np.arange(stats.shape[0]), np.arange(stats.shape[0]), indexing='ij')
+    return matchup_design(stats, spec, team, opponent, symmetric).reshape((stats.shape[0]**2,-1))
+
+def design_win_prob (stats, spec, coefs, symmetric=False):
+    """
+    Win probability function for simulate_bracket_draws that evaluates the model directly.
+    Inputs:
+        stats:     Numpy array of team statistics from team_feature_matrix.
+        spec:      Feature specification from team_feature_matrix.
+        coefs:     Numpy array of coefficients; one row per simulation, intercept first.
+        symmetric: As in matchup_design.
+    Returns:
+        Function taking (simulations, games) team and opponent row arrays, plus the first simulation's row in 'coefs',
+        and returning the probabilities that each team wins.
+    """
+    def win_prob (team, opponent, start=0):
+        return logistic(np.einsum('dgk,dk->dg', matchup_design(stats, spec, team, opponent, symmetric), coefs[start:start+team.shape[0]]))
+    return win_prob
+
+def simulate_bracket_draws (bracket_idx, n_teams, draws, win_prob, deterministic, rng=np.random, chunk_size=4096):
+    """
+    Simulates a tournament for every set of coefficients. Each round of a chunk of draws is a single array operation over draws and games;
+    outcomes are tallied as each chunk finishes, so memory does not grow with the number of draws.
+    Inputs:
+        bracket_idx:   Integer array of first round matchups, as team positions. Unrolled as in simulate_tournament.
+        n_teams:       Number of team positions.
+        draws:         Number of simulations (sets of coefficients).
+        win_prob:      Function mapping (simulations, games) team and opponent arrays and the first simulation's index to win probabilities;
+                       see design_win_prob.
+        deterministic: Declare the most likely winner as the winner if true; else use a Bernoulli trial to simulate each game.
+        rng:           Random number source (np.random or a np.random.RandomState).
+        chunk_size:    Number of draws simulated together.
+    Returns:
+        Numpy array of matchup counts of shape (rounds, teams, teams); [r,w,l] counts wins of team w over team l in round r+1.
+        Numpy array of round wins; one row per team position, one column per round.
+    """
+    bracket_idx = np.asarray(bracket_idx).ravel()
+    n_rounds = int(np.log2(len(bracket_idx)))
+    matchup_counts = np.zeros((n_rounds,n_teams,n_teams), dtype=np.int64)
+    round_wins = np.zeros((n_teams,n_rounds), dtype=np.int64)
+
+    for start in range(0, draws, chunk_size):
+        # Teams still alive, in bracket order, for every draw of the chunk.
+        slots = np.tile(bracket_idx, (min(chunk_size,draws-start),1))
+        for r in range(n_rounds):
+            with instrumentation.timer('simulate_round', round=str(r+1)):
+                games = slots.reshape((slots.shape[0],-1,2))
+                # Randomly choose which side of each game is the "team".
+                flip = rng.randint(2, size=games.shape[:2]).astype(bool)
+                team     = np.where(flip, games[:,:,1], games[:,:,0])
+                opponent = np.where(flip, games[:,:,0], games[:,:,1])
+                # Win probabilities for every draw and game.
+                p = win_prob(team, opponent, start)
+                # Decide games.
+                if deterministic:
+                    team_wins = p >= .5
+                else:
+                    team_wins = rng.random_sample(p.shape) < p
+                winners = np.where(team_wins, team, opponent)
+                losers  = np.where(team_wins, opponent, team)
+                # Tally.
+                round_wins[:,r] += np.bincount(winners.ravel(), minlength=n_teams)
+                matchup_counts[r] += np.bincount((winners*n_teams+losers).ravel(), minlength=n_teams**2).reshape((n_teams,n_teams))
+                # Winners advance in bracket order.
+                slots = winners
+
+    return matchup_counts, round_wins
+
+def spawn_random_states (seed, n):
+    """
+    Independent, reproducible random streams for parallel simulation.
+    Inputs:
+        seed: Integer seed (or None for fresh entropy).
+        n:    Number of streams.
+    Returns:
+        List of n np.random.RandomState objects, spawned from a single SeedSequence where numpy provides one.
+    """
+    if hasattr(np.random, 'SeedSequence'):
+        return [np.random.RandomState(np.random.MT19937(s)) for s in np.random.SeedSequence(seed).spawn(n)]
+    # Older numpy: derive each stream from the seed and its index.
+    return [np.random.RandomState(None if seed is None else [seed, i]) for i in range(n)]
+
+def simulate_shard (task):
+    """
+    Worker for parallel simulate_tournament runs.
+    Inputs:
+        task: Tuple of (bracket_idx, stats, spec, coefs, deterministic, rng, chunk_size, symmetric); see simulate_bracket_draws
+              and design_win_prob.
+    Returns:
+        The outputs of simulate_bracket_draws for the shard.
+    """
+    bracket_idx, stats, spec, coefs, deterministic, rng, chunk_size, symmetric = task
+    return simulate_bracket_draws(bracket_idx, stats.shape[0], len(coefs), design_win_prob(stats, spec, coefs, symmetric), deterministic, rng, chunk_size)
+
+### Exact Outcomes
+
+def bracket_advancement (bracket_idx, probs):
+    """
+    Exact advancement probabilities for a single-elimination bracket, by dynamic programming over the bracket tree.
+    Each game's "team" side is a coin flip, as in the simulations, so team i beats team j with probability (p_ij + 1 - p_ji)/2.
+    Inputs:
+        bracket_idx: Integer array of first round matchups, as team positions. Unrolled as in simulate_tournament.
+        probs:       Numpy array of shape (draws, teams, teams); [d,i,j] is the probability that team i beats team j as the "team" under draw d.
+    Returns:
+        Numpy array of shape (draws, teams, rounds) with the probability that each team wins each round.
+        Numpy array of shape (rounds, teams, teams) with the expected number of wins of team i over team j, summed over draws.
+    """
+    slots = np.asarray(bracket_idx).ravel()
+    n = len(slots)
+    n_rounds = int(np.log2(n))
+
+    # Neutral win probabilities between bracket slots.
+    p = probs[:,slots[:,None],slots[None,:]]
+    q = .5*(p + 1 - p.transpose((0,2,1)))
+
+    advance  = np.zeros((probs.shape[0],probs.shape[1],n_rounds))
+    meetings = np.zeros((n_rounds,probs.shape[1],probs.shape[1]))
+    reach = np.ones((probs.shape[0],n))
+    for r in range(n_rounds):
+        # Slots meet in this round if they share a block of 2^(r+1) slots but sit in different halves of it.
+        half   = 2**r
+        blocks = n//(2*half)
+        b      = np.arange(blocks)
+        q_left = q.reshape((-1,blocks,2,half,blocks,2,half))[:,b,0,:,b,1,:].transpose((1,0,2,3))
+        reach_left  = reach.reshape((-1,blocks,2,half))[:,:,0,:]
+        reach_right = reach.reshape((-1,blocks,2,half))[:,:,1,:]
+        # Probability that a slot reaches this round, meets a slot from the other half and beats it.
+        wins_left  = reach_left[:,:,:,None] * q_left * reach_right[:,:,None,:]
+        wins_right = reach_right[:,:,:,None] * (1 - q_left.transpose((0,1,3,2))) * reach_left[:,:,None,:]
+        reach = np.concatenate((wins_left.sum(axis=3)[:,:,None,:], wins_right.sum(axis=3)[:,:,None,:]), axis=2).reshape((-1,n))
+        advance[:,slots,r] = reach
+        # Expected meetings, summed over draws.
+        left  = slots.reshape((blocks,2,half))[:,0,:]
+        right = slots.reshape((blocks,2,half))[:,1,:]
+        meetings[r][left[:,:,None],right[:,None,:]] = wins_left.sum(axis=0)
+        meetings[r][right[:,:,None],left[:,None,:]] = wins_right.sum(axis=0)
+
+    return advance, meetings
+
+def exact_advancement_chunks (teams, bracket_idx, team_stats, features, coef_trace, win_probs=None, chunk_size=256, symmetric=False):
+    """
+    Runs bracket_advancement over a coefficient trace in chunks of draws, bounding memory at chunk_size*teams^2 entries.
+    Inputs:
+        teams:       Sorted array of bracket team names.
+        bracket_idx: Integer array of first round matchups, as positions in 'teams'.
+        team_stats:  Dataframe with team statistics. Unused if 'win_probs' is given.
+        features:    List of features in data dataframe.
+        coef_trace:  Numpy array of coefficients; one row per draw, intercept first.
+        win_probs:   Optional win_prob_cache.WinProbabilityCache to take pairwise probabilities from.
+        chunk_size:  Number of draws per chunk.
+        symmetric:   As in simulate_tournament.
+    Yields:
+        The outputs of bracket_advancement for each chunk.
+    """
+    if win_probs is not None:
+        positions = win_probs.index(teams)
+    else:
+        stats, spec = team_feature_matrix(teams, team_stats, features, symmetric)
+        design = pairwise_design(stats, spec, symmetric)
+    for start in range(0, len(coef_trace), chunk_size):
+        stop = min(start+chunk_size, len(coef_trace))
+        if win_probs is not None:
+            probs = win_probs.probabilities(start, stop)[:,positions[:,None],positions[None,:]]
+        else:
+            probs = logistic(np.atleast_2d(coef_trace[start:stop]).dot(design.T)).reshape((stop-start,len(teams),len(teams)))
+        with instrumentation.timer('exact_advancement'):
+            advancement = bracket_advancement(bracket_idx, probs)
+        yield advancement
+
+def advancement_probabilities (bracket, team_stats, features, model_mcmc=None, coef_trace=None, win_probs=None, symmetric=False):
+    """
+    Exact probabilities that each team wins each round, for every set of coefficients.
+    Inputs:
+        As in simulate_tournament.
+    Returns:
+        Sorted array of team names.
+        Numpy array of shape (draws, teams, rounds); entry [d,t,r] is the probability team t wins round r+1 under draw d.
+    """
+    check_symmetric(symmetric, model_mcmc, win_probs)
+    if win_probs is not None:
+        coef_trace = win_probs.coef_trace
+    elif coef_trace is None:
+        coef_trace = feature_coefficients(model_mcmc, features)
+    bracket = np.asarray(bracket)
+    teams = np.sort(bracket.ravel())
+    advance = [a for a, _m in exact_advancement_chunks(teams, np.searchsorted(teams, bracket), team_stats, features, coef_trace, win_probs, symmetric=symmetric)]
+    return teams, np.concatenate(advance, axis=0)
+
+def check_symmetric (symmetric, model_mcmc=None, win_probs=None):
+    """
+    Raises ValueError if a sampled model or win probability cache does not match the 'symmetric' setting of a simulation, so
+    symmetric coefficients are never scored with the standard design (or the reverse).
+    """
+    if getattr(model_mcmc, 'symmetric', False) and not symmetric:
+        raise ValueError('Coefficients are from the symmetric matchup model; simulate with symmetric=True.')
+    if win_probs is not None and win_probs.symmetric != symmetric:
+        raise ValueError('Win probability cache was built with symmetric=%s.' % win_probs.symmetric)
+
 # Helper function for simulating a bracket for one set of coefficients.
 def simulate_bracket_coefs (bracket, teams_df, opponents_df, features, coefs, deterministic):
     """
@@ -155,32 +655,35 @@ def simulate_bracket_coefs (bracket, teams_df, opponents_df, features, coefs, de
 
     ### Data
 
+    import pandas as pd
+
     # Start by randomly shuffling each pair of teams.
     shuffled_bracket = np.empty(bracket.shape, dtype=bracket.dtype)
     for g_i, game in enumerate(bracket):
         flip = np.random.randint(2)
         shuffled_bracket[g_i,:] = [game[flip],game[np.abs(flip-1)]]
 
-    # Get team and opponent.
-    games_df = pd.concat((
-            teams_df[teams_df.team.isin(shuffled_bracket[:,0])].reset_index(drop=True),
-            opponents_df[opponents_df.opponent.isin(shuffled_bracket[:,1])].reset_index(drop=True)
-        ),
-        axis=1
-    )
-
-    # Calculate aggregate columns
-    # Get all team, opponent columns.
-    team_cols     = [c for c in games_df.columns if c.startswith('team_')]
-    opponent_cols = [c for c in games_df.columns if c.startswith('opponent_')]
-    # Calculate diff and ratio col names.
-    diff_col_names  = [c.replace('team_','diff_')  for c in team_cols]
-    ratio_col_names = [c.replace('team_','ratio_') for c in team_cols]
-    # Calculate differences and ratios as DF.
-    diff_vals_df  = pd.DataFrame(np.array(games_df.ix[:,team_cols]) - np.array(games_df.ix[:,opponent_cols]),  columns=diff_col_names)
-    ratio_vals_df = pd.DataFrame(np.array(games_df.ix[:,team_cols]) / np.array(games_df.ix[:,opponent_cols]), columns=ratio_col_names)
-    # Append to game features.
-    games_df = pd.concat((games_df,diff_vals_df,ratio_vals_df),  axis=1)
+    with instrumentation.timer('recursive_merge'):
+        # Get team and opponent.
+        games_df = pd.concat((
+                teams_df[teams_df.team.isin(shuffled_bracket[:,0])].reset_index(drop=True),
+                opponents_df[opponents_df.opponent.isin(shuffled_bracket[:,1])].reset_index(drop=True)
+            ),
+            axis=1
+        )
+
+        # Calculate aggregate columns
+        # Get all team, opponent columns.
+        team_cols     = [c for c in games_df.columns if c.startswith('team_')]
+        opponent_cols = [c for c in games_df.columns if c.startswith('opponent_')]
+        # Calculate diff and ratio col names.
+        diff_col_names  = [c.replace('team_','diff_')  for c in team_cols]
+        ratio_col_names = [c.replace('team_','ratio_') for c in team_cols]
+        # Calculate differences and ratios as DF.
+        diff_vals_df  = pd.DataFrame(np.array(games_df.ix[:,team_cols]) - np.array(games_df.ix[:,opponent_cols]),  columns=diff_col_names)
+        ratio_vals_df = pd.DataFrame(np.array(games_df.ix[:,team_cols]) / np.array(games_df.ix[:,opponent_cols]), columns=ratio_col_names)
+        # Append to game features.
+        games_df = pd.concat((games_df,diff_vals_df,ratio_vals_df),  axis=1)
 
     ### Simulations
 
@@ -191,7 +694,10 @@ def simulate_bracket_coefs (bracket, teams_df, opponents_df, features, coefs, de
     if deterministic:
         winners_losers = y_hat.reshape((y_hat.shape[1],1))
     else:
-        game_outcomes  = sp.stats.binom.rvs(n=1, p=y_hat_raw.ravel())
+        # SciPy is imported here only, so scoring and the vectorized engine need NumPy alone.
+        import scipy as sp, scipy.stats
+        with instrumentation.timer('recursive_binom'):
+            game_outcomes  = sp.stats.binom.rvs(n=1, p=y_hat_raw.ravel())
         if type(game_outcomes) == int:
             game_outcomes = np.array(game_outcomes)
         winners_losers = game_outcomes.reshape((y_hat_raw.shape[1],1))
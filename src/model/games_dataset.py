@@ -0,0 +1,138 @@
+### Setup
+
+# Libraries.
+import json
+import numpy as np
+import os
+
+# Default partition directory written by generate_game_data.py.
+games_partition_path = '../../../data/games/'
+
+### Main Functionality
+
+def seasons (path=games_partition_path):
+    """
+    Sorted list of seasons available in a games partition directory.
+    """
+    with open(os.path.join(path, 'manifest.json')) as f:
+        return sorted(int(y) for y in json.load(f))
+
+def load_games (seasons=None, columns=None, path=games_partition_path):
+    """
+    Loads games from the per-season partitions written by generate_game_data.py. Only the requested seasons' files are opened
+    and only the requested columns are read from them.
+    Inputs:
+        seasons: List of seasons (e.g. [2014, 2015]). Default: all seasons.
+        columns: List of columns to load (e.g. ['game_group','win','diff_Pythag']). Default: all columns.
+        path:    Partition directory.
+    Returns:
+        Data frame of games in the same layout as games.csv, restricted to 'columns'.
+    Raises KeyError for seasons or columns not in the dataset.
+    """
+    with open(os.path.join(path, 'manifest.json')) as f:
+        manifest = json.load(f)
+    if seasons is None:
+        seasons = sorted(int(y) for y in manifest)
+    missing = [y for y in seasons if str(y) not in manifest]
+    if len(missing) > 0:
+        raise KeyError('Seasons not in games dataset: %s' % ', '.join(str(y) for y in missing))
+    if columns is not None:
+        missing = sorted(set(c for y in seasons for c in columns if c not in manifest[str(y)]['columns']))
+        if len(missing) > 0:
+            raise KeyError('Columns not in games dataset: %s' % ', '.join(missing))
+
+    import pandas as pd
+    frames = []
+    for y in seasons:
+        with np.load(os.path.join(path, manifest[str(y)]['file'])) as season:
+            all_columns = list(season['__columns__'])
+            season_columns = all_columns if columns is None else list(columns)
+            frames.append(pd.DataFrame(dict((c, season[c]) for c in season_columns), columns=season_columns))
+    return pd.concat(frames, ignore_index=True)
+
+### Matchups
+
+# Location dummies that trade places when a game is seen from the other team's side.
+mirrored_locations = {
+    'location_Home':     'location_Away',
+    'location_Away':     'location_Home',
+    'location_SemiHome': 'location_SemiAway',
+    'location_SemiAway': 'location_SemiHome'
+}
+
+# Game properties shared by both teams.
+shared_columns = ['year', 'conference', 'conference_tournament', 'ncaa_tournament', 'other_tournament', 'location_Neutral']
+
+def canonical_games (data):
+    """
+    One row per game: generate_game_data.py writes every game from both teams' sides, with game_group 1 on one side chosen
+    at random, so keeping those rows gives each game once in a random orientation. Games listed only once are kept as is.
+    Inputs:
+        data: Data frame of games with game_id and game_group columns.
+    Returns:
+        Data frame of games with a fresh sequential index.
+    """
+    first = np.array(data.game_group == 1)
+    keep = first | ~np.array(data.game_id.isin(data.game_id[first]))
+    canonical = data[keep]
+    return canonical[~np.array(canonical.game_id.duplicated())].reset_index(drop=True)
+
+def mirror_features (data, features):
+    """
+    Features of each game as seen from the opponent's side: team_ and opponent_ statistics and home and away locations
+    trade places, diff_ features and the location_HomeAway columns change sign, ratio_ features are inverted and shared
+    game properties are unchanged.
+    Inputs:
+        data:     Data frame of games.
+        features: List of features in data.
+    Returns:
+        Data frame of the mirrored features, with the same index and columns as data[features].
+    """
+    import pandas as pd
+    mirrored = pd.DataFrame(index=data.index)
+    for f in features:
+        if f.startswith('diff_') or f in ('location_HomeAway', 'location_SemiHomeAway'):
+            mirrored[f] = -data[f]
+        elif f.startswith('ratio_'):
+            mirrored[f] = 1. / data[f]
+        elif mirror_name(f) is not None:
+            other = mirror_name(f)
+            if other not in data:
+                raise ValueError('Cannot mirror %s without %s.' % (f, other))
+            mirrored[f] = data[other]
+        elif f in shared_columns:
+            mirrored[f] = data[f]
+        else:
+            raise ValueError('Cannot mirror feature %s.' % f)
+    return mirrored
+
+def mirror_name (feature):
+    """
+    Column that trades places with 'feature' when a game is seen from the other side (team_X and opponent_X, location_Home
+    and location_Away, ...); None for other features.
+    """
+    if feature in mirrored_locations:
+        return mirrored_locations[feature]
+    if feature.startswith('team_'):
+        return 'opponent_'+feature[len('team_'):]
+    if feature.startswith('opponent_'):
+        return 'team_'+feature[len('opponent_'):]
+    return None
+
+def antisymmetric_features (features):
+    """
+    Positions of the features that get their own column in the symmetric matchup model. A feature and its mirror image have
+    antisymmetric parts of opposite sign, so of each such pair only the first listed is kept and its column stands for
+    both. Shared game properties have no antisymmetric part and are rejected.
+    Inputs:
+        features: List of features.
+    Returns:
+        List of positions in 'features'.
+    """
+    keep = []
+    for i, f in enumerate(features):
+        if f in shared_columns:
+            raise ValueError('Shared game property %s has no antisymmetric part; leave it out of the symmetric model.' % f)
+        if mirror_name(f) not in features[:i]:
+            keep.append(i)
+    return keep
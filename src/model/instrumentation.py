@@ -0,0 +1,161 @@
+### Setup
+
+# Libraries.
+import atexit
+import json
+import os
+import threading
+import time
+
+# Recording is off unless enabled, here or by setting BAYESKET_METRICS to an output file (see enable_from_environment).
+enabled = False
+
+# Recorded metrics, keyed by (name, sorted label pairs).
+timers = {}
+counters = {}
+gauges = {}
+lock = threading.Lock()
+
+### Recording
+
+class Timer (object):
+    """
+    Context manager adding the elapsed wall time of its block to a named timer.
+    """
+
+    def __init__ (self, name, labels):
+        self.key = (name, tuple(sorted(labels.items())))
+
+    def __enter__ (self):
+        self.start = time.time()
+        return self
+
+    def __exit__ (self, *exc_info):
+        elapsed = time.time() - self.start
+        with lock:
+            entry = timers.setdefault(self.key, [0, 0.])
+            entry[0] += 1
+            entry[1] += elapsed
+        return False
+
+class NullTimer (object):
+    """
+    Timer used while recording is disabled: does nothing.
+    """
+
+    def __enter__ (self):
+        return self
+
+    def __exit__ (self, *exc_info):
+        return False
+
+null_timer = NullTimer()
+
+def timer (name, **labels):
+    """
+    Times a block: with instrumentation.timer('simulate_round', round='1'): ...
+    Label values should be strings.
+    """
+    if not enabled:
+        return null_timer
+    return Timer(name, labels)
+
+def count (name, value=1, **labels):
+    """
+    Adds 'value' to a counter.
+    """
+    if not enabled:
+        return
+    key = (name, tuple(sorted(labels.items())))
+    with lock:
+        counters[key] = counters.get(key, 0) + value
+
+def gauge (name, value, **labels):
+    """
+    Sets a gauge to its latest value.
+    """
+    if not enabled:
+        return
+    with lock:
+        gauges[(name, tuple(sorted(labels.items())))] = value
+
+def enable ():
+    global enabled
+    enabled = True
+
+def disable ():
+    global enabled
+    enabled = False
+
+def reset ():
+    with lock:
+        timers.clear()
+        counters.clear()
+        gauges.clear()
+
+### Export
+
+def records ():
+    """
+    List of metric dictionaries (type, name, labels and values), e.g. for a structured log.
+    """
+    with lock:
+        out = [{'type':'timer', 'name':n, 'labels':dict(l), 'calls':v[0], 'seconds':v[1]} for (n, l), v in timers.items()]
+        out += [{'type':'counter', 'name':n, 'labels':dict(l), 'value':v} for (n, l), v in counters.items()]
+        out += [{'type':'gauge', 'name':n, 'labels':dict(l), 'value':v} for (n, l), v in gauges.items()]
+    return sorted(out, key=lambda r: (r['type'], r['name'], sorted(r['labels'].items())))
+
+def prometheus_text (prefix='bayesket_'):
+    """
+    Metrics in the Prometheus text exposition format. Timers become <name>_seconds_total and <name>_calls_total counters.
+    """
+    def label_text (labels):
+        if len(labels) == 0:
+            return ''
+        return '{'+','.join('%s="%s"' % (k, str(v).replace('\\','\\\\').replace('"','\\"')) for k, v in sorted(labels.items()))+'}'
+
+    # Samples grouped by metric, each group under its TYPE line.
+    metrics = {}
+    def add (name, kind, labels, value):
+        metrics.setdefault(name, (kind, []))[1].append('%s%s %r' % (name, label_text(labels), float(value)))
+
+    for r in records():
+        name = prefix+r['name']
+        if r['type'] == 'timer':
+            add(name+'_seconds_total', 'counter', r['labels'], r['seconds'])
+            add(name+'_calls_total', 'counter', r['labels'], r['calls'])
+        elif r['type'] == 'counter':
+            add(name+'_total', 'counter', r['labels'], r['value'])
+        else:
+            add(name, 'gauge', r['labels'], r['value'])
+    lines = []
+    for name in sorted(metrics):
+        kind, samples = metrics[name]
+        lines.append('# TYPE %s %s' % (name, kind))
+        lines.extend(samples)
+    return '\n'.join(lines)+'\n'
+
+def write (path):
+    """
+    Writes the metrics to 'path': Prometheus text if it ends in .prom, else one JSON record per line.
+    Metrics from worker processes are not included; each process records its own.
+    """
+    if path.endswith('.prom'):
+        text = prometheus_text()
+    else:
+        stamp = time.time()
+        text = ''.join(json.dumps(dict(r, time=stamp, pid=os.getpid()))+'\n' for r in records())
+    with open(path+'.tmp', 'w') as f:
+        f.write(text)
+    os.rename(path+'.tmp', path)
+
+def enable_from_environment ():
+    """
+    Enables recording if BAYESKET_METRICS names an output file, and writes the metrics there when the process exits.
+    """
+    path = os.environ.get('BAYESKET_METRICS')
+    if path:
+        enable()
+        atexit.register(write, path)
+
+enable_from_environment()
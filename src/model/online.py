@@ -0,0 +1,178 @@
+### Setup
+
+# Libraries.
+import numpy as np
+
+# Custom library
+import approximations
+import samplers
+
+### Posteriors
+
+class GaussianPriorPosterior (samplers.LogisticPosterior):
+    """
+    Log posterior of new games with a full multivariate normal prior, i.e. a previous posterior summarized as a Gaussian.
+    Works with samplers.posterior_mode and the step methods like LogisticPosterior. The prior covariance must be nonsingular,
+    so coefficients fixed in the symmetric matchup model are left out of X and the prior (see free_columns).
+    """
+
+    def __init__ (self, X, y, prior_mean, prior_cov):
+        """
+        Inputs:
+            X:          Design matrix of the new games; the first column is the intercept.
+            y:          Array of 0/1 outcomes of the new games.
+            prior_mean: Previous posterior mean, intercept first.
+            prior_cov:  Previous posterior covariance matrix.
+        """
+        precision = np.linalg.inv(np.asarray(prior_cov, dtype=np.float64))
+        samplers.LogisticPosterior.__init__(self, X, y, prior_mean, np.diag(precision))
+        self.precision = precision
+
+    def log_prior (self, b):
+        d = b - self.prior_mu
+        return -.5*(d.dot(self.precision)*d).sum(axis=-1)
+
+    def log_prior_grad (self, b):
+        return -(b-self.prior_mu).dot(self.precision)
+
+    def prior_precision (self):
+        return self.precision
+
+class ParticlePosterior (object):
+    """
+    Weighted coefficient draws (particles) standing for a posterior. sample() returns an unweighted coefficient array in the
+    layout of bayes_lr.feature_coefficients, which predict_games and simulate_tournament take as 'coefs'/'coef_trace'.
+    """
+
+    def __init__ (self, particles, log_weights=None, symmetric=False):
+        """
+        Inputs:
+            particles:   Numpy array of coefficient draws; rows are draws, columns are coefficients starting with the intercept.
+            log_weights: Unnormalized log weights of the draws. Default: equal weights.
+            symmetric:   Whether the draws are of the symmetric matchup model, whose fixed coefficients are zero in every draw
+                         (see approximations.GaussianApproximation).
+        """
+        self.particles = np.array(particles, dtype=np.float64)
+        self.log_weights = np.zeros(len(self.particles)) if log_weights is None else np.array(log_weights, dtype=np.float64)
+        self.symmetric = symmetric
+
+    def __len__ (self):
+        return len(self.particles)
+
+    def weights (self):
+        w = np.exp(self.log_weights - self.log_weights.max())
+        return w / w.sum()
+
+    def ess (self):
+        """
+        Effective number of particles, 1/sum(w^2).
+        """
+        return 1. / (self.weights()**2).sum()
+
+    def mean (self):
+        return self.weights().dot(self.particles)
+
+    def cov (self):
+        d = self.particles - self.mean()
+        return (d.T*self.weights()).dot(d)
+
+    def gaussian (self):
+        """
+        Moment-matched approximations.GaussianApproximation.
+        """
+        return approximations.GaussianApproximation(self.mean(), self.cov(), self.symmetric)
+
+    def resample (self, rng=np.random):
+        """
+        Systematic resampling to equal weights, in place.
+        """
+        n = len(self)
+        positions = (rng.random_sample() + np.arange(n)) / n
+        idx = np.minimum(np.searchsorted(np.cumsum(self.weights()), positions), n-1)
+        self.particles = self.particles[idx]
+        self.log_weights = np.zeros(n)
+
+    def sample (self, draws=None, seed=None):
+        """
+        Numpy array of 'draws' equally weighted coefficient samples (default: as many as there are particles).
+        """
+        rng = np.random.RandomState(seed)
+        draws = len(self) if draws is None else draws
+        return self.particles[rng.choice(len(self), size=draws, p=self.weights())]
+
+### Main Functionality
+
+def free_columns (previous, X):
+    """
+    Positions of the coefficients of a Gaussian previous posterior that are not fixed (see
+    approximations.GaussianApproximation.free_columns). Fixed coefficients must have a zero column in the new games' design.
+    """
+    free = previous.free_columns()
+    fixed = np.setdiff1d(np.arange(X.shape[1]), free)
+    if np.any(X[:,fixed] != 0):
+        raise ValueError('Design has values for coefficients fixed in the previous posterior; build it with symmetric=%s.' % previous.symmetric)
+    return free
+
+def assumed_density_update (previous, X, y):
+    """
+    Assumed-density filtering: folds new games into a Gaussian posterior by taking the Laplace approximation of
+    (previous Gaussian) x (likelihood of the new games). Costs a few Newton steps over the new games only.
+    Inputs:
+        previous: approximations.GaussianApproximation (or a ParticlePosterior, which is moment matched).
+        X:        Design matrix of the new games; the first column is the intercept (zero in the symmetric model).
+        y:        Array of 0/1 outcomes of the new games.
+    Returns:
+        approximations.GaussianApproximation object. Coefficients fixed in the symmetric model stay fixed.
+    """
+    if isinstance(previous, ParticlePosterior):
+        previous = previous.gaussian()
+    free = free_columns(previous, X)
+    posterior = GaussianPriorPosterior(X[:,free], y, previous.mean[free], previous.cov[np.ix_(free,free)])
+    mode, cov = samplers.posterior_mode(posterior, init=previous.mean[free])
+    mode, cov = approximations.full_layout(free, len(previous.mean), mode, cov)
+    return approximations.GaussianApproximation(mode, cov, previous.symmetric)
+
+def smc_update (previous, X, y, ess_threshold=.5, rejuvenate_steps=5, seed=None):
+    """
+    Sequential Monte Carlo update: reweights the previous particles by the likelihood of the new games. If the effective
+    sample size drops below 'ess_threshold' times the number of particles, they are resampled and rejuvenated by random-walk
+    Metropolis moves (all particles at once). The moves target the new games' likelihood times a Gaussian fit of the
+    previous particles, so no step touches the old games; cost scales with (new games) x (particles).
+    Inputs:
+        previous:         ParticlePosterior, or a coefficient array (e.g. from bayes_lr.feature_coefficients).
+        X:                Design matrix of the new games; the first column is the intercept (zero in the symmetric model).
+        y:                Array of 0/1 outcomes of the new games.
+        ess_threshold:    Resampling threshold as a fraction of the number of particles.
+        rejuvenate_steps: Metropolis moves per particle after resampling.
+        seed:             Seed for resampling and moves.
+    Returns:
+        ParticlePosterior object. Coefficients fixed in the symmetric model are not moved.
+    """
+    rng = np.random.RandomState(seed)
+    if not isinstance(previous, ParticlePosterior):
+        previous = ParticlePosterior(previous)
+    fit = previous.gaussian()
+    free = free_columns(fit, X)
+    posterior = GaussianPriorPosterior(X[:,free], y, fit.mean[free], fit.cov[np.ix_(free,free)])
+
+    # Reweight.
+    S = posterior.X.dot(previous.particles[:,free].T)
+    loglik = (posterior.y[:,None]*S - np.logaddexp(0, S)).sum(axis=0)
+    updated = ParticlePosterior(previous.particles, previous.log_weights + loglik, previous.symmetric)
+    if updated.ess() >= ess_threshold*len(updated):
+        return updated
+
+    # Resample and rejuvenate the free coefficients.
+    updated.resample(rng)
+    B = updated.particles[:,free]
+    dims = B.shape[1]
+    chol = np.linalg.cholesky(updated.cov()[np.ix_(free,free)]*2.38**2/dims + 1e-12*np.eye(dims))
+    logp = posterior.log_prob_batch(B)
+    for _i in range(rejuvenate_steps):
+        proposal = B + rng.standard_normal(B.shape).dot(chol.T)
+        proposal_logp = posterior.log_prob_batch(proposal)
+        accept = np.log(rng.random_sample(len(B))) < proposal_logp - logp
+        B[accept] = proposal[accept]
+        logp[accept] = proposal_logp[accept]
+    updated.particles[:,free] = B
+    return updated
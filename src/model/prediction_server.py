@@ -0,0 +1,337 @@
+### Setup
+
+# Libraries.
+import argparse
+import json
+import numpy as np
+import os
+import socket
+import sys
+import time
+
+# HTTP server and client; module names differ between Python 2 and 3.
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from http.client import HTTPConnection
+    from socketserver import ThreadingMixIn, UnixStreamServer
+    from urllib.parse import urlparse, parse_qs
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from httplib import HTTPConnection
+    from SocketServer import ThreadingMixIn, UnixStreamServer
+    from urlparse import urlparse, parse_qs
+
+# Custom library
+import game_predictions
+import trace_store
+
+# Values of the location features for each query location; features not listed are 0. 'mirror' is the same game from the
+# opponent's side.
+query_locations = {
+    'neutral':   {'location_Neutral':1},
+    'home':      {'location_Home':1, 'location_HomeAway':1},
+    'away':      {'location_Away':1, 'location_HomeAway':-1},
+    'semi-home': {'location_SemiHome':1, 'location_SemiHomeAway':1},
+    'semi-away': {'location_SemiAway':1, 'location_SemiHomeAway':-1}
+}
+mirror_locations = {'neutral':'neutral', 'home':'away', 'away':'home', 'semi-home':'semi-away', 'semi-away':'semi-home'}
+
+### Predictions
+
+class MatchupPredictor (object):
+    """
+    Posterior win probabilities for arbitrary matchups, with the coefficient trace and every team's statistics held in memory.
+    A batch of queries is one design matrix and one matrix product against the trace.
+    """
+
+    def __init__ (self, coef_trace, team_stats, features, interval=.95, symmetric=False):
+        """
+        Inputs:
+            coef_trace: Numpy array of coefficients; one row per draw, intercept first.
+            team_stats: Dataframe with team statistics, keyed by 'TeamName'.
+            features:   List of features the coefficients were fit on: diff_, ratio_, team_ and opponent_ statistics and
+                        location_ dummies.
+            interval:   Width of the central credible interval reported for each win probability.
+            symmetric:  True for coefficients from bayes_lr.model_games(symmetric=True).
+        """
+        self.features  = list(features)
+        self.interval  = interval
+        self.symmetric = symmetric
+        # Transposed trace: a batch's linear predictors are design.dot(coefs_t), games x draws.
+        self.coefs_t = np.ascontiguousarray(np.atleast_2d(coef_trace).T, dtype=np.float64)
+
+        # Team statistics needed for the features, one row per team.
+        self.teams = list(team_stats.TeamName)
+        self.team_index = dict((t, i) for i, t in enumerate(self.teams))
+        self.stats, self.spec = game_predictions.team_feature_matrix(self.teams, team_stats, self.features)
+
+        # Location feature values per query location.
+        self.locations = sorted(query_locations)
+        self.location_columns = np.array([k+1 for k, f in enumerate(self.features) if f.startswith('location_')], dtype=np.int64)
+        self.location_values = np.array([[query_locations[l].get(self.features[k-1], 0) for k in self.location_columns] for l in self.locations],
+                                        dtype=np.float64).reshape((len(self.locations),len(self.location_columns)))
+        self.location_mirrors = np.array([self.locations.index(mirror_locations[l]) for l in self.locations])
+
+    def __len__ (self):
+        return self.coefs_t.shape[1]
+
+    def design (self, team, opponent, location):
+        """
+        Design matrix for arrays of team rows, opponent rows and location positions.
+        """
+        X = game_predictions.matchup_design(self.stats, self.spec, team, opponent)
+        if len(self.location_columns) > 0:
+            X[:,self.location_columns] = self.location_values[location]
+        return X
+
+    def predict (self, matchups):
+        """
+        Inputs:
+            matchups: List of (team, opponent, location) tuples; location is one of query_locations (e.g. 'neutral').
+        Returns:
+            List of dictionaries with the matchup, the posterior mean probability that the team wins ('win_probability')
+            and its credible interval ('interval').
+        Raises KeyError for unknown teams and ValueError for unknown locations.
+        """
+        missing = sorted(set(t for m in matchups for t in m[:2] if t not in self.team_index))
+        if len(missing) > 0:
+            raise KeyError('Unknown teams: %s' % ', '.join(missing))
+        bad_locations = sorted(set(m[2] for m in matchups if m[2] not in query_locations))
+        if len(bad_locations) > 0:
+            raise ValueError('Unknown locations: %s' % ', '.join(bad_locations))
+
+        team     = np.array([self.team_index[m[0]] for m in matchups], dtype=np.int64)
+        opponent = np.array([self.team_index[m[1]] for m in matchups], dtype=np.int64)
+        location = np.array([self.locations.index(m[2]) for m in matchups], dtype=np.int64)
+        X = self.design(team, opponent, location)
+        if self.symmetric:
+            # Antisymmetric part of the design, as game_predictions.design_matrix(symmetric=True).
+            X = (X - self.design(opponent, team, self.location_mirrors[location])) / 2
+
+        # Linear predictors, games x draws. The logistic function is monotone, so quantiles can be taken on them.
+        s = X.dot(self.coefs_t)
+        mean = game_predictions.logistic(s).mean(axis=1)
+        bounds = game_predictions.logistic(np.percentile(s, [50*(1-self.interval), 50*(1+self.interval)], axis=1).T)
+        return [{
+                'team': m[0], 'opponent': m[1], 'location': m[2],
+                'win_probability': float(mean[g]),
+                'interval': [float(bounds[g,0]), float(bounds[g,1])]
+            } for g, m in enumerate(matchups)]
+
+def load_predictor (trace_path, team_stats_path, features=None, max_draws=None, interval=.95, symmetric=False):
+    """
+    Builds a MatchupPredictor from files.
+    Inputs:
+        trace_path:      Trace store directory (see trace_store.write_traces) or .npy coefficient array.
+        team_stats_path: CSV of team statistics with a 'TeamName' column, e.g. a KenPom summary.
+        features:        List of features. Default: the trace store's features; required for .npy arrays.
+        max_draws:       Keep at most this many draws, evenly thinned, to bound query time.
+        interval, symmetric: As in MatchupPredictor.
+    Returns:
+        MatchupPredictor.
+    """
+    if os.path.isdir(trace_path):
+        store = trace_store.TraceStore(trace_path)
+        features = store.features if features is None else features
+        coef_trace = np.array(store.coefficients(features))
+    else:
+        if features is None:
+            raise ValueError('Features are required for coefficient arrays.')
+        coef_trace = np.load(trace_path)
+    if max_draws is not None and len(coef_trace) > max_draws:
+        coef_trace = coef_trace[np.linspace(0, len(coef_trace)-1, max_draws).astype(np.int64)]
+    import pandas as pd
+    return MatchupPredictor(coef_trace, pd.read_csv(team_stats_path), features, interval, symmetric)
+
+### Server
+
+class PredictionHandler (BaseHTTPRequestHandler):
+    """
+    HTTP interface to a MatchupPredictor (the server's 'predictor'). Connections are kept alive between requests.
+        GET  /health                                         Draws, features and teams loaded.
+        GET  /teams                                          Team names.
+        GET  /predict?team=A&opponent=B&location=neutral     One matchup; location defaults to neutral.
+        POST /predict  {"matchups": [{"team": A, "opponent": B, "location": "home"}, ...]}
+                                                             Batch of matchups; also accepts [[A, B, location], ...].
+    Responses are JSON. Unknown teams and locations get 400 responses with an 'error' entry.
+    """
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET (self):
+        url = urlparse(self.path)
+        predictor = self.server.predictor
+        if url.path == '/health':
+            self.respond(200, {'draws': len(predictor), 'features': predictor.features, 'teams': len(predictor.teams)})
+        elif url.path == '/teams':
+            self.respond(200, {'teams': predictor.teams})
+        elif url.path == '/predict':
+            query = parse_qs(url.query)
+            if 'team' not in query or 'opponent' not in query:
+                self.respond(400, {'error': 'team and opponent are required.'})
+                return
+            self.predict([(query['team'][0], query['opponent'][0], query.get('location', ['neutral'])[0])], single=True)
+        else:
+            self.respond(404, {'error': 'Not found: %s' % url.path})
+
+    def do_POST (self):
+        if urlparse(self.path).path != '/predict':
+            self.respond(404, {'error': 'Not found: %s' % self.path})
+            return
+        try:
+            body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))).decode('utf-8'))
+            matchups = [(m['team'], m['opponent'], m.get('location', 'neutral')) if isinstance(m, dict) else
+                        (m[0], m[1], m[2] if len(m) > 2 else 'neutral') for m in body['matchups']]
+        except (ValueError, KeyError, IndexError, TypeError):
+            self.respond(400, {'error': 'Expected {"matchups": [{"team": ..., "opponent": ..., "location": ...}, ...]}.'})
+            return
+        self.predict(matchups, single=False)
+
+    def predict (self, matchups, single):
+        try:
+            predictions = self.server.predictor.predict(matchups) if len(matchups) > 0 else []
+        except (KeyError, ValueError) as e:
+            self.respond(400, {'error': str(e.args[0])})
+            return
+        self.respond(200, predictions[0] if single else {'predictions': predictions})
+
+    def respond (self, status, body):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message (self, format, *args):
+        # Quiet: requests are frequent and latency matters.
+        pass
+
+class ThreadingHTTPServer (ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def get_request (self):
+        # Send small responses immediately rather than waiting on the client's delayed acknowledgements.
+        request, address = HTTPServer.get_request(self)
+        request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return request, address
+
+class ThreadingUnixHTTPServer (ThreadingMixIn, UnixStreamServer):
+    daemon_threads = True
+
+    def server_bind (self):
+        # Replace a stale socket file from an earlier run.
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)
+        UnixStreamServer.server_bind(self)
+
+    def get_request (self):
+        # BaseHTTPRequestHandler expects an address tuple.
+        request, _address = UnixStreamServer.get_request(self)
+        return request, ('unix', 0)
+
+def make_server (predictor, host='127.0.0.1', port=8765, socket_path=None):
+    """
+    HTTP server for a MatchupPredictor on a TCP port, or on a Unix socket if 'socket_path' is given.
+    Call serve_forever() to run it (e.g. in a thread) and shutdown() to stop it.
+    """
+    if socket_path is not None:
+        server = ThreadingUnixHTTPServer(socket_path, PredictionHandler)
+    else:
+        server = ThreadingHTTPServer((host, port), PredictionHandler)
+    server.predictor = predictor
+    return server
+
+### Client
+
+class UnixHTTPConnection (HTTPConnection):
+    """
+    HTTP connection over a Unix socket.
+    """
+
+    def __init__ (self, socket_path, timeout=60):
+        HTTPConnection.__init__(self, 'localhost', timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect (self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+class PredictionClient (object):
+    """
+    Client for a prediction server over one persistent connection, on a TCP port or a Unix socket. Not thread-safe; use one
+    client per thread.
+    """
+
+    def __init__ (self, host='127.0.0.1', port=8765, socket_path=None, timeout=60):
+        if socket_path is not None:
+            self.connection = UnixHTTPConnection(socket_path, timeout)
+        else:
+            self.connection = HTTPConnection(host, port, timeout=timeout)
+
+    def request (self, method, path, body=None):
+        """
+        Sends a request and returns the decoded JSON response. Raises ValueError with the server's message on errors.
+        """
+        data = None if body is None else json.dumps(body)
+        headers = {} if body is None else {'Content-Type': 'application/json'}
+        self.connection.request(method, path, data, headers)
+        response = self.connection.getresponse()
+        result = json.loads(response.read().decode('utf-8'))
+        if response.status != 200:
+            raise ValueError(result.get('error', 'HTTP %d' % response.status))
+        return result
+
+    def health (self):
+        return self.request('GET', '/health')
+
+    def predict (self, team, opponent, location='neutral'):
+        """
+        Posterior win probability and interval for one matchup.
+        """
+        return self.request('POST', '/predict', {'matchups': [[team, opponent, location]]})['predictions'][0]
+
+    def predict_many (self, matchups):
+        """
+        Predictions for a list of (team, opponent[, location]) tuples in one request.
+        """
+        return self.request('POST', '/predict', {'matchups': [list(m) for m in matchups]})['predictions']
+
+    def close (self):
+        self.connection.close()
+
+### Main Execution
+
+def main (argv=None):
+    if argv is None:
+        argv = sys.argv
+
+    parser = argparse.ArgumentParser(description='Serve posterior matchup win probabilities over HTTP.')
+    parser.add_argument('trace', help='Trace store directory or .npy coefficient array (intercept first).')
+    parser.add_argument('team_stats', help='CSV of team statistics with a TeamName column, e.g. a KenPom summary.')
+    parser.add_argument('--features', help='Comma-separated features. Default: the trace store\'s.')
+    parser.add_argument('--max-draws', type=int, default=None, help='Thin the trace to at most this many draws.')
+    parser.add_argument('--interval', type=float, default=.95, help='Width of the reported credible intervals.')
+    parser.add_argument('--symmetric', action='store_true', help='Coefficients are from the symmetric matchup model.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--socket', help='Listen on this Unix socket instead of a TCP port.')
+    args = parser.parse_args(argv[1:])
+
+    start = time.time()
+    features = None if args.features is None else args.features.split(',')
+    predictor = load_predictor(args.trace, args.team_stats, features, args.max_draws, args.interval, args.symmetric)
+    server = make_server(predictor, args.host, args.port, args.socket)
+    print('Loaded %d draws and %d teams in %.2fs; listening on %s.' % (
+        len(predictor), len(predictor.teams), time.time()-start, args.socket or '%s:%d' % (args.host, args.port)))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,595 @@
+### Setup
+
+# Libraries.
+import numpy as np
+
+# Custom library
+import instrumentation
+
+### Posterior
+
+class LogisticPosterior (object):
+    """
+    Log posterior of the Bayesian logistic regression in bayes_lr.model_games: independent normal priors on the intercept and
+    coefficients and a Bernoulli likelihood for wins. Each evaluation is a single matrix-vector product over the games.
+    """
+
+    def __init__ (self, X, y, prior_mu, prior_tau):
+        """
+        Inputs:
+            X:         Design matrix; the first column is the intercept.
+            y:         Array of 0/1 outcomes.
+            prior_mu:  Prior means, one per column of X.
+            prior_tau: Prior precisions (inverse variances), one per column of X.
+        """
+        self.X         = np.ascontiguousarray(X, dtype=np.float64)
+        self.y         = np.asarray(y, dtype=np.float64)
+        self.prior_mu  = np.asarray(prior_mu, dtype=np.float64)
+        self.prior_tau = np.asarray(prior_tau, dtype=np.float64)
+        # Number of likelihood evaluations so far.
+        self.evals = 0
+
+    def log_likelihood_linear (self, s):
+        """
+        Bernoulli log likelihood given the linear predictor for every game.
+        """
+        return (self.y*s - np.logaddexp(0, s)).sum()
+
+    def log_prior (self, b):
+        """
+        Log prior density (up to a constant) at 'b', or at each row of 'b'.
+        """
+        return -.5*(self.prior_tau*(b-self.prior_mu)**2).sum(axis=-1)
+
+    def log_prior_grad (self, b):
+        return -self.prior_tau*(b-self.prior_mu)
+
+    def prior_precision (self):
+        return np.diag(self.prior_tau)
+
+    def log_prob (self, b):
+        """
+        Unnormalized log posterior at coefficients 'b'.
+        """
+        self.evals += 1
+        return self.log_likelihood_linear(self.X.dot(b)) + self.log_prior(b)
+
+    def log_prob_batch (self, B):
+        """
+        Unnormalized log posterior at each row of 'B' (one matrix product for all rows).
+        """
+        self.evals += len(B)
+        S = self.X.dot(B.T)
+        return (self.y[:,None]*S - np.logaddexp(0, S)).sum(axis=0) + self.log_prior(B)
+
+    def log_prob_grad (self, b):
+        """
+        Unnormalized log posterior and its gradient at coefficients 'b'.
+        """
+        self.evals += 1
+        s = self.X.dot(b)
+        # Numerically stable logistic function.
+        p = .5*(1+np.tanh(.5*s))
+        grad = self.X.T.dot(self.y-p) + self.log_prior_grad(b)
+        return self.log_likelihood_linear(s) + self.log_prior(b), grad
+
+    def grad_batch (self, B):
+        """
+        Log posterior gradients at each row of 'B' (one matrix product for all rows).
+        """
+        self.evals += len(B)
+        P = .5*(1+np.tanh(.5*self.X.dot(B.T)))
+        return self.X.T.dot(self.y[:,None]-P).T + self.log_prior_grad(B)
+
+    def hessian (self, b):
+        """
+        Hessian of the log posterior at coefficients 'b'.
+        """
+        p = .5*(1+np.tanh(.5*self.X.dot(b)))
+        return -(self.X.T*(p*(1-p))).dot(self.X) - self.prior_precision()
+
+def posterior_mode (posterior, init=None, max_iter=100, tol=1e-8):
+    """
+    Posterior mode by Newton's method (iteratively reweighted least squares with the prior as a ridge penalty).
+    The log posterior is concave, so Newton steps converge quickly; steps are halved if they fail to increase it.
+    Inputs:
+        posterior: LogisticPosterior.
+        init:      Starting coefficients. Default: prior means.
+        max_iter:  Maximum number of Newton steps.
+        tol:       Convergence tolerance on the largest coefficient change.
+    Returns:
+        Mode coefficients.
+        Covariance of the Laplace approximation at the mode (inverse negative Hessian).
+    """
+    b = np.array(posterior.prior_mu if init is None else init, dtype=np.float64)
+    logp, grad = posterior.log_prob_grad(b)
+    for _i in range(max_iter):
+        step = np.linalg.solve(-posterior.hessian(b), grad)
+        # Backtrack if needed.
+        for _j in range(30):
+            new_logp, new_grad = posterior.log_prob_grad(b+step)
+            if new_logp >= logp or not np.isfinite(logp):
+                break
+            step *= .5
+        b, logp, grad = b+step, new_logp, new_grad
+        if np.abs(step).max() < tol:
+            break
+    return b, np.linalg.inv(-posterior.hessian(b))
+
+### Step Methods
+
+class MetropolisStep (object):
+    """
+    Random-walk Metropolis over the whole coefficient vector. During burn-in the proposal takes the shape of the chain's
+    empirical covariance (scaled by 2.38^2/dimensions) and its scale follows the acceptance rate, as pymc.Metropolis tunes proposal_sd.
+    """
+
+    def __init__ (self, posterior, proposal_sd, rng):
+        self.posterior = posterior
+        self.rng = rng
+        dims = posterior.X.shape[1]
+        self.shape_chol = np.eye(dims) * np.broadcast_to(np.asarray(proposal_sd, dtype=np.float64), (dims,))
+        self.scale = 1.
+        self.proposal_chol = self.shape_chol
+        # Acceptance since the last tuning.
+        self.window_accepted = 0
+        self.window_steps = 0
+
+    def step (self, b, logp):
+        """
+        One update. Returns the new coefficients, their log posterior and whether the proposal was accepted.
+        """
+        proposal = b + self.proposal_chol.dot(self.rng.standard_normal(len(b)))
+        proposal_logp = self.posterior.log_prob(proposal)
+        self.window_steps += 1
+        if np.log(self.rng.random_sample()) < proposal_logp - logp:
+            self.window_accepted += 1
+            return proposal, proposal_logp, True
+        return b, logp, False
+
+    def tune (self, samples):
+        """
+        Adapts the proposal to the samples drawn so far.
+        """
+        # Scale by acceptance rate, following pymc's tuning table.
+        rate = self.window_accepted / float(max(self.window_steps,1))
+        self.window_accepted = 0
+        self.window_steps = 0
+        for threshold, factor in ((.001, .1), (.05, .5), (.2, .9)):
+            if rate < threshold:
+                self.scale *= factor
+                break
+        else:
+            for threshold, factor in ((.95, 10.), (.75, 2.), (.5, 1.1)):
+                if rate > threshold:
+                    self.scale *= factor
+                    break
+        # Shape from the empirical covariance, once the chain has moved enough to estimate it.
+        if len(samples) >= 2*samples.shape[1]:
+            cov = np.cov(samples, rowvar=False) * 2.38**2/samples.shape[1]
+            if np.all(np.diag(cov) > 0):
+                self.shape_chol = np.linalg.cholesky(cov + 1e-10*np.eye(samples.shape[1]))
+                self.scale = 1. if .2 <= rate <= .5 else self.scale
+        self.proposal_chol = self.scale*self.shape_chol
+
+class SliceStep (object):
+    """
+    Slice sampling along a random direction through the whole coefficient vector (hit-and-run slice sampling), with stepping out
+    and shrinkage. Directions are drawn from the chain's empirical covariance once tuned. Points along a line only need the
+    linear predictor updated, so each extra evaluation costs one pass over the games rather than a matrix-vector product.
+    """
+
+    def __init__ (self, posterior, width, rng, max_steps=50):
+        self.posterior = posterior
+        self.rng = rng
+        self.max_steps = max_steps
+        dims = posterior.X.shape[1]
+        self.direction_chol = np.eye(dims) * np.broadcast_to(np.asarray(width, dtype=np.float64), (dims,))
+
+    def step (self, b, logp):
+        post = self.posterior
+        d  = self.direction_chol.dot(self.rng.standard_normal(len(b)))
+        s  = post.X.dot(b)
+        sd = post.X.dot(d)
+        def line_logp (t):
+            post.evals += 1
+            return post.log_likelihood_linear(s+t*sd) + post.log_prior(b+t*d)
+
+        # Slice height.
+        log_y = logp + np.log(self.rng.random_sample())
+        # Step out.
+        lower = -self.rng.random_sample()
+        upper = lower + 1
+        steps = 0
+        while steps < self.max_steps and line_logp(lower) > log_y:
+            lower -= 1
+            steps += 1
+        while steps < self.max_steps and line_logp(upper) > log_y:
+            upper += 1
+            steps += 1
+        # Shrink.
+        while True:
+            t = lower + (upper-lower)*self.rng.random_sample()
+            t_logp = line_logp(t)
+            if t_logp > log_y:
+                return b+t*d, t_logp, True
+            if t < 0:
+                lower = t
+            else:
+                upper = t
+
+    def tune (self, samples):
+        if len(samples) < 2*samples.shape[1]:
+            return
+        self.direction_chol = np.linalg.cholesky(np.cov(samples, rowvar=False) + 1e-10*np.eye(samples.shape[1]))
+
+class HamiltonianStep (object):
+    """
+    Leapfrog integration and warm-up adaptation shared by HMCStep and NUTSStep.
+    During burn-in the step size is tuned by dual averaging towards 'target_accept', and the diagonal mass matrix is set from the
+    chain's variance whenever the step method is tuned.
+    """
+
+    def __init__ (self, posterior, rng, step_size=None, target_accept=.8):
+        self.posterior = posterior
+        self.rng = rng
+        self.target_accept = target_accept
+        self.inv_mass  = np.ones(posterior.X.shape[1])
+        self.step_size = step_size
+        self.tuning    = False
+        self.adapted   = False
+        # Gradient at the last returned state; saves an evaluation per step.
+        self.last_b    = None
+        self.last_grad = None
+
+    def restart_adaptation (self):
+        self.mu          = np.log(10*self.step_size)
+        self.h_bar       = 0.
+        self.log_eps_bar = np.log(self.step_size)
+        self.t           = 0
+
+    def gradient (self, b, logp):
+        if self.last_b is not None and np.array_equal(b, self.last_b):
+            return self.last_grad
+        return self.posterior.log_prob_grad(b)[1]
+
+    def kinetic (self, r):
+        return .5*(r*r*self.inv_mass).sum()
+
+    def leapfrog (self, b, r, grad, eps):
+        r = r + .5*eps*grad
+        b = b + eps*self.inv_mass*r
+        logp, grad = self.posterior.log_prob_grad(b)
+        r = r + .5*eps*grad
+        return b, r, logp, grad
+
+    def joint (self, logp, r):
+        joint = logp - self.kinetic(r)
+        return joint if np.isfinite(joint) else -np.inf
+
+    def current_step_size (self, b, logp, grad):
+        """
+        Step size for the next trajectory; finds a starting value on first use and ends adaptation after burn-in.
+        """
+        if self.step_size is None:
+            # Double or halve until a single leapfrog step has acceptance probability crossing 1/2.
+            eps = 1.
+            r = self.rng.standard_normal(len(b))/np.sqrt(self.inv_mass)
+            joint = self.joint(logp, r)
+            _b, r1, logp1, _g = self.leapfrog(b, r, grad, eps)
+            direction = 1 if self.joint(logp1, r1) - joint > np.log(.5) else -1
+            for _i in range(50):
+                _b, r1, logp1, _g = self.leapfrog(b, r, grad, eps)
+                if direction*(self.joint(logp1, r1) - joint) <= -direction*np.log(2):
+                    break
+                eps *= 2.**direction
+            self.step_size = eps
+            self.restart_adaptation()
+        if self.tuning:
+            self.adapted = True
+            return self.step_size*np.exp(.2*self.rng.uniform(-1,1))
+        if self.adapted:
+            # Burn-in is over: fix the averaged step size.
+            self.step_size = np.exp(self.log_eps_bar)
+            self.adapted = False
+        return self.step_size
+
+    def adapt_step_size (self, accept_stat):
+        """
+        Dual averaging update (Hoffman & Gelman, 2014) during burn-in.
+        """
+        if not self.tuning:
+            return
+        self.t += 1
+        eta = 1./(self.t+10)
+        self.h_bar = (1-eta)*self.h_bar + eta*(self.target_accept-accept_stat)
+        log_eps = self.mu - np.sqrt(self.t)/.05*self.h_bar
+        weight = self.t**-.75
+        self.log_eps_bar = weight*log_eps + (1-weight)*self.log_eps_bar
+        self.step_size = np.exp(log_eps)
+
+    def tune (self, samples):
+        """
+        Sets the diagonal mass matrix from the samples drawn so far (regularized towards a small constant) and restarts step size adaptation.
+        """
+        if len(samples) < 2*samples.shape[1] or self.step_size is None:
+            return
+        n = len(samples)
+        self.inv_mass = n/(n+5.)*samples.var(axis=0) + 1e-3*5./(n+5.)
+        self.restart_adaptation()
+
+    def finish (self, b, logp, grad, b_new, logp_new, grad_new):
+        self.last_b, self.last_grad = b_new, grad_new
+        return b_new, logp_new, not np.array_equal(b_new, b)
+
+class HMCStep (HamiltonianStep):
+    """
+    Hamiltonian Monte Carlo with a fixed integration time 'path_length' (number of leapfrog steps = path_length/step size).
+    """
+
+    def __init__ (self, posterior, rng, step_size=None, target_accept=.8, path_length=1., max_steps=1000):
+        HamiltonianStep.__init__(self, posterior, rng, step_size, target_accept)
+        self.path_length = path_length
+        self.max_steps   = max_steps
+
+    def step (self, b, logp):
+        grad = self.gradient(b, logp)
+        eps  = self.current_step_size(b, logp, grad)
+        r = self.rng.standard_normal(len(b))/np.sqrt(self.inv_mass)
+        joint = self.joint(logp, r)
+        b_new, r_new, logp_new, grad_new = b, r, logp, grad
+        for _i in range(int(min(max(1, round(self.path_length/eps)), self.max_steps))):
+            b_new, r_new, logp_new, grad_new = self.leapfrog(b_new, r_new, grad_new, eps)
+        log_accept = min(0., self.joint(logp_new, r_new) - joint)
+        self.adapt_step_size(np.exp(log_accept))
+        if np.log(self.rng.random_sample()) < log_accept:
+            return self.finish(b, logp, grad, b_new, logp_new, grad_new)
+        return self.finish(b, logp, grad, b, logp, grad)
+
+class NUTSStep (HamiltonianStep):
+    """
+    No-U-Turn sampler (Hoffman & Gelman, 2014; slice version with dual averaging).
+    """
+
+    def __init__ (self, posterior, rng, step_size=None, target_accept=.8, max_depth=10):
+        HamiltonianStep.__init__(self, posterior, rng, step_size, target_accept)
+        self.max_depth = max_depth
+
+    def no_u_turn (self, b_minus, b_plus, r_minus, r_plus):
+        delta = b_plus - b_minus
+        return delta.dot(self.inv_mass*r_minus) >= 0 and delta.dot(self.inv_mass*r_plus) >= 0
+
+    def step (self, b, logp):
+        grad = self.gradient(b, logp)
+        eps  = self.current_step_size(b, logp, grad)
+        r0 = self.rng.standard_normal(len(b))/np.sqrt(self.inv_mass)
+        joint0 = self.joint(logp, r0)
+        log_u  = joint0 + np.log(self.rng.random_sample())
+
+        # Tree edges and the proposal.
+        b_minus, r_minus, g_minus = b, r0, grad
+        b_plus,  r_plus,  g_plus  = b, r0, grad
+        b_new, logp_new, grad_new = b, logp, grad
+        n = 1
+        keep_going = True
+        depth = 0
+        while keep_going and depth < self.max_depth:
+            # Double the trajectory in a random direction.
+            v = 1 if self.rng.random_sample() < .5 else -1
+            if v == -1:
+                b_minus, r_minus, g_minus, _b, _r, _g, b_p, logp_p, g_p, n_p, s_p, alpha, n_alpha = self.build_tree(b_minus, r_minus, g_minus, log_u, v, depth, eps, joint0)
+            else:
+                _b, _r, _g, b_plus, r_plus, g_plus, b_p, logp_p, g_p, n_p, s_p, alpha, n_alpha = self.build_tree(b_plus, r_plus, g_plus, log_u, v, depth, eps, joint0)
+            if s_p and self.rng.random_sample() < n_p/float(n):
+                b_new, logp_new, grad_new = b_p, logp_p, g_p
+            n += n_p
+            keep_going = s_p and self.no_u_turn(b_minus, b_plus, r_minus, r_plus)
+            depth += 1
+
+        self.adapt_step_size(alpha/float(n_alpha))
+        return self.finish(b, logp, grad, b_new, logp_new, grad_new)
+
+    def build_tree (self, b, r, grad, log_u, v, depth, eps, joint0):
+        """
+        Builds a subtree of 2^depth leapfrog steps in direction v.
+        Returns:
+            Backward edge (b, r, grad), forward edge (b, r, grad), proposal (b, logp, grad), number of valid states,
+            whether to continue, and the acceptance statistic sum and count.
+        """
+        if depth == 0:
+            b1, r1, logp1, g1 = self.leapfrog(b, r, grad, v*eps)
+            joint = self.joint(logp1, r1)
+            alpha = np.exp(min(0., joint-joint0)) if np.isfinite(joint) else 0.
+            return b1, r1, g1, b1, r1, g1, b1, logp1, g1, int(log_u <= joint), log_u < joint+1000, alpha, 1
+
+        b_minus, r_minus, g_minus, b_plus, r_plus, g_plus, b1, logp1, g1, n1, s1, alpha1, n_alpha1 = self.build_tree(b, r, grad, log_u, v, depth-1, eps, joint0)
+        if s1:
+            if v == -1:
+                b_minus, r_minus, g_minus, _b, _r, _g, b2, logp2, g2, n2, s2, alpha2, n_alpha2 = self.build_tree(b_minus, r_minus, g_minus, log_u, v, depth-1, eps, joint0)
+            else:
+                _b, _r, _g, b_plus, r_plus, g_plus, b2, logp2, g2, n2, s2, alpha2, n_alpha2 = self.build_tree(b_plus, r_plus, g_plus, log_u, v, depth-1, eps, joint0)
+            if n1+n2 > 0 and self.rng.random_sample() < n2/float(n1+n2):
+                b1, logp1, g1 = b2, logp2, g2
+            alpha1   += alpha2
+            n_alpha1 += n_alpha2
+            s1 = s2 and self.no_u_turn(b_minus, b_plus, r_minus, r_plus)
+            n1 += n2
+        return b_minus, r_minus, g_minus, b_plus, r_plus, g_plus, b1, logp1, g1, n1, s1, alpha1, n_alpha1
+
+### Stochastic Gradient Step Methods
+
+class StochasticGradientStep (object):
+    """
+    Minibatch gradients shared by SGLDStep and SGHMCStep. Each step reads one chunk of games: every epoch the games are
+    shuffled into a buffer and read in consecutive chunks of 'batch_size', so each game is visited once per epoch.
+    The log likelihood gradient uses control variates around the posterior mode b_hat: the exact full-data gradient at
+    b_hat plus a minibatch estimate of the difference, (games/batch) * sum over the batch of x_i*(p_i(b_hat) - p_i(b)).
+    The estimate is unbiased and its variance vanishes near the mode, so the cost of a step depends on the batch size only.
+    Moves are preconditioned by the Laplace covariance at the mode.
+    """
+
+    def __init__ (self, posterior, rng, batch_size=1000, step_size=.1, mode=None, cov=None):
+        """
+        Inputs:
+            posterior:  LogisticPosterior.
+            rng:        Random stream, used for shuffling and noise.
+            batch_size: Games per step.
+            step_size:  Step size in units of the Laplace covariance.
+            mode, cov:  Posterior mode and Laplace covariance (see posterior_mode). Default: computed here with full-data passes.
+        """
+        self.posterior = posterior
+        self.rng = rng
+        self.step_size = step_size
+        self.tuning = False
+        if mode is None or cov is None:
+            mode, cov = posterior_mode(posterior)
+        self.mode = np.asarray(mode, dtype=np.float64)
+        self.cov = np.asarray(cov, dtype=np.float64)
+        self.chol = np.linalg.cholesky(self.cov)
+        # Full-data likelihood gradient and win probabilities at the mode.
+        self.mode_p = .5*(1+np.tanh(.5*posterior.X.dot(self.mode)))
+        self.mode_grad = posterior.X.T.dot(posterior.y-self.mode_p)
+        # Shuffled buffer, filled at the start of each epoch.
+        self.n = len(posterior.X)
+        self.batch_size = min(batch_size, self.n)
+        self.X_buffer = np.empty_like(posterior.X)
+        self.p_buffer = np.empty_like(self.mode_p)
+        self.position = self.n
+
+    def next_batch (self):
+        """
+        Design matrix rows and mode win probabilities of the next chunk of games.
+        """
+        if self.position >= self.n:
+            order = self.rng.permutation(self.n)
+            np.take(self.posterior.X, order, axis=0, out=self.X_buffer)
+            np.take(self.mode_p, order, out=self.p_buffer)
+            self.position = 0
+        start, stop = self.position, min(self.position+self.batch_size, self.n)
+        self.position = stop
+        return self.X_buffer[start:stop], self.p_buffer[start:stop]
+
+    def gradient (self, b):
+        """
+        Unbiased minibatch estimate of the log posterior gradient at 'b'.
+        """
+        X, mode_p = self.next_batch()
+        p = .5*(1+np.tanh(.5*X.dot(b)))
+        # Likelihood evaluations are counted in full-data equivalents.
+        self.posterior.evals += len(X) / float(self.n)
+        return self.mode_grad + self.n/float(len(X))*X.T.dot(mode_p-p) + self.posterior.log_prior_grad(b)
+
+    def noise (self, variance):
+        """
+        Normal noise with covariance 'variance' times the Laplace covariance.
+        """
+        return np.sqrt(variance)*self.chol.dot(self.rng.standard_normal(len(self.mode)))
+
+    def tune (self, samples):
+        # Step sizes are fixed; the preconditioner comes from the mode.
+        pass
+
+class SGLDStep (StochasticGradientStep):
+    """
+    Stochastic gradient Langevin dynamics (Welling & Teh, 2011): b + step_size/2 * cov.grad + N(0, step_size*cov).
+    There is no accept/reject step, so draws carry a discretization bias that shrinks with the step size (for a normal
+    posterior, variances are inflated by a factor 1/(1-step_size/4)). The log posterior is not evaluated; steps return nan, and
+    None for acceptance.
+    """
+
+    def step (self, b, logp):
+        b = b + .5*self.step_size*self.cov.dot(self.gradient(b)) + self.noise(self.step_size)
+        return b, np.nan, None
+
+class SGHMCStep (StochasticGradientStep):
+    """
+    Stochastic gradient Hamiltonian Monte Carlo (Chen, Fox & Guestrin, 2014) with friction: the velocity decays by 'friction'
+    each step, takes a step_size^2 gradient step and receives N(0, 2*friction*step_size^2*cov) noise. Momentum lets the chain
+    travel further per gradient than SGLD. The log posterior is not evaluated; steps return nan, and None for acceptance.
+    """
+
+    def __init__ (self, posterior, rng, batch_size=1000, step_size=.1, friction=.1, mode=None, cov=None):
+        StochasticGradientStep.__init__(self, posterior, rng, batch_size, step_size, mode, cov)
+        self.friction = friction
+        self.v = np.zeros(len(self.mode))
+
+    def step (self, b, logp):
+        eta = self.step_size**2
+        self.v = (1-self.friction)*self.v + eta*self.cov.dot(self.gradient(b)) + self.noise(2*self.friction*eta)
+        return b + self.v, np.nan, None
+
+### MCMC Interface
+
+class NumpyMCMC (object):
+    """
+    Sampler with the parts of the pymc.MCMC interface used in this project: sample(iter, burn, thin) and trace(name)[:].
+    Like pymc, each call to sample() continues from the last state and stores a new chain.
+    Step methods without an accept/reject step (SGLDStep, SGHMCStep) report None for acceptance; their steps are not counted
+    as proposals, and no acceptance rate is recorded for them.
+    """
+
+    def __init__ (self, posterior, names, step_method, init):
+        """
+        Inputs:
+            posterior:   LogisticPosterior.
+            names:       Trace names for each coefficient, e.g. ['b_0', 'b_diff_Pythag'].
+            step_method: Step method object (MetropolisStep, SliceStep, HMCStep, NUTSStep, SGLDStep, SGHMCStep). Its random
+                         stream is the sampler's.
+            init:        Initial coefficients.
+        """
+        self.posterior = posterior
+        self.names  = list(names)
+        self.step_method = step_method
+        self.rng = step_method.rng
+        self.b = np.array(init, dtype=np.float64)
+        self.logp = posterior.log_prob(self.b)
+        self.chains = []
+        self.accepted = 0
+        self.proposals = 0
+        self.iterations = 0
+
+    def sample (self, iter, burn=0, thin=1, tune_interval=100):
+        """
+        Draws 'iter' iterations, discarding the first 'burn' and keeping every 'thin'-th afterwards.
+        The step method is tuned every 'tune_interval' iterations during burn-in.
+        """
+        kept = np.empty(((max(iter-burn,0)+thin-1)//thin,len(self.b)))
+        burn_samples = np.empty((burn,len(self.b)))
+        step_name = type(self.step_method).__name__
+        evals, accepted_before, proposals_before = self.posterior.evals, self.accepted, self.proposals
+        with instrumentation.timer('sample', step_method=step_name):
+            for i in range(iter):
+                # Step methods that adapt on every iteration do so only during burn-in.
+                self.step_method.tuning = i < burn
+                self.b, self.logp, accepted = self.step_method.step(self.b, self.logp)
+                if accepted is not None:
+                    self.accepted += accepted
+                    self.proposals += 1
+                self.iterations += 1
+                if i < burn:
+                    burn_samples[i] = self.b
+                    if (i+1) % tune_interval == 0 and i+1 < burn:
+                        self.step_method.tune(burn_samples[i+1-min(i+1,10*tune_interval):i+1])
+                elif (i-burn) % thin == 0:
+                    kept[(i-burn)//thin] = self.b
+        self.step_method.tuning = False
+        self.chains.append(kept)
+        instrumentation.count('sampler_iterations', iter, step_method=step_name)
+        instrumentation.count('likelihood_evaluations', self.posterior.evals-evals, step_method=step_name)
+        if self.proposals > proposals_before:
+            instrumentation.gauge('acceptance_rate', (self.accepted-accepted_before)/float(self.proposals-proposals_before), step_method=step_name)
+
+    def trace (self, name, chain=-1):
+        """
+        Samples of one coefficient from a chain; chain=None concatenates all chains.
+        """
+        samples = np.concatenate(self.chains, axis=0) if chain is None else self.chains[chain]
+        return samples[:,self.names.index(name)]
+
+    def acceptance_rate (self):
+        """
+        Acceptance rate over all iterations so far; None for step methods without an accept/reject step.
+        """
+        if isinstance(self.step_method, StochasticGradientStep):
+            return None
+        return self.accepted / float(max(self.proposals,1))
@@ -0,0 +1,121 @@
+### Setup
+
+# Libraries.
+import json
+import numpy as np
+import os
+import pickle
+
+# File names inside a trace store directory.
+header_file = 'header.json'
+values_file = 'coefficients.npy'
+
+### Main Functionality
+
+class TraceStore (object):
+    """
+    Coefficient traces on disk, opened without loading them. A store is a directory holding a JSON header (feature names,
+    chains, seeds, thinning) and one .npy array of shape (coefficients, draws), so each coefficient's trace is contiguous.
+    The array is memory-mapped; coefficients() returns a (draws x coefficients) view of it, which simulate_tournament reads
+    slice by slice, and chunks() reads it a block of draws at a time for predict_games and score_games. The store can stand
+    in for the MCMC object anywhere a 'model_mcmc' is taken.
+    """
+
+    def __init__ (self, path, mmap_mode='r'):
+        """
+        Inputs:
+            path:      Store directory, as written by write_traces.
+            mmap_mode: Memory-map mode for np.load; None loads the traces into memory.
+        """
+        self.path = path
+        with open(os.path.join(path, header_file)) as fid:
+            self.header = json.load(fid)
+        self.values = np.load(os.path.join(path, values_file), mmap_mode=mmap_mode)
+        self.features = self.header['features']
+        self.names = ['b_0']+['b_'+f for f in self.features]
+
+    def __len__ (self):
+        return self.values.shape[1]
+
+    def trace (self, name, chain=None):
+        """
+        Samples of one coefficient, from one chain (by position in the header's chain list) or all chains.
+        """
+        samples = self.values[self.names.index(name)]
+        if chain is None:
+            return samples
+        c = self.header['chains'][chain]
+        return samples[c['start']:c['stop']]
+
+    def coefficients (self, features=None, start=0, stop=None):
+        """
+        Coefficient array in the layout of bayes_lr.feature_coefficients: rows are draws, columns are coefficients starting
+        with the intercept. If 'features' are the stored features (the default), the result is a view of the mapped file;
+        a different subset or order is copied.
+        """
+        if features is None or list(features) == self.features:
+            return self.values[:,start:stop].T
+        missing = [f for f in features if f not in self.features]
+        if len(missing) > 0:
+            raise KeyError('Features not in trace store: %s' % ', '.join(missing))
+        return self.values[[0]+[self.features.index(f)+1 for f in features],start:stop].T
+
+    def chunks (self, chunk_size=4096, features=None):
+        """
+        Generator of (start, coefficients) for consecutive blocks of at most 'chunk_size' draws.
+        """
+        for start in range(0, len(self), chunk_size):
+            yield start, np.ascontiguousarray(self.coefficients(features, start, start+chunk_size))
+
+def write_traces (path, coefs, features, seeds=None, thin=1, burn=0, dtype=np.float64):
+    """
+    Writes coefficient traces to a new trace store.
+    Inputs:
+        path:     Store directory; created if needed.
+        coefs:    Numpy array of coefficients, either (draws x coefficients) as from bayes_lr.feature_coefficients or
+                  (chains x draws x coefficients) as in diagnostics.ChainTraces.samples. Coefficients start with the intercept.
+        features: List of features, in the order of the coefficient columns after the intercept.
+        seeds:    Optional seed of each chain, recorded in the header.
+        thin:     Thinning interval used when sampling, recorded in the header.
+        burn:     Burn-in used when sampling, recorded in the header.
+        dtype:    Floating point type of the stored traces.
+    Returns:
+        TraceStore object opened on the new store.
+    """
+    coefs = np.asarray(coefs)
+    if coefs.ndim == 2:
+        coefs = coefs[None]
+    if coefs.shape[2] != len(features)+1:
+        raise ValueError('Expected %d coefficient columns, got %d.' % (len(features)+1, coefs.shape[2]))
+    if not os.path.isdir(path):
+        os.makedirs(path)
+
+    # Write chain by chain into the mapped output, so the transposed traces are never held in memory.
+    n_chains, draws = coefs.shape[0], coefs.shape[1]
+    values = np.lib.format.open_memmap(os.path.join(path, values_file), mode='w+', dtype=dtype, shape=(coefs.shape[2],n_chains*draws))
+    chains = []
+    for c in range(n_chains):
+        values[:,c*draws:(c+1)*draws] = coefs[c].T
+        chains.append({'chain':c, 'start':c*draws, 'stop':(c+1)*draws, 'seed':None if seeds is None else int(seeds[c])})
+    values.flush()
+    del values
+
+    header = {'version':1, 'features':list(features), 'chains':chains, 'thin':thin, 'burn':burn, 'dtype':np.dtype(dtype).name}
+    with open(os.path.join(path, header_file), 'w') as fid:
+        json.dump(header, fid, indent=2)
+    return TraceStore(path)
+
+def convert_pickle (pickle_path, path, features, thin=1, burn=0):
+    """
+    Converts a pickled coefficient array (e.g. MH_traces.pkl, slice_samples_traces.pkl) to a trace store.
+    The pickles do not record their features; pass them in column order, e.g.
+    ['location_Home','diff_RankAdjTempo','diff_OE','diff_DE','diff_RankPythag'].
+    """
+    with open(pickle_path, 'rb') as fid:
+        try:
+            # Python 2 pickles of numpy arrays need latin1 to load under Python 3.
+            coefs = pickle.load(fid, encoding='latin1')
+        except TypeError:
+            fid.seek(0)
+            coefs = pickle.load(fid)
+    return write_traces(path, coefs, features, thin=thin, burn=burn)
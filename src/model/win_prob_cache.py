@@ -0,0 +1,136 @@
+### Setup
+
+# Libraries.
+import collections
+import numpy as np
+
+# Custom library
+import game_predictions
+
+### Main Functionality
+
+class WinProbabilityCache (object):
+    """
+    Pairwise win probabilities for a set of teams under every draw of a coefficient trace.
+    Entry [d,i,j] of the (draws x teams x teams) tensor is the probability that team i, playing as the "team", beats team j under draw d.
+    The tensor is filled lazily in blocks of draws; blocks are evicted least-recently-used once more than 'max_bytes' are held.
+    """
+
+    def __init__ (self, teams, team_stats, features, coef_trace, block_size=1024, max_bytes=256*2**20, dtype=np.float64, symmetric=False):
+        """
+        Inputs:
+            teams:      List of team names. Any team that may appear in a simulated bracket or query.
+            team_stats: Dataframe with team statistics, keyed by 'TeamName'.
+            features:   List of features the coefficients were fit on.
+            coef_trace: Numpy array of coefficients; one row per draw, intercept first.
+            block_size: Number of draws computed (and evicted) together.
+            max_bytes:  Memory bound for cached blocks. The most recent block is always kept.
+            dtype:      Floating point type of the stored probabilities.
+            symmetric:  True for coefficients from bayes_lr.model_games(symmetric=True); see game_predictions.matchup_design.
+        """
+        self.teams      = np.unique(np.asarray(teams).ravel())
+        self.features   = list(features)
+        self.coef_trace = np.atleast_2d(coef_trace)
+        self.block_size = int(block_size)
+        self.max_bytes  = max_bytes
+        self.dtype      = dtype
+        self.symmetric  = symmetric
+
+        # Design rows for every ordered pair of teams. These do not depend on the draws, so they are built once.
+        stats, spec = game_predictions.team_feature_matrix(self.teams, team_stats, self.features, symmetric)
+        self.design = game_predictions.pairwise_design(stats, spec, symmetric)
+
+        # Block storage.
+        self.blocks = collections.OrderedDict()
+        self.nbytes = 0
+        self.hits   = 0
+        self.misses = 0
+
+    def __len__ (self):
+        return len(self.coef_trace)
+
+    def index (self, names):
+        """
+        Positions of team names in the cache. Raises KeyError for unknown teams.
+        """
+        names = np.asarray(names)
+        positions = np.searchsorted(self.teams, names)
+        found = (positions < len(self.teams)) & (self.teams[np.minimum(positions,len(self.teams)-1)] == names)
+        if not np.all(found):
+            raise KeyError('Teams not in cache: %s' % ', '.join(np.atleast_1d(names[~found]).astype(str)))
+        return positions
+
+    def block (self, b):
+        """
+        Probability tensor for the b-th block of draws, computing it if needed.
+        """
+        if b in self.blocks:
+            # Re-insert to mark as most recently used.
+            probs = self.blocks.pop(b)
+            self.blocks[b] = probs
+            self.hits += 1
+            return probs
+        self.misses += 1
+
+        # One matrix product covers every pair for every draw in the block.
+        coefs = self.coef_trace[b*self.block_size:(b+1)*self.block_size]
+        probs = game_predictions.logistic(coefs.dot(self.design.T)).astype(self.dtype)
+        probs = probs.reshape((len(coefs),len(self.teams),len(self.teams)))
+
+        # Store; evict old blocks beyond the memory bound.
+        self.blocks[b] = probs
+        self.nbytes += probs.nbytes
+        while self.nbytes > self.max_bytes and len(self.blocks) > 1:
+            _b, evicted = self.blocks.popitem(last=False)
+            self.nbytes -= evicted.nbytes
+        return probs
+
+    def probabilities (self, start=0, stop=None):
+        """
+        Probability tensor for draws [start, stop).
+        """
+        stop = len(self) if stop is None else min(stop, len(self))
+        parts = []
+        for b in range(start//self.block_size, (stop-1)//self.block_size+1):
+            lo = max(start-b*self.block_size, 0)
+            hi = min(stop-b*self.block_size, self.block_size)
+            parts.append(self.block(b)[lo:hi])
+        return np.concatenate(parts, axis=0)
+
+    def lookup (self, team, opponent, start=0):
+        """
+        Win probabilities for team/opponent position arrays whose first axis runs over draws beginning at 'start'.
+        """
+        team     = np.asarray(team)
+        opponent = np.asarray(opponent)
+        probs = np.empty(team.shape)
+        d = 0
+        while d < team.shape[0]:
+            b, lo = divmod(start+d, self.block_size)
+            block = self.block(b)
+            n = min(block.shape[0]-lo, team.shape[0]-d)
+            draw_idx = np.arange(lo, lo+n).reshape((n,)+(1,)*(team.ndim-1))
+            probs[d:d+n] = block[draw_idx, team[d:d+n], opponent[d:d+n]]
+            d += n
+        return probs
+
+    def draw_lookup (self, positions, start=0):
+        """
+        Win probability function for game_predictions.simulate_bracket_draws.
+        Inputs:
+            positions: Cache positions of the simulation's teams (see index).
+            start:     First draw of the simulation.
+        Returns:
+            Function mapping simulation team/opponent arrays to win probabilities.
+        """
+        positions = np.asarray(positions)
+        def win_prob (team, opponent, chunk_start=0):
+            return self.lookup(positions[team], positions[opponent], start+chunk_start)
+        return win_prob
+
+    def matchup (self, team, opponent):
+        """
+        Per-draw probability that 'team' beats 'opponent', averaging over which side is the "team" as in the simulations.
+        """
+        i, j = self.index([team, opponent])
+        return .5*(self.lookup(np.repeat(i,len(self)), np.repeat(j,len(self))) + 1 - self.lookup(np.repeat(j,len(self)), np.repeat(i,len(self))))